@@ -0,0 +1,109 @@
+"""
+Бенчмарк форматов сообщений: JSON и двоичный формат (common.codec).
+
+Для типичных сообщений протокола выводит размер кадра на проводе и
+время кодирования и декодирования одного сообщения.
+
+Запуск из корня проекта:
+    python benchmarks/codec.py [--number 20000]
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from common.utils import MessageBuffer
+
+
+def sample_messages():
+    """
+    Функция возвращает типичные сообщения протокола.
+
+    :return: dict: название - сообщение.
+    """
+
+    return {
+        'сообщение (RSA 2048)': {
+            ACTION: MESSAGE,
+            SENDER: 'Евгений',
+            DESTINATION: 'Анна',
+            TIME: time.time(),
+            MESSAGE_TEXT: base64.b64encode(os.urandom(256)).decode('ascii')
+        },
+        'ответ 200': {RESPONSE: 200},
+        'список контактов': {
+            RESPONSE: 202,
+            LIST_INFO: [f'user_{number}' for number in range(20)]
+        },
+        'presence': {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {ACCOUNT_NAME: 'Евгений', PUBLIC_KEY: 'k' * 450},
+            FRAMING: FRAMING_LENGTH,
+            CODEC: CODEC_BINARY
+        },
+    }
+
+
+def make_buffer(codec: str):
+    """
+    Функция создаёт буфер, согласованный на кадры с заданным форматом.
+
+    :param codec: формат сообщений,
+    :return: MessageBuffer: буфер.
+    """
+
+    buffer = MessageBuffer()
+    buffer.framed = True
+    buffer.codec = codec
+    return buffer
+
+
+def measure(message: dict, codec: str, number: int):
+    """
+    Функция измеряет размер кадра и время кодирования и декодирования.
+
+    :param message: сообщение,
+    :param codec: формат сообщений,
+    :param number: количество повторов,
+    :return: tuple: размер в байтах, кодирование и декодирование в
+    микросекундах.
+    """
+
+    sender = make_buffer(codec)
+    receiver = make_buffer(codec)
+    frame = sender.pack(message)
+
+    def decode():
+        receiver.feed(frame)
+        return receiver.next_message()
+
+    assert decode() == message
+    encode_time = timeit.timeit(lambda: sender.pack(message), number=number)
+    decode_time = timeit.timeit(decode, number=number)
+    return len(frame), encode_time / number * 1e6, \
+        decode_time / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--number', default=20000, type=int)
+    namespace = parser.parse_args()
+
+    print(f'{"сообщение":<22}{"формат":<8}{"байт":>6}'
+          f'{"код., мкс":>11}{"декод., мкс":>13}')
+    for name, message in sample_messages().items():
+        for codec in (CODEC_JSON, CODEC_BINARY):
+            size, encode_time, decode_time = measure(message, codec,
+                                                     namespace.number)
+            print(f'{name:<22}{codec:<8}{size:>6}'
+                  f'{encode_time:>11.2f}{decode_time:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,504 @@
+"""
+Генератор нагрузки: синтетические пользователи против локального сервера.
+
+Регистрирует пользователей в базе сервера, запускает сервер в отдельных
+процессах (или подключается к уже запущенному), проходит настоящую
+авторизацию (PBKDF2, HMAC) и отправляет зашифрованные сообщения и
+запросы в заданной пропорции. Результат - пропускная способность,
+задержки (p50, p95, p99) по видам запросов и счётчики ошибок - выводится
+в JSON, чтобы сравнивать запуски между собой.
+
+Запуск из корня проекта:
+    python benchmarks/loadgen.py [--users 50] [--duration 10]
+        [--mix chat=80,contacts=10,users=5,keys=5] [--rate 0]
+        [--engine thread] [--shards 1] [--codec binary] [--output r.json]
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from common.utils import MessageBuffer, Compressor
+from common.errors import ProtocolError
+from server.core import MessageProcessor
+from server.async_core import AsyncMessageProcessor
+from server.database import ServerStorage
+from server.shards import ShardSupervisor
+
+try:
+    from Cryptodome.Cipher import PKCS1_OAEP
+    from Cryptodome.PublicKey import RSA
+except ImportError:
+    PKCS1_OAEP = RSA = None
+
+# Виды запросов генератора и пропорция по умолчанию.
+OPERATIONS = ('chat', 'contacts', 'users', 'active', 'keys')
+DEFAULT_MIX = 'chat=80,contacts=10,users=5,keys=5'
+# Текст сообщения до шифрования.
+MESSAGE_PLAINTEXT = 'Проверка связи, нагрузочный тест.'.encode(ENCODING)
+
+
+def password_hash(name: str, password: str, iterations: int):
+    """
+    Функция вычисляет хэш пароля так же, как клиент и окно регистрации.
+
+    :param name: имя пользователя,
+    :param password: пароль,
+    :param iterations: количество итераций PBKDF2,
+    :return: bytes: хэш в шестнадцатеричном виде.
+    """
+
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha512', password.encode(ENCODING), name.lower().encode(ENCODING),
+        iterations))
+
+
+def parse_mix(spec: str):
+    """
+    Функция разбирает пропорцию запросов вида "chat=80,users=20".
+
+    :param spec: строка с пропорцией,
+    :return: tuple: виды запросов и их веса.
+    """
+
+    operations, weights = [], []
+    for item in spec.split(','):
+        name, weight = item.split('=')
+        if name.strip() not in OPERATIONS:
+            raise ValueError(f'Неизвестный вид запроса - {name}.')
+        operations.append(name.strip())
+        weights.append(float(weight))
+    return operations, weights
+
+
+def percentile(values: list, share: float):
+    """
+    Функция возвращает перцентиль отсортированного списка (ближайший
+    ранг).
+
+    :param values: отсортированные значения,
+    :param share: доля от 0 до 1,
+    :return: float: значение перцентиля.
+    """
+
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1,
+                       int(round(share * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summary(values: list):
+    """
+    Функция сводит список задержек в секундах к счётчику и перцентилям
+    в миллисекундах.
+
+    :param values: задержки,
+    :return: dict: сводка.
+    """
+
+    values = sorted(values)
+    result = {'count': len(values)}
+    for name, share in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        value = percentile(values, share)
+        result[name] = round(value * 1000, 3) if value is not None else None
+    result['max'] = round(values[-1] * 1000, 3) if values else None
+    return result
+
+
+class Stats:
+    """Класс - задержки по видам запросов и счётчики ошибок."""
+
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+
+    def record(self, operation: str, latency: float):
+        self.latency.setdefault(operation, []).append(latency)
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class VirtualUser:
+    """
+    Класс - синтетический пользователь.
+
+    Держит одно соединение с сервером, согласует кадры и формат так же,
+    как ClientTransport, и сопоставляет ответы с запросами по
+    идентификатору.
+    """
+
+    def __init__(self, name: str, secret: bytes, peers: list, options,
+                 stats: Stats, encryptor, public_key: str):
+        self.name = name
+        self.secret = secret
+        self.peers = peers
+        self.options = options
+        self.stats = stats
+        self.encryptor = encryptor
+        self.public_key = public_key
+        self.buffer = MessageBuffer()
+        self.reader = None
+        self.writer = None
+        self.request_ids = itertools.count(1)
+        self.requests = {}
+        self.contacts = set()
+        self.listener = None
+
+    def send(self, message: dict):
+        """Метод ставит сообщение в буфер отправки."""
+
+        self.writer.write(self.buffer.pack(message))
+
+    async def receive(self):
+        """Сопрограмма приёма одного сообщения сервера."""
+
+        message = self.buffer.next_message()
+        while message is None:
+            data = await self.reader.read(RECV_BUFFER_LENGTH)
+            if not data:
+                raise ConnectionResetError('Сервер закрыл соединение.')
+            self.buffer.feed(data)
+            message = self.buffer.next_message()
+        return message
+
+    async def login(self, host: str, port: int):
+        """
+        Сопрограмма подключения и авторизации.
+
+        :param host: адрес сервера,
+        :param port: порт сервера,
+        :return: ничего не возвращает.
+        """
+
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        presence = {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {ACCOUNT_NAME: self.name, PUBLIC_KEY: self.public_key},
+            FRAMING: FRAMING_LENGTH
+        }
+        if self.options.codec == CODEC_BINARY:
+            presence[CODEC] = CODEC_BINARY
+        if self.options.compression:
+            presence[COMPRESSION] = COMPRESSION_ZLIB
+        self.send(presence)
+        if self.options.compression:
+            self.buffer.compressor = Compressor()
+        answer = await self.receive()
+        if answer.get(RESPONSE) != 511:
+            raise ConnectionError(f'Авторизация отклонена: {answer}.')
+        digest = hmac.new(self.secret, answer[DATA].encode(ENCODING),
+                          'MD5').digest()
+        self.send({RESPONSE: 511,
+                   DATA: binascii.b2a_base64(digest).decode('ascii')})
+        answer = await self.receive()
+        while RESPONSE not in answer:
+            answer = await self.receive()
+        if answer[RESPONSE] != 200:
+            raise ConnectionError(f'Авторизация отклонена: {answer}.')
+        self.stats.record('login', time.perf_counter() - started)
+        self.listener = asyncio.get_running_loop().create_task(self.listen())
+
+    async def listen(self):
+        """
+        Сопрограмма чтения сообщений сервера: ответы передаются
+        ожидающим запросам, для доставленных сообщений считается время
+        доставки, на ping отправляется pong.
+
+        :return: ничего не возвращает.
+        """
+
+        try:
+            while True:
+                message = await self.receive()
+                request_id = message.get(REQUEST_ID)
+                if request_id is not None:
+                    future = self.requests.pop(request_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif message.get(ACTION) == MESSAGE:
+                    self.stats.record('delivery',
+                                      max(time.time() - message[TIME], 0))
+                elif message.get(ACTION) == PING:
+                    self.send({ACTION: PONG, TIME: time.time()})
+        except (OSError, ProtocolError, ValueError, TypeError) as err:
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_exception(err)
+            self.requests.clear()
+
+    async def request(self, message: dict):
+        """
+        Сопрограмма отправки запроса и ожидания ответа.
+
+        :param message: запрос,
+        :return: dict: ответ сервера.
+        """
+
+        request_id = next(self.request_ids)
+        message[REQUEST_ID] = request_id
+        future = asyncio.get_running_loop().create_future()
+        self.requests[request_id] = future
+        self.send(message)
+        try:
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        finally:
+            self.requests.pop(request_id, None)
+
+    def chat_message(self):
+        """Метод формирует зашифрованное сообщение случайному собеседнику."""
+
+        if self.encryptor is not None:
+            ciphertext = self.encryptor.encrypt(MESSAGE_PLAINTEXT)
+        else:
+            ciphertext = os.urandom(256)
+        return {
+            ACTION: MESSAGE,
+            SENDER: self.name,
+            DESTINATION: random.choice(self.peers),
+            TIME: time.time(),
+            MESSAGE_TEXT: base64.b64encode(ciphertext).decode('ascii')
+        }
+
+    def operation_request(self, operation: str):
+        """
+        Метод формирует запрос заданного вида.
+
+        :param operation: вид запроса,
+        :return: dict: запрос.
+        """
+
+        if operation == 'chat':
+            return self.chat_message()
+        if operation == 'contacts':
+            contact = random.choice(self.peers)
+            action = REMOVE_CONTACT if contact in self.contacts \
+                else ADD_CONTACT
+            self.contacts ^= {contact}
+            return {ACTION: action, TIME: time.time(), USER: self.name,
+                    ACCOUNT_NAME: contact}
+        if operation == 'users':
+            return {ACTION: USERS_REQUEST, TIME: time.time(),
+                    ACCOUNT_NAME: self.name}
+        if operation == 'active':
+            return {ACTION: ACTIVE_USERS, TIME: time.time()}
+        return {ACTION: PUBLIC_KEY_REQUEST, TIME: time.time(),
+                ACCOUNT_NAME: random.choice(self.peers)}
+
+    async def run(self, deadline: float, operations: list, weights: list):
+        """
+        Сопрограмма генерации запросов до окончания теста.
+
+        :param deadline: время окончания по time.perf_counter,
+        :param operations: виды запросов,
+        :param weights: их веса,
+        :return: ничего не возвращает.
+        """
+
+        interval = 1 / self.options.rate if self.options.rate else 0
+        next_start = time.perf_counter()
+        while time.perf_counter() < deadline:
+            operation = random.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                answer = await self.request(self.operation_request(operation))
+            except asyncio.TimeoutError:
+                self.stats.error('timeout')
+                continue
+            except (OSError, ProtocolError) as err:
+                self.stats.error(type(err).__name__)
+                return
+            if answer.get(RESPONSE) in (200, 202, 511):
+                self.stats.record(operation, time.perf_counter() - started)
+            else:
+                self.stats.error(f'response_{answer.get(RESPONSE)}')
+            if interval:
+                next_start += interval
+                delay = next_start - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+    def close(self):
+        """Метод закрывает соединение."""
+
+        if self.listener is not None:
+            self.listener.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def drive(options, secrets: dict, public_key: str, encryptor):
+    """
+    Сопрограмма подключения пользователей и генерации нагрузки.
+
+    :param options: параметры запуска,
+    :param secrets: имя пользователя и хэш пароля,
+    :param public_key: публичный ключ пользователей,
+    :param encryptor: шифратор сообщений или None,
+    :return: dict: результаты.
+    """
+
+    stats = Stats()
+    names = list(secrets)
+    users = [VirtualUser(name, secrets[name],
+                         [peer for peer in names if peer != name] or [name],
+                         options, stats, encryptor, public_key)
+             for name in names]
+    connected = []
+    for start in range(0, len(users), options.connect_batch):
+        batch = users[start:start + options.connect_batch]
+        results = await asyncio.gather(
+            *(user.login(options.host, options.port) for user in batch),
+            return_exceptions=True)
+        for user, result in zip(batch, results):
+            if isinstance(result, Exception):
+                stats.error(f'login_{type(result).__name__}')
+            else:
+                connected.append(user)
+
+    operations, weights = parse_mix(options.mix)
+    started = time.perf_counter()
+    deadline = started + options.duration
+    await asyncio.gather(*(user.run(deadline, operations, weights)
+                           for user in connected))
+    elapsed = time.perf_counter() - started
+    # Даём доставить сообщения, отправленные в конце теста.
+    await asyncio.sleep(0.2)
+    for user in connected:
+        user.close()
+
+    completed = sum(len(values) for operation, values
+                    in stats.latency.items() if operation in OPERATIONS)
+    return {
+        'users': len(users),
+        'connected': len(connected),
+        'duration': round(elapsed, 3),
+        'operations': completed,
+        'throughput': round(completed / elapsed, 1) if elapsed else 0,
+        'latency_ms': {operation: summary(values) for operation, values
+                       in sorted(stats.latency.items())},
+        'errors': stats.errors
+    }
+
+
+def register_users(database: ServerStorage, count: int, password: str,
+                   iterations: int):
+    """
+    Функция регистрирует синтетических пользователей, которых ещё нет в
+    базе.
+
+    :param database: база данных сервера,
+    :param count: количество пользователей,
+    :param password: общий пароль,
+    :param iterations: количество итераций PBKDF2,
+    :return: dict: имя пользователя и хэш пароля.
+    """
+
+    secrets = {}
+    for number in range(count):
+        name = f'load_{number}'
+        secrets[name] = password_hash(name, password, iterations)
+        if not database.check_user(name):
+            database.add_user(name, secrets[name])
+    return secrets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', default=50, type=int)
+    parser.add_argument('--duration', default=10.0, type=float)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--rate', default=0.0, type=float,
+                        help='запросов в секунду на пользователя, '
+                             '0 - следующий запрос сразу после ответа')
+    parser.add_argument('--engine', default=SERVER_ENGINES[0],
+                        choices=SERVER_ENGINES)
+    parser.add_argument('--shards', default=1, type=int)
+    parser.add_argument('--codec', default=CODEC_BINARY,
+                        choices=(CODEC_JSON, CODEC_BINARY))
+    parser.add_argument('--compression', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=17777, type=int)
+    parser.add_argument('--database', default=None,
+                        help='база сервера, по умолчанию - временный файл')
+    parser.add_argument('--connect-only', action='store_true',
+                        help='не запускать сервер, а подключиться к '
+                             'запущенному с той же базой')
+    parser.add_argument('--setting', action='append', default=[],
+                        help='параметр сервера вида name=value')
+    parser.add_argument('--iterations', default=100000, type=int)
+    parser.add_argument('--connect-batch', default=50, type=int)
+    parser.add_argument('--output', default=None)
+    options = parser.parse_args()
+
+    logging.getLogger('server').setLevel(logging.WARNING)
+    logging.getLogger('client').setLevel(logging.WARNING)
+
+    database_path = options.database or os.path.join(
+        tempfile.mkdtemp(prefix='loadgen-'), 'server.db3')
+    database = ServerStorage(database_path)
+    secrets = register_users(database, options.users, 'load',
+                             options.iterations)
+
+    # Ограничение частоты по умолчанию отключено: генератор измеряет
+    # сервер, а не ограничитель.
+    settings = {'rate_limit': '0'}
+    settings.update(item.split('=', 1) for item in options.setting)
+
+    supervisor = None
+    if not options.connect_only:
+        engine = AsyncMessageProcessor if options.engine == 'asyncio' \
+            else MessageProcessor
+        supervisor = ShardSupervisor(options.shards, engine, options.host,
+                                     options.port, database, settings)
+        supervisor.start()
+        time.sleep(0.5)
+
+    encryptor, public_key = None, 'loadgen-key'
+    if RSA is not None:
+        key = RSA.generate(2048)
+        public_key = key.publickey().export_key().decode('ascii')
+        encryptor = PKCS1_OAEP.new(key.publickey())
+
+    try:
+        result = asyncio.run(drive(options, secrets, public_key, encryptor))
+    finally:
+        if supervisor is not None:
+            supervisor.stop()
+            supervisor.join()
+
+    result['config'] = {
+        'engine': options.engine,
+        'shards': options.shards,
+        'codec': options.codec,
+        'compression': options.compression,
+        'mix': options.mix,
+        'rate': options.rate,
+        'encryption': encryptor is not None,
+        'settings': settings
+    }
+    report = json.dumps(result, ensure_ascii=False, indent=2)
+    if options.output:
+        with open(options.output, 'w', encoding=ENCODING) as file:
+            file.write(report)
+    print(report)
+
+
+if __name__ == '__main__':
+    main()
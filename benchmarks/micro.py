@@ -0,0 +1,303 @@
+"""
+Микробенчмарки горячих путей протокола и баз данных.
+
+Измеряет время одного вызова: обмена сообщением через пару сокетов
+(send_message и get_message), проверки авторизации login_required,
+методов ServerStorage (process_message, get_contacts, user_login,
+check_user) на синтетической базе заданного числа пользователей и
+ClientDatabase.get_history на истории того же числа сообщений.
+
+Результаты можно сохранить как базовые и сравнивать с ними следующие
+запуски: замедление больше допустимого завершает скрипт с кодом 1.
+
+Запуск из корня проекта:
+    python benchmarks/micro.py [--sizes 1000 100000 1000000]
+        [--save [benchmarks/baseline.json]]
+        [--compare [benchmarks/baseline.json]] [--tolerance 0.3]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from common.decos import login_required
+from common.utils import send_message, get_message, get_buffer
+from server.database import ServerStorage
+
+# Файл базовых результатов по умолчанию.
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+# Контактов у каждого синтетического пользователя и собеседников в
+# истории клиента.
+CONTACTS_PER_USER = 2
+HISTORY_CONTACTS = 100
+# Строк в одной пакетной вставке при заполнении баз.
+INSERT_BATCH = 10000
+
+
+def timed(func, min_time: float, repeat: int):
+    """
+    Функция измеряет время одного вызова: вызывает функцию, пока не
+    пройдёт min_time секунд, и берёт лучший из repeat замеров.
+
+    :param func: функция без параметров,
+    :param min_time: минимальная длительность замера в секундах,
+    :param repeat: количество замеров,
+    :return: float: время одного вызова в микросекундах.
+    """
+
+    results = []
+    for _ in range(repeat):
+        number = 0
+        started = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < min_time:
+            func()
+            number += 1
+            elapsed = time.perf_counter() - started
+        results.append(elapsed / number * 1e6)
+    return min(results)
+
+
+def bench_transport(measure):
+    """
+    Функция измеряет обмен сообщением через пару сокетов: старый формат
+    без кадров и двоичные кадры.
+
+    :param measure: функция замера,
+    :return: dict: название - время в микросекундах.
+    """
+
+    message = {
+        ACTION: MESSAGE,
+        SENDER: 'sender',
+        DESTINATION: 'recipient',
+        TIME: time.time(),
+        MESSAGE_TEXT: 'x' * 344
+    }
+    results = {}
+    for name, codec in (('legacy', None), ('binary', CODEC_BINARY)):
+        sender, receiver = socket.socketpair()
+        if codec:
+            get_buffer(sender).framed = True
+            get_buffer(sender).codec = codec
+
+        def exchange():
+            send_message(sender, message)
+            get_message(receiver)
+
+        results[f'utils.send_get[{name}]'] = measure(exchange)
+        sender.close()
+        receiver.close()
+    return results
+
+
+def bench_login_required(measure, sessions: int = 1000):
+    """
+    Функция измеряет вызов метода с проверкой авторизации и без неё.
+
+    :param measure: функция замера,
+    :param sessions: количество авторизованных клиентов,
+    :return: dict: название - время в микросекундах.
+    """
+
+    class Processor:
+        def __init__(self):
+            self.sessions = {number: None for number in range(sessions)}
+
+        def plain(self, message, client):
+            return client
+
+        checked = login_required(plain)
+
+    processor = Processor()
+    message = {ACTION: MESSAGE}
+    client = sessions // 2
+    return {
+        'decos.plain_call': measure(lambda: processor.plain(message, client)),
+        'decos.login_required': measure(
+            lambda: processor.checked(message, client))
+    }
+
+
+def grow_server_database(database: ServerStorage, size: int):
+    """
+    Функция добавляет в базу сервера синтетических пользователей, их
+    истории и контакты, пока пользователей не станет size.
+
+    :param database: база данных сервера,
+    :param size: требуемое количество пользователей,
+    :return: ничего не возвращает.
+    """
+
+    tables = database.metadata.tables
+    count = database.session.query(database.AllUsers).count()
+    now = datetime.now()
+    for start in range(count, size, INSERT_BATCH):
+        ids = range(start + 1, min(start + INSERT_BATCH, size) + 1)
+        database.session.execute(tables['Users'].insert(), [
+            {'id': user_id, 'name': f'user_{user_id}',
+             'password_hash': 'hash', 'last_login': now, 'pubkey': 'key'}
+            for user_id in ids])
+        database.session.execute(tables['Users_history'].insert(), [
+            {'user': user_id, 'sent': 0, 'accepted': 0} for user_id in ids])
+        database.session.execute(tables['Contacts'].insert(), [
+            {'user': user_id, 'contact': contact} for user_id in ids
+            for contact in random.sample(
+                range(1, user_id + 1), min(CONTACTS_PER_USER, user_id))])
+        database.session.commit()
+    # Пользователи добавлены в обход ServerStorage, поэтому кэш
+    # заполняется заново, как при запуске сервера.
+    database.load_users()
+
+
+def bench_server_database(database: ServerStorage, size: int, measure):
+    """
+    Функция измеряет методы базы сервера на случайных пользователях.
+
+    :param database: база данных сервера,
+    :param size: количество пользователей в базе,
+    :param measure: функция замера,
+    :return: dict: название - время в микросекундах.
+    """
+
+    def name():
+        return f'user_{random.randint(1, size)}'
+
+    return {
+        f'storage.check_user[{size}]': measure(
+            lambda: database.check_user(name())),
+        f'storage.get_contacts[{size}]': measure(
+            lambda: database.get_contacts(name())),
+        f'storage.process_message[{size}]': measure(
+            lambda: database.process_message(name(), name())),
+        f'storage.user_login[{size}]': measure(
+            lambda: database.user_login(name(), '127.0.0.1', 7777, 'key')),
+    }
+
+
+def grow_client_history(database, size: int):
+    """
+    Функция добавляет в историю клиента сообщения, пока их не станет
+    size.
+
+    :param database: база данных клиента,
+    :param size: требуемое количество сообщений,
+    :return: ничего не возвращает.
+    """
+
+    table = database.metadata.tables['messages_stat']
+    count = database.session.query(database.MessagesStat).count()
+    now = datetime.now()
+    for start in range(count, size, INSERT_BATCH):
+        database.session.execute(table.insert(), [
+            {'contact': f'user_{number % HISTORY_CONTACTS}',
+             'direction': 'in', 'message': 'x' * 100, 'date': now}
+            for number in range(start, min(start + INSERT_BATCH, size))])
+        database.session.commit()
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Функция сравнивает результаты с базовыми.
+
+    :param results: текущие результаты,
+    :param baseline: базовые результаты,
+    :param tolerance: допустимое замедление (0.3 - на 30%),
+    :return: list: названия замедлившихся замеров.
+    """
+
+    regressions = []
+    print(f'{"замер":<36}{"база, мкс":>12}{"сейчас, мкс":>13}{"изм.":>8}')
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f'{name:<36}{"-":>12}{value:>13.2f}')
+            continue
+        change = value / base - 1
+        mark = ''
+        if change > tolerance:
+            regressions.append(name)
+            mark = '  замедление'
+        print(f'{name:<36}{base:>12.2f}{value:>13.2f}{change:>+8.0%}{mark}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default=[1000, 100000, 1000000],
+                        type=int, nargs='+')
+    parser.add_argument('--min-time', default=0.2, type=float)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--save', nargs='?', const=BASELINE, default=None)
+    parser.add_argument('--compare', nargs='?', const=BASELINE,
+                        default=None)
+    parser.add_argument('--tolerance', default=0.3, type=float)
+    namespace = parser.parse_args()
+
+    logging.getLogger('server').setLevel(logging.WARNING)
+    logging.getLogger('client').setLevel(logging.WARNING)
+    random.seed(namespace.seed)
+
+    def measure(func):
+        return timed(func, namespace.min_time, namespace.repeat)
+
+    results = {}
+    results.update(bench_transport(measure))
+    results.update(bench_login_required(measure))
+
+    # Отображения классов ServerStorage и ClientDatabase создаются один
+    # раз на процесс, поэтому базы не пересоздаются, а дополняются до
+    # следующего размера.
+    from client.databases.database import ClientDatabase
+    client_name = f'micro_{os.getpid()}'
+    client_path = os.path.join(os.path.dirname(__file__), '..', 'client',
+                               'databases', f'client_{client_name}.db3')
+    with tempfile.TemporaryDirectory(prefix='micro-') as directory:
+        server_database = ServerStorage(os.path.join(directory, 'server.db3'))
+        client_database = ClientDatabase(client_name)
+        try:
+            for size in sorted(namespace.sizes):
+                grow_server_database(server_database, size)
+                results.update(
+                    bench_server_database(server_database, size, measure))
+                grow_client_history(client_database, size)
+                contact = f'user_{random.randrange(HISTORY_CONTACTS)}'
+                results[f'client.get_history[{size}]'] = measure(
+                    lambda: client_database.get_history(contact))
+        finally:
+            client_database.session.close()
+            client_database.database_engine.dispose()
+            os.remove(client_path)
+        server_database.session.close()
+        server_database.database_engine.dispose()
+
+    regressions = []
+    if namespace.compare:
+        with open(namespace.compare, encoding=ENCODING) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, namespace.tolerance)
+    else:
+        for name, value in results.items():
+            print(f'{name:<36}{value:>13.2f} мкс')
+
+    if namespace.save:
+        with open(namespace.save, 'w', encoding=ENCODING) as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+    if regressions:
+        print(f'Замедлились: {", ".join(regressions)}.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
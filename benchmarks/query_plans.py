@@ -0,0 +1,165 @@
+"""
+Проверка планов запросов базы сервера.
+
+Вызывает методы ServerStorage на синтетической базе, записывает
+выполненные ими запросы и выводит для каждого запроса EXPLAIN QUERY
+PLAN. Кэш пользователей перед каждым вызовом очищается, чтобы были видны
+и запросы, выполняемые при промахе кэша. Полный просмотр таблицы (SCAN)
+допустим только в методах, которые выводят таблицу целиком, в остальных
+он завершает скрипт с кодом 1.
+
+Запуск из корня проекта:
+    python benchmarks/query_plans.py [--users 1000]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+from sqlalchemy import event
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from server.database import ServerStorage
+from micro import grow_server_database
+
+# Методы, которые читают таблицы целиком, полный просмотр для них
+# ожидаем.
+FULL_SCANS = {'load_users', 'purge_offline_messages', 'users_list',
+              'active_users_list', 'login_history[all]', 'message_history'}
+
+
+def storage_calls(database: ServerStorage):
+    """
+    Функция возвращает проверяемые вызовы методов базы сервера.
+
+    :param database: база данных сервера,
+    :return: list: пары (название, функция без параметров).
+    """
+
+    message = {'action': 'message', 'from': 'user_2', 'to': 'user_1'}
+    return [
+        ('load_users', database.load_users),
+        ('find_user', lambda: database.find_user('user_1')),
+        ('history_id', lambda: database.history_id(
+            database.find_user('user_1'))),
+        ('add_user', lambda: database.add_user('plan_user', 'hash')),
+        ('user_login', lambda: database.user_login(
+            'user_1', '127.0.0.1', 7777, 'new key')),
+        ('get_hash', lambda: database.get_hash('user_1')),
+        ('get_pubkey', lambda: database.get_pubkey('user_1')),
+        ('check_user', lambda: database.check_user('user_1')),
+        ('get_user', lambda: database.get_user('user_1')),
+        ('add_contact', lambda: database.add_contact('user_1', 'user_3')),
+        ('get_contacts', lambda: database.get_contacts('user_1')),
+        ('remove_contact', lambda: database.remove_contact('user_1',
+                                                           'user_3')),
+        ('process_message', lambda: database.process_message('user_2',
+                                                             'user_1')),
+        ('flush_history', database.flush_history),
+        ('add_offline_message', lambda: database.add_offline_message(
+            'user_1', message)),
+        ('flush_offline_messages[insert]', database.flush_offline_messages),
+        ('get_offline_messages', lambda: database.get_offline_messages(
+            'user_1')),
+        ('flush_offline_messages[delete]', database.flush_offline_messages),
+        ('purge_offline_messages', database.purge_offline_messages),
+        ('users_list', database.users_list),
+        ('active_users_list', database.active_users_list),
+        ('login_history[user]', lambda: database.login_history('user_1')),
+        ('login_history[all]', database.login_history),
+        ('message_history', database.message_history),
+        ('user_logout', lambda: database.user_logout('user_1')),
+        ('remove_user', lambda: database.remove_user('plan_user')),
+    ]
+
+
+def record_statements(database: ServerStorage, func):
+    """
+    Функция вызывает метод и записывает выполненные им запросы.
+
+    :param database: база данных сервера,
+    :param func: функция без параметров,
+    :return: list: пары (запрос, параметры) без повторов.
+    """
+
+    statements = []
+
+    def before_execute(connection, cursor, statement, parameters, context,
+                       executemany):
+        if executemany:
+            parameters = parameters[0]
+        if (statement, parameters) not in statements:
+            statements.append((statement, parameters))
+
+    engines = (database.database_engine, database.reader_engine)
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_execute)
+    try:
+        func()
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', before_execute)
+    return statements
+
+
+def query_plan(database: ServerStorage, statement: str, parameters):
+    """
+    Функция возвращает план запроса.
+
+    :param database: база данных сервера,
+    :param statement: текст запроса,
+    :param parameters: его параметры,
+    :return: list: строки плана с отступами по вложенности.
+    """
+
+    connection = database.database_engine.raw_connection()
+    try:
+        rows = connection.cursor().execute(
+            f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+    finally:
+        connection.close()
+    depth = {0: 0}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, 0) + 1
+        lines.append('  ' * depth[node] + detail)
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', default=1000, type=int)
+    namespace = parser.parse_args()
+
+    logging.getLogger('server').setLevel(logging.WARNING)
+
+    scans = []
+    with tempfile.TemporaryDirectory(prefix='plans-') as directory:
+        database = ServerStorage(os.path.join(directory, 'server.db3'))
+        grow_server_database(database, namespace.users)
+        for name, func in storage_calls(database):
+            database.users.records.clear()
+            print(f'{name}:')
+            for statement, parameters in record_statements(database, func):
+                print(f'  {" ".join(statement.split())}')
+                for line in query_plan(database, statement, parameters):
+                    print(f'  {line}')
+                    if line.strip().startswith('SCAN ') and \
+                            line.strip() != 'SCAN CONSTANT ROW' and \
+                            name not in FULL_SCANS:
+                        scans.append(f'{name}: {line.strip()}')
+        database.session.close()
+        database.database_engine.dispose()
+        database.reader_engine.dispose()
+
+    if scans:
+        print('Полный просмотр таблиц:')
+        for scan in scans:
+            print(f'  {scan}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Бенчмарк обработки сообщения в зависимости от числа пользователей в сети.
+
+Проверка авторизации (login_required), проверка отправителя и поиск
+получателя выполняются по словарям сессий, поэтому время обработки
+одного сообщения не должно расти с числом подключённых клиентов.
+
+Запуск из корня проекта:
+    python benchmarks/sessions.py [--messages 20000] [--users 10 100 ...]
+"""
+import argparse
+import logging
+import os
+import selectors
+import socket
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from server.core import MessageProcessor, raise_open_files_limit
+
+
+class NullStorage:
+    """
+    Класс - заглушка базы данных, чтобы время запросов SQLite не
+    заслоняло время работы самого сервера.
+    """
+
+    def process_message(self, sender, recipient):
+        pass
+
+    def user_logout(self, user_id):
+        pass
+
+    def begin_group(self):
+        pass
+
+    def commit_group(self):
+        pass
+
+    def rollback_group(self):
+        pass
+
+    def group_failed(self):
+        return False
+
+
+def drain(sock: socket.socket):
+    """
+    Функция вычитывает всё, что сервер успел отправить в сокет.
+
+    :param sock: сокет клиента,
+    :return: ничего не возвращает.
+    """
+
+    try:
+        while sock.recv(RECV_BUFFER_LENGTH):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def measure(users: int, messages: int):
+    """
+    Функция измеряет среднее время обработки сообщения от одного
+    пользователя другому при заданном числе пользователей в сети.
+
+    :param users: число авторизованных клиентов,
+    :param messages: число отправляемых сообщений,
+    :return: float: время обработки одного сообщения в микросекундах.
+    """
+
+    processor = MessageProcessor('127.0.0.1', 7777, NullStorage())
+    processor.selector = selectors.DefaultSelector()
+
+    peers = []
+    for name in ('sender', 'recipient'):
+        server_side, client_side = socket.socketpair()
+        client_side.setblocking(False)
+        processor.add_client(server_side, ('127.0.0.1', 0))
+        processor.add_session(name, server_side)
+        peers.append(client_side)
+
+    # Остальные пользователи только занимают место в словарях сессий.
+    fillers = [socket.socket() for _ in range(users - 2)]
+    for number, filler in enumerate(fillers):
+        processor.add_session(f'user_{number}', filler)
+
+    message = {
+        ACTION: MESSAGE,
+        SENDER: 'sender',
+        DESTINATION: 'recipient',
+        TIME: time.time(),
+        MESSAGE_TEXT: 'Привет!'
+    }
+    started = time.perf_counter()
+    for number in range(messages):
+        processor.process_clients_message(message, processor.names['sender'])
+        if not number % 100:
+            for peer in peers:
+                drain(peer)
+    elapsed = time.perf_counter() - started
+
+    for client in list(processor.clients):
+        processor.remove_client(client)
+    for sock in fillers + peers:
+        sock.close()
+    processor.selector.close()
+    processor.workers.shutdown()
+    return elapsed / messages * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', default=20000, type=int)
+    parser.add_argument('--users', default=[10, 100, 1000, 10000], type=int,
+                        nargs='+')
+    namespace = parser.parse_args()
+
+    logging.getLogger('server').setLevel(logging.WARNING)
+    raise_open_files_limit()
+
+    results = []
+    for users in namespace.users:
+        cost = measure(users, namespace.messages)
+        results.append(cost)
+        print(f'{users:>8} пользователей: {cost:8.2f} мкс на сообщение')
+    print(f'Отношение наибольшего времени к наименьшему: '
+          f'{max(results) / min(results):.2f}')
+
+
+if __name__ == '__main__':
+    main()
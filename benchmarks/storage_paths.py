@@ -0,0 +1,156 @@
+"""
+Сравнение запросов ORM и Core в горячих методах базы сервера.
+
+Измеряет время одного вызова check_user, get_hash, get_pubkey,
+get_contacts, process_message, user_login и user_logout: методов
+ServerStorage, выполняющих подготовленные запросы Core, и их вариантов
+на запросах ORM (Query и объекты отображений), какими методы были
+раньше. Кэш пользователей уменьшается до одной записи, поэтому почти
+каждый вызов обращается к базе. Изменения фиксируются групповым
+коммитом после каждого замера, как в потоке базы данных сервера.
+
+Запуск из корня проекта:
+    python benchmarks/storage_paths.py [--users 10000]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from server.database import ServerStorage, UserDirectory
+from micro import grow_server_database, timed
+
+
+def orm_calls(database: ServerStorage):
+    """
+    Функция возвращает варианты методов на запросах ORM.
+
+    :param database: база данных сервера,
+    :return: dict: название метода - функция.
+    """
+
+    session = database.session
+
+    def user(name):
+        return session.query(database.AllUsers).filter_by(name=name).first()
+
+    def check_user(name):
+        return bool(session.query(database.AllUsers).filter_by(
+            name=name).count())
+
+    def get_hash(name):
+        return user(name).password_hash
+
+    def get_pubkey(name):
+        return user(name).pubkey
+
+    def get_contacts(name):
+        query = session.query(database.UsersContacts,
+                              database.AllUsers.name).filter_by(
+            user=user(name).id).join(
+            database.AllUsers,
+            database.UsersContacts.contact == database.AllUsers.id)
+        return [contact[1] for contact in query.all()]
+
+    def process_message(sender, recipient):
+        for name in (sender, recipient):
+            session.query(database.UsersHistory).filter_by(
+                user=user(name).id).first()
+
+    def user_login(name, ip_address, port, key):
+        row = user(name)
+        if row.pubkey != key:
+            row.pubkey = key
+        session.query(database.ActiveUsers).filter_by(user=row.id).delete()
+        session.add_all([database.ActiveUsers(row.id, ip_address, port),
+                         database.UsersLoginHistory(row.id, ip_address,
+                                                    port)])
+        database.commit()
+
+    def user_logout(name):
+        session.query(database.ActiveUsers).filter_by(
+            user=user(name).id).delete()
+        database.commit()
+
+    return {
+        'check_user': check_user,
+        'get_hash': get_hash,
+        'get_pubkey': get_pubkey,
+        'get_contacts': get_contacts,
+        'process_message': process_message,
+        'user_login': user_login,
+        'user_logout': user_logout,
+    }
+
+
+def core_calls(database: ServerStorage):
+    """
+    Функция возвращает методы ServerStorage.
+
+    :param database: база данных сервера,
+    :return: dict: название метода - функция.
+    """
+
+    return {name: getattr(database, name) for name in orm_calls(database)}
+
+
+def arguments(name: str, size: int):
+    """
+    Функция возвращает аргументы вызова метода для случайного
+    пользователя.
+
+    :param name: название метода,
+    :param size: количество пользователей в базе,
+    :return: tuple: аргументы.
+    """
+
+    user = f'user_{random.randint(1, size)}'
+    if name == 'process_message':
+        return user, f'user_{random.randint(1, size)}'
+    if name == 'user_login':
+        return user, '127.0.0.1', 7777, 'key'
+    return user,
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--users', default=10000, type=int)
+    parser.add_argument('--min-time', default=0.2, type=float)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=1, type=int)
+    namespace = parser.parse_args()
+
+    logging.getLogger('server').setLevel(logging.WARNING)
+    random.seed(namespace.seed)
+
+    with tempfile.TemporaryDirectory(prefix='paths-') as directory:
+        database = ServerStorage(os.path.join(directory, 'server.db3'),
+                                 stats_flush_threshold=10 ** 9)
+        grow_server_database(database, namespace.users)
+        database.users = UserDirectory(1)
+
+        print(f'{"метод":<18}{"ORM, мкс":>12}{"Core, мкс":>12}'
+              f'{"ускорение":>11}')
+        orm, core = orm_calls(database), core_calls(database)
+        for name in orm:
+            results = []
+            for func in (orm[name], core[name]):
+                database.begin_group()
+                results.append(timed(
+                    lambda: func(*arguments(name, namespace.users)),
+                    namespace.min_time, namespace.repeat))
+                database.commit_group()
+            print(f'{name:<18}{results[0]:>12.2f}{results[1]:>12.2f}'
+                  f'{results[0] / results[1]:>10.1f}x')
+
+        database.session.close()
+        database.database_engine.dispose()
+        database.reader_engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -115,6 +115,7 @@ class ClientDatabase:
         """
 
         self.session.query(self.Contacts).filter_by(name=contact).delete()
+        self.session.commit()
 
     def contacts_clear(self):
         """
@@ -125,10 +126,20 @@ class ClientDatabase:
 
         self.session.query(self.Contacts).delete()
 
-    def contact_active(self, contact: str):
+    def contact_active(self, contact: str, active: bool = True):
+        """
+        Метод отмечает, в сети ли контакт.
+
+        :param contact: имя контакта,
+        :param active: True если контакт в сети,
+        :return: ничего не возвращает.
+        """
+
         contact_item = self.session.query(self.Contacts).\
             filter_by(name=contact).first()
-        contact_item.active = True
+        if contact_item is None:
+            return
+        contact_item.active = active
         self.session.commit()
 
     def add_users(self, users_list: list):
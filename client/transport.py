@@ -1,8 +1,13 @@
 import binascii
+import errno
 import hashlib
 import hmac
+import itertools
+import select
 import socket
 import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 import threading
 from PyQt5.QtCore import pyqtSignal, QObject
@@ -20,6 +25,12 @@ class ClientTransport(threading.Thread, QObject):
     """
     Класс реализующий транспортную подсистему клиентского модуля.
     Отвечает за взаимодействие с сервером.
+
+    Каждый запрос получает идентификатор, который сервер возвращает в
+    ответе, и объект Future, который выполняет единственный читатель
+    сокета - поток транспорта. Поэтому несколько запросов могут
+    ожидать ответа одновременно, а сообщения, присланные сервером по
+    своей инициативе, не принимаются за ответы.
     """
 
     new_message = pyqtSignal(dict)
@@ -38,11 +49,18 @@ class ClientTransport(threading.Thread, QObject):
         self.password = password
         self.transport = None
         self.keys = keys
+        # Сообщения сервера, принятые в ожидании ответа на запрос.
+        self.pending_messages = deque()
+        # Ожидающие ответа запросы: идентификатор и Future ответа.
+        self.requests = dict()
+        self.request_ids = itertools.count(1)
+        self.requests_lock = threading.Lock()
         self.connection_init(ip_address, port)
 
+        # Список контактов и их состояние сервер присылает событиями
+        # подписки сразу после авторизации.
         try:
             self.user_list_update()
-            self.contacts_list_update()
         except OSError as err:
             if err.errno:
                 LOGGER.critical('Потеряно соединение с сервером!')
@@ -108,7 +126,11 @@ class ClientTransport(threading.Thread, QObject):
                 USER: {
                     ACCOUNT_NAME: self.username,
                     PUBLIC_KEY: pubkey
-                }
+                },
+                FRAMING: FRAMING_LENGTH,
+                CODEC: CODEC_BINARY,
+                COMPRESSION: COMPRESSION_ZLIB,
+                SUBSCRIBE: SUBSCRIBE_CONTACTS
             }
         LOGGER.debug(f'Приветственное сообщение - {presence}.')
 
@@ -128,7 +150,7 @@ class ClientTransport(threading.Thread, QObject):
                     my_answer[DATA] = binascii.b2a_base64(digest).decode(
                         'ascii')
                     send_message(self.transport, my_answer)
-                    self.process_server_answer(get_message(self.transport))
+                    self.process_server_answer(self.receive_answer())
         except (OSError, json.JSONDecodeError) as err:
             LOGGER.debug('Потеряно соединение', exc_info=err)
             raise ServerError('Сбой соединения в процессе авторизации.')
@@ -170,45 +192,166 @@ class ClientTransport(threading.Thread, QObject):
                 f'Получено сообщение от пользователя '
                 f'{message[SENDER]}:{message[MESSAGE_TEXT]}.')
             self.new_message.emit(message)
-            self.contacts_list_update()
 
-    def contacts_list_update(self):
-        """Метод обновляющий контакт-лист пользователя с сервера."""
+        elif ACTION in message and message[ACTION] == PING:
+            LOGGER.debug('Получен ping от сервера.')
+            with socket_lock:
+                send_message(self.transport, {ACTION: PONG,
+                                              TIME: time.time()})
 
-        LOGGER.debug(f'Запрос контакт-листа для пользователя {self.name}.')
-        request_contacts = {
-            ACTION: GET_CONTACTS,
-            TIME: time.time(),
-            USER: self.username
-        }
-        LOGGER.debug(f'Сформирован запрос - {request_contacts}.')
-        with socket_lock:
-            send_message(self.transport, request_contacts)
-            answer_contacts = get_message(self.transport)
-        LOGGER.debug(f'Получен ответ - {answer_contacts}.')
+        elif ACTION in message and message[ACTION] == CONTACT_EVENT and \
+                ACCOUNT_NAME in message and EVENT in message:
+            self.apply_contact_event(message)
 
-        request_active_users = {
-            ACTION: ACTIVE_USERS,
-            TIME: time.time()
-        }
-        LOGGER.debug(f'Сформирован запрос - {request_active_users}.')
-        with socket_lock:
-            send_message(self.transport, request_active_users)
-            answer_active_users = get_message(self.transport)
-        LOGGER.debug(f'Получен ответ - {answer_active_users}.')
-
-        if RESPONSE in answer_contacts and answer_contacts[
-            RESPONSE] == 202 and RESPONSE in answer_active_users \
-                and answer_active_users[RESPONSE] == 202:
-            for contact in answer_contacts[LIST_INFO]:
-                if contact in answer_active_users[LIST_INFO]:
-                    self.database.add_contact(contact, True)
-                else:
-                    self.database.add_contact(contact)
+    def apply_contact_event(self, message: dict):
+        """
+        Метод применяет к списку контактов событие, присланное сервером:
+        контакт вошёл, вышел, добавлен или удалён.
+
+        :param message: событие контакта,
+        :return: ничего не возвращает.
+        """
+
+        LOGGER.debug(f'Событие контакта - {message}.')
+        contact, event = message[ACCOUNT_NAME], message[EVENT]
+        if event == EVENT_ADDED:
+            self.database.add_contact(contact)
+            self.database.contact_active(contact,
+                                         bool(message.get(ACTIVE)))
+        elif event == EVENT_REMOVED:
+            self.database.del_contact(contact)
+        elif event in (EVENT_ONLINE, EVENT_OFFLINE):
+            self.database.contact_active(contact, event == EVENT_ONLINE)
         else:
-            LOGGER.error('Не удалось обновить список контактов.')
+            LOGGER.debug(f'Неизвестное событие контакта - {event}.')
+            return
         self.signal_update_cont_list.emit()
 
+    def receive_answer(self):
+        """
+        Метод принимает ответ сервера при авторизации.
+
+        Сообщения пользователей, пришедшие раньше ответа (например,
+        сохранённые сервером до подключения), откладываются и
+        обрабатываются основным циклом.
+
+        :return: dict: ответ сервера.
+        """
+
+        message = get_message(self.transport)
+        while RESPONSE not in message:
+            self.pending_messages.append(message)
+            message = get_message(self.transport)
+        return message
+
+    def request(self, message: dict):
+        """
+        Метод отправляет запрос серверу, не дожидаясь ответа.
+
+        :param message: словарь - запрос,
+        :return: Future: ответ сервера.
+        """
+
+        future = Future()
+        with self.requests_lock:
+            request_id = next(self.request_ids)
+            self.requests[request_id] = future
+        message[REQUEST_ID] = request_id
+        try:
+            with socket_lock:
+                send_message(self.transport, message)
+        except OSError:
+            with self.requests_lock:
+                self.requests.pop(request_id, None)
+            raise
+        return future
+
+    def wait_answer(self, future: Future):
+        """
+        Метод ожидает ответ сервера на запрос.
+
+        Если поток транспорта уже читает сокет, то ответ ожидается от
+        него. Иначе (до запуска потока или в самом потоке) сокет
+        читается здесь же, а сообщения, не являющиеся ответами,
+        откладываются для основного цикла.
+
+        Если ответ не пришёл за REQUEST_TIMEOUT, генерирует TimeoutError.
+
+        :param future: Future ответа,
+        :return: dict: ответ сервера.
+        """
+
+        if self.is_alive() and threading.current_thread() is not self:
+            try:
+                return future.result(REQUEST_TIMEOUT)
+            except FutureTimeoutError:
+                raise TimeoutError('Сервер не ответил на запрос.')
+
+        deadline = time.monotonic() + REQUEST_TIMEOUT
+        while not future.done():
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise TimeoutError('Сервер не ответил на запрос.')
+            message = self.read_server_message(timeout)
+            if message is not None:
+                self.dispatch(message, defer=True)
+        return future.result()
+
+    def read_server_message(self, timeout: float):
+        """
+        Метод ожидает сообщение сервера не дольше timeout секунд.
+
+        :param timeout: время ожидания,
+        :return: dict: сообщение или None, если сообщения нет.
+        """
+
+        message = get_buffer(self.transport).next_message()
+        if message is None:
+            ready, _, _ = select.select([self.transport], [], [], timeout)
+            if not ready:
+                return None
+            message = get_message(self.transport)
+        return message
+
+    def dispatch(self, message: dict, defer: bool = False):
+        """
+        Метод передаёт ответ ожидающему его запросу, а остальные
+        сообщения - обработчику.
+
+        :param message: сообщение сервера,
+        :param defer: отложить обработку сообщения до основного цикла,
+        :return: ничего не возвращает.
+        """
+
+        # Идентификатор запроса сервер добавляет только в ответы.
+        request_id = message.get(REQUEST_ID)
+        if request_id is not None:
+            with self.requests_lock:
+                future = self.requests.pop(request_id, None)
+            if future is not None:
+                future.set_result(message)
+            else:
+                LOGGER.debug(f'Получен ответ на неизвестный запрос - '
+                             f'{message}.')
+            return
+        if defer:
+            self.pending_messages.append(message)
+        else:
+            self.process_server_answer(message)
+
+    def fail_requests(self, error: Exception):
+        """
+        Метод завершает все ожидающие запросы ошибкой.
+
+        :param error: исключение для ожидающих,
+        :return: ничего не возвращает.
+        """
+
+        with self.requests_lock:
+            requests, self.requests = self.requests, dict()
+        for future in requests.values():
+            future.set_exception(error)
+
     def user_list_update(self):
         """
         Метод запрашивает список известных пользователей с сервера
@@ -222,9 +365,7 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            send_message(self.transport, request)
-            answer = get_message(self.transport)
+        answer = self.wait_answer(self.request(request))
         if RESPONSE in answer and answer[RESPONSE] == 202:
             self.database.add_users(answer[LIST_INFO])
         else:
@@ -244,9 +385,7 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with socket_lock:
-            send_message(self.transport, request)
-            answer = get_message(self.transport)
+        answer = self.wait_answer(self.request(request))
         if RESPONSE in answer and answer[RESPONSE] == 511:
             return answer[DATA]
         else:
@@ -267,10 +406,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, request)
-            self.process_server_answer(get_message(self.transport))
-        self.contacts_list_update()
+        self.process_server_answer(self.wait_answer(self.request(request)))
 
     def remove_contact(self, contact: str):
         """
@@ -287,10 +423,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, request)
-            self.process_server_answer(get_message(self.transport))
-        self.contacts_list_update()
+        self.process_server_answer(self.wait_answer(self.request(request)))
 
     def transport_shutdown(self):
         """Метод уведомляющий сервер о завершении работы клиента."""
@@ -327,10 +460,9 @@ class ClientTransport(threading.Thread, QObject):
         }
         LOGGER.debug(f'Сформирован словарь сообщения - {message_dict}.')
 
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_answer(get_message(self.transport))
-            LOGGER.info(f'Отправлено сообщение для пользователя - {to}.')
+        self.process_server_answer(
+            self.wait_answer(self.request(message_dict)))
+        LOGGER.info(f'Отправлено сообщение для пользователя - {to}.')
 
     def run(self):
         """
@@ -343,25 +475,25 @@ class ClientTransport(threading.Thread, QObject):
 
         LOGGER.debug('Запущен процесс-приёмник сообщений сервера.')
         while self.running:
-            time.sleep(1)
+            while self.pending_messages:
+                self.process_server_answer(self.pending_messages.popleft())
             message = None
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        LOGGER.critical(f'Потеряно соединение с сервером!')
-                        self.running = False
-                        self.connection_lost.emit()
-                except (ConnectionError, ConnectionAbortedError,
-                        ConnectionResetError, json.JSONDecodeError, TypeError):
-                    LOGGER.debug(f'Потеряно соединение с сервером!')
+            try:
+                message = self.read_server_message(0.5)
+            except OSError as err:
+                if err.errno:
+                    LOGGER.critical(f'Потеряно соединение с сервером!')
                     self.running = False
                     self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
+            except (json.JSONDecodeError, TypeError):
+                LOGGER.debug(f'Потеряно соединение с сервером!')
+                self.running = False
+                self.connection_lost.emit()
 
             if message:
                 LOGGER.debug(f'Принято сообщение от сервера: {message}.')
-                self.process_server_answer(message)
+                self.dispatch(message)
+
+        # Запросы, ожидающие ответа, больше не получат его.
+        self.fail_requests(ConnectionResetError(
+            errno.ECONNRESET, 'Потеряно соединение с сервером!'))
@@ -0,0 +1,366 @@
+"""Компактный двоичный формат сообщений JIM"""
+import base64
+import binascii
+import struct
+
+from common.variables import *
+from common.errors import ProtocolError
+
+# Первый байт данных - раскладка сообщения. Общая раскладка хранит
+# количество полей и поля с типами значений. Для самых частых сообщений -
+# текстового сообщения пользователя и ответа без данных - используются
+# фиксированные заголовки struct.
+# Варианты с идентификатором запроса хранят его сразу после заголовка.
+LAYOUT_GENERIC = 1
+LAYOUT_MESSAGE = 2
+LAYOUT_RESPONSE = 3
+LAYOUT_MESSAGE_REQUEST = 4
+LAYOUT_RESPONSE_REQUEST = 5
+
+# Заголовок текстового сообщения: раскладка, время, тип текста, длины
+# имени отправителя, имени получателя и текста.
+MESSAGE_HEADER = struct.Struct('!BdBHHI')
+MESSAGE_KEYS = frozenset((ACTION, TIME, SENDER, DESTINATION, MESSAGE_TEXT))
+MESSAGE_REQUEST_KEYS = MESSAGE_KEYS | {REQUEST_ID}
+# Заголовок ответа без данных: раскладка и код ответа.
+RESPONSE_HEADER = struct.Struct('!BH')
+RESPONSE_REQUEST_KEYS = frozenset((RESPONSE, REQUEST_ID))
+# Идентификатор запроса.
+REQUEST_ID_FIELD = struct.Struct('!I')
+
+# Типы значений.
+T_NONE = 0
+T_TRUE = 1
+T_FALSE = 2
+T_INT = 3
+T_FLOAT = 4
+T_STR = 5
+T_BASE64 = 6
+T_LIST = 7
+T_DICT = 8
+T_CODE = 9
+T_STRINGS = 10
+
+BYTE = struct.Struct('!B')
+COUNT = struct.Struct('!H')
+INT = struct.Struct('!q')
+FLOAT = struct.Struct('!d')
+LENGTH = struct.Struct('!I')
+# Границы значений, которые помещаются в поля INT и COUNT.
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+COUNT_MAX = 0xFFFF
+
+# Коды ключей и часто передаваемых строковых значений протокола.
+# Номера только добавляются в конец: изменение номеров ломает
+# совместимость клиентов и сервера.
+KEYS = (ACTION, TIME, USER, ACCOUNT_NAME, SENDER, DESTINATION, DATA,
+        PUBLIC_KEY, FRAMING, RESPONSE, ERROR, MESSAGE_TEXT, LIST_INFO, CODEC,
+        COMPRESSION, REQUEST_ID, SUBSCRIBE, EVENT, ACTIVE)
+VALUES = (PRESENCE, MESSAGE, EXIT, GET_CONTACTS, REMOVE_CONTACT,
+          ADD_CONTACT, USERS_REQUEST, ACTIVE_USERS, PUBLIC_KEY_REQUEST,
+          FRAMING_LENGTH, CODEC_BINARY, COMPRESSION_ZLIB, SUBSCRIBE_CONTACTS,
+          CONTACT_EVENT, EVENT_ONLINE, EVENT_OFFLINE, EVENT_ADDED,
+          EVENT_REMOVED, PING, PONG)
+
+KEY_CODES = {key: code for code, key in enumerate(KEYS, 1)}
+VALUE_CODES = {value: code for code, value in enumerate(VALUES)}
+
+# Поля, значения которых обычно передаются в base64 (шифротекст). В
+# двоичном формате они передаются исходными байтами.
+BASE64_KEYS = frozenset((MESSAGE_TEXT, DATA))
+
+
+def _pack_str(value: str, out: bytearray):
+    """Функция дописывает строку с длиной в буфер."""
+
+    data = value.encode(ENCODING)
+    out += LENGTH.pack(len(data))
+    out += data
+
+
+def _pack_value(value, out: bytearray, key=None):
+    """Функция дописывает значение с байтом типа в буфер."""
+
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif isinstance(value, int):
+        if not INT_MIN <= value <= INT_MAX:
+            raise TypeError(f'Целое {value} не помещается в int64.')
+        out.append(T_INT)
+        out += INT.pack(value)
+    elif isinstance(value, float):
+        out.append(T_FLOAT)
+        out += FLOAT.pack(value)
+    elif isinstance(value, str):
+        code = VALUE_CODES.get(value)
+        if code is not None:
+            out.append(T_CODE)
+            out.append(code)
+            return
+        if key in BASE64_KEYS:
+            raw = _from_base64(value)
+            if raw is not None:
+                out.append(T_BASE64)
+                out += LENGTH.pack(len(raw))
+                out += raw
+                return
+        out.append(T_STR)
+        _pack_str(value, out)
+    elif isinstance(value, (list, tuple)):
+        # Списки строк (имена пользователей) передаются одной строкой с
+        # разделителем \0, если он не встречается в самих строках.
+        if value and all(type(item) is str for item in value):
+            joined = '\0'.join(value)
+            if joined.count('\0') == len(value) - 1:
+                out.append(T_STRINGS)
+                _pack_str(joined, out)
+                return
+        out.append(T_LIST)
+        out += LENGTH.pack(len(value))
+        for item in value:
+            _pack_value(item, out)
+    elif isinstance(value, dict):
+        out.append(T_DICT)
+        _pack_fields(value, out)
+    else:
+        raise TypeError(f'Тип {type(value)} не поддерживается.')
+
+
+def _pack_fields(message: dict, out: bytearray):
+    """Функция дописывает поля словаря в буфер."""
+
+    if len(message) > COUNT_MAX:
+        raise TypeError(f'Словарь из {len(message)} полей слишком велик.')
+    out += COUNT.pack(len(message))
+    for key, value in message.items():
+        code = KEY_CODES.get(key)
+        if code is None:
+            out.append(0)
+            _pack_str(key, out)
+        else:
+            out.append(code)
+        _pack_value(value, out, key)
+
+
+def _from_base64(value: str):
+    """
+    Функция возвращает байты строки base64, если строка восстановится
+    из них без изменений, иначе None.
+    """
+
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    if base64.b64encode(raw).decode('ascii') != value:
+        return None
+    return raw
+
+
+def encode_binary(message: dict):
+    """
+    Функция кодирования словаря - сообщения в двоичный формат.
+
+    Ключи и известные значения протокола заменяются кодами, числа
+    упаковываются struct, шифротекст передаётся без base64. Сообщение,
+    которое формат не представляет (целые вне int64, словари больше
+    COUNT_MAX полей), вызывает TypeError.
+
+    :param message: словарь, с сообщением,
+    :return: bytes: закодированное сообщение.
+    """
+
+    keys = message.keys()
+    request_id = message.get(REQUEST_ID)
+    if request_id is not None and not (
+            type(request_id) is int and 0 <= request_id <= 0xFFFFFFFF):
+        request_id = None
+    if type(message.get(RESPONSE)) is int and \
+            0 <= message[RESPONSE] <= 0xFFFF:
+        if len(message) == 1:
+            return RESPONSE_HEADER.pack(LAYOUT_RESPONSE, message[RESPONSE])
+        if keys == RESPONSE_REQUEST_KEYS and request_id is not None:
+            return RESPONSE_HEADER.pack(
+                LAYOUT_RESPONSE_REQUEST, message[RESPONSE]) + \
+                REQUEST_ID_FIELD.pack(request_id)
+    # Длины имён в заголовке - два байта, символ UTF-8 - до четырёх.
+    if (keys == MESSAGE_KEYS or keys == MESSAGE_REQUEST_KEYS and
+            request_id is not None) and message[ACTION] == MESSAGE and \
+            type(message[TIME]) is float and \
+            type(message[SENDER]) is str and \
+            type(message[DESTINATION]) is str and \
+            type(message[MESSAGE_TEXT]) is str and \
+            len(message[SENDER]) <= COUNT_MAX // 4 and \
+            len(message[DESTINATION]) <= COUNT_MAX // 4:
+        return _encode_message(message, request_id)
+
+    out = bytearray(BYTE.pack(LAYOUT_GENERIC))
+    _pack_fields(message, out)
+    return bytes(out)
+
+
+def _encode_message(message: dict, request_id=None):
+    """
+    Функция кодирования текстового сообщения с фиксированным заголовком.
+    """
+
+    sender = message[SENDER].encode(ENCODING)
+    destination = message[DESTINATION].encode(ENCODING)
+    text = _from_base64(message[MESSAGE_TEXT])
+    kind = T_BASE64
+    if text is None:
+        text = message[MESSAGE_TEXT].encode(ENCODING)
+        kind = T_STR
+    layout = LAYOUT_MESSAGE if request_id is None else LAYOUT_MESSAGE_REQUEST
+    header = MESSAGE_HEADER.pack(layout, message[TIME], kind, len(sender),
+                                 len(destination), len(text))
+    if request_id is not None:
+        header += REQUEST_ID_FIELD.pack(request_id)
+    return b''.join((header, sender, destination, text))
+
+
+def _decode_message(data):
+    """
+    Функция декодирования текстового сообщения с фиксированным заголовком.
+    """
+
+    if len(data) < MESSAGE_HEADER.size:
+        raise ProtocolError('Двоичное сообщение обрезано.')
+    layout, sent_time, kind, sender_length, destination_length, \
+        text_length = MESSAGE_HEADER.unpack_from(data)
+    start = MESSAGE_HEADER.size
+    request_id = None
+    if layout == LAYOUT_MESSAGE_REQUEST:
+        if len(data) < start + REQUEST_ID_FIELD.size:
+            raise ProtocolError('Двоичное сообщение обрезано.')
+        request_id = REQUEST_ID_FIELD.unpack_from(data, start)[0]
+        start += REQUEST_ID_FIELD.size
+    end = start + sender_length + destination_length + text_length
+    if end != len(data):
+        raise ProtocolError('Неверная длина двоичного сообщения.')
+    data = bytes(data)
+    sender = data[start:start + sender_length]
+    start += sender_length
+    destination = data[start:start + destination_length]
+    text = data[start + destination_length:end]
+    if kind == T_BASE64:
+        text = base64.b64encode(text).decode('ascii')
+    elif kind == T_STR:
+        text = text.decode(ENCODING)
+    else:
+        raise ProtocolError(f'Неизвестный тип текста {kind}.')
+    message = {
+        ACTION: MESSAGE,
+        TIME: sent_time,
+        SENDER: sender.decode(ENCODING),
+        DESTINATION: destination.decode(ENCODING),
+        MESSAGE_TEXT: text
+    }
+    if request_id is not None:
+        message[REQUEST_ID] = request_id
+    return message
+
+
+class _Reader:
+    """Класс - последовательное чтение двоичного сообщения."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def take(self, size: int):
+        end = self.pos + size
+        if end > len(self.data):
+            raise ProtocolError('Двоичное сообщение обрезано.')
+        chunk = self.data[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def unpack(self, fmt: struct.Struct):
+        return fmt.unpack(self.take(fmt.size))[0]
+
+    def read_str(self):
+        return str(self.take(self.unpack(LENGTH)), ENCODING)
+
+    def read_value(self):
+        kind = self.unpack(BYTE)
+        if kind == T_NONE:
+            return None
+        elif kind == T_TRUE:
+            return True
+        elif kind == T_FALSE:
+            return False
+        elif kind == T_INT:
+            return self.unpack(INT)
+        elif kind == T_FLOAT:
+            return self.unpack(FLOAT)
+        elif kind == T_STR:
+            return self.read_str()
+        elif kind == T_BASE64:
+            raw = self.take(self.unpack(LENGTH))
+            return base64.b64encode(raw).decode('ascii')
+        elif kind == T_LIST:
+            return [self.read_value() for _ in range(self.unpack(LENGTH))]
+        elif kind == T_DICT:
+            return self.read_fields()
+        elif kind == T_STRINGS:
+            return self.read_str().split('\0')
+        elif kind == T_CODE:
+            code = self.unpack(BYTE)
+            if code >= len(VALUES):
+                raise ProtocolError(f'Неизвестный код значения {code}.')
+            return VALUES[code]
+        raise ProtocolError(f'Неизвестный тип значения {kind}.')
+
+    def read_fields(self):
+        message = dict()
+        for _ in range(self.unpack(COUNT)):
+            code = self.unpack(BYTE)
+            if code == 0:
+                key = self.read_str()
+            elif code <= len(KEYS):
+                key = KEYS[code - 1]
+            else:
+                raise ProtocolError(f'Неизвестный код ключа {code}.')
+            message[key] = self.read_value()
+        return message
+
+
+def decode_binary(data):
+    """
+    Функция декодирования сообщения из двоичного формата.
+
+    :param data: принятые байты,
+    :return: dict: декодированное сообщение.
+    """
+
+    reader = _Reader(data)
+    layout = reader.unpack(BYTE)
+    try:
+        if layout == LAYOUT_RESPONSE:
+            if len(data) != RESPONSE_HEADER.size:
+                raise ProtocolError('Неверная длина двоичного сообщения.')
+            return {RESPONSE: RESPONSE_HEADER.unpack(data)[1]}
+        elif layout == LAYOUT_RESPONSE_REQUEST:
+            if len(data) != RESPONSE_HEADER.size + REQUEST_ID_FIELD.size:
+                raise ProtocolError('Неверная длина двоичного сообщения.')
+            return {
+                RESPONSE: RESPONSE_HEADER.unpack_from(data)[1],
+                REQUEST_ID: REQUEST_ID_FIELD.unpack_from(
+                    data, RESPONSE_HEADER.size)[0]
+            }
+        elif layout in (LAYOUT_MESSAGE, LAYOUT_MESSAGE_REQUEST):
+            return _decode_message(data)
+        elif layout != LAYOUT_GENERIC:
+            raise ProtocolError(f'Неизвестная раскладка сообщения {layout}.')
+        message = reader.read_fields()
+    except UnicodeDecodeError:
+        raise ProtocolError('Строка в неверной кодировке.')
+    if reader.pos != len(reader.data):
+        raise ProtocolError('Лишние данные в двоичном сообщении.')
+    return message
@@ -1,11 +1,11 @@
 import inspect
 import logging
 import re
-import socket
 import sys
 
 import logs.server_log_config
 import logs.client_log_config
+from common.variables import ACTION, PRESENCE
 
 sys.path.append('../')
 
@@ -38,30 +38,18 @@ def log(func_to_log):
 def login_required(func):
     """
     Декоратор, проверяющий, что клиент авторизован на сервере.
-    Проверяет, что передаваемый объект сокета находится в списке
+    Применяется к методам сервера вида method(self, message, client).
+    Проверяет, что сокет клиента находится в словаре сессий sessions
     авторизованных клиентов. За исключением передачи словаря-запроса на
     авторизацию. Если клиент не авторизован, генерирует исключение TypeError.
     """
 
-    def checker(*args, **kwargs):
-        # Им портить необходимо тут, иначе ошибка рекурсивного импорта.
-        from server.core import MessageProcessor
-        from common.variables import ACTION, PRESENCE
-        if isinstance(args[0], MessageProcessor):
-            found = False
-            for arg in args:
-                if isinstance(arg, socket.socket):
-                    for client in args[0].names:
-                        if args[0].names[client] == arg:
-                            found = True
-
-            for arg in args:
-                if isinstance(arg, dict):
-                    if ACTION in arg and arg[ACTION] == PRESENCE:
-                        found = True
-
-            if not found:
-                raise TypeError
-        return func(*args, **kwargs)
+    def checker(self, message, client, *args, **kwargs):
+        sessions = getattr(self, 'sessions', None)
+        if sessions is not None and client not in sessions and not (
+                isinstance(message, dict) and
+                message.get(ACTION) == PRESENCE):
+            raise TypeError
+        return func(self, message, client, *args, **kwargs)
 
     return checker
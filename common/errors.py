@@ -1,4 +1,5 @@
 """Ошибки"""
+import errno
 
 
 class ServerError(Exception):
@@ -19,3 +20,29 @@ class UserNotAvailable(Exception):
 
     def __str__(self):
         return self.text
+
+
+class ShardEventTooLarge(Exception):
+    """Исключение - событие не помещается в датаграмму шарда."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+class ProtocolError(ConnectionError):
+    """
+    Исключение - нарушен формат передачи данных.
+
+    Наследуется от ConnectionError, так как после ошибки разбора потока
+    соединение продолжить невозможно.
+    """
+
+    def __init__(self, text):
+        super().__init__(errno.ECONNABORTED, text)
+        self.text = text
+
+    def __str__(self):
+        return self.text
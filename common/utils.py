@@ -1,25 +1,48 @@
 """Утилиты"""
+import errno
 import json
+import struct
 import sys
+import time
+import weakref
+import zlib
 
 from common.variables import *
+from common.errors import ProtocolError
+from common.codec import encode_binary, decode_binary
 
 sys.path.append('../')
 
+# Заголовок кадра: байт маркера и флагов, длина данных кадра.
+FRAME_HEADER = struct.Struct('!BI')
 
-def get_message(client):
+# Буферы приёма сокетов, удаляются вместе с сокетом.
+_buffers = weakref.WeakKeyDictionary()
+
+
+def encode_message(message):
     """
-    Утилита приёма и декодирования сообщения.
+    Утилита кодирования словаря - сообщения в байты.
 
-    Принимает байты, выдает словарь если принято,
-    что-то другое отдаёт ошибку значения.
+    :param message: словарь, с сообщением,
+    :return: bytes: закодированное сообщение.
+    """
 
-    :param client: сокет для передачи данных,
-    :return: возвращает сообщения от сервера.
+    js_message = json.dumps(message)
+    return js_message.encode(ENCODING)
+
+
+def decode_message(encoded_message):
     """
+    Утилита декодирования байтов в словарь - сообщение.
+
+    Если получен не словарь, то генерирует исключение TypeError.
 
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    json_response = encoded_response.decode(ENCODING)
+    :param encoded_message: принятые байты,
+    :return: dict: декодированное сообщение.
+    """
+
+    json_response = encoded_message.decode(ENCODING)
     response = json.loads(json_response)
     if isinstance(response, dict):
         return response
@@ -27,6 +50,304 @@ def get_message(client):
         raise TypeError
 
 
+def pack_frame(payload, flags=0):
+    """
+    Утилита упаковки данных в кадр с заголовком длины.
+
+    :param payload: байты сообщения,
+    :param flags: флаги кадра,
+    :return: bytes: кадр для отправки.
+    """
+
+    return FRAME_HEADER.pack(FRAME_MARKER | flags, len(payload)) + payload
+
+
+class Compressor:
+    """
+    Класс - параметры сжатия кадров и счётчики степени сжатия и
+    затраченного процессорного времени.
+
+    Один объект используется всеми соединениями, согласовавшими сжатие.
+    """
+
+    def __init__(self, threshold: int = COMPRESSION_THRESHOLD,
+                 level: int = COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self.level = level
+        # Сжатые кадры, кадры, сжатие которых не уменьшило размер,
+        # размер данных до и после сжатия и время сжатия.
+        self.frames = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_time = 0.0
+
+    def __repr__(self):
+        return f'Сжато кадров - {self.frames}, без выигрыша - ' \
+               f'{self.skipped}, степень сжатия - {self.ratio:.2f}, ' \
+               f'время - {self.cpu_time:.6f} с.'
+
+    @property
+    def ratio(self):
+        """Отношение размера данных до сжатия к размеру после."""
+
+        if not self.compressed_bytes:
+            return 1.0
+        return self.raw_bytes / self.compressed_bytes
+
+    def compress(self, payload: bytes):
+        """
+        Метод сжимает данные кадра, если они не меньше порога и сжатие
+        уменьшает их размер.
+
+        :param payload: данные кадра,
+        :return: tuple: данные и флаги кадра.
+        """
+
+        if len(payload) < self.threshold:
+            return payload, 0
+        started = time.process_time()
+        compressed = zlib.compress(payload, self.level)
+        self.cpu_time += time.process_time() - started
+        if len(compressed) >= len(payload):
+            self.skipped += 1
+            return payload, 0
+        self.frames += 1
+        self.raw_bytes += len(payload)
+        self.compressed_bytes += len(compressed)
+        return compressed, FRAME_COMPRESSED
+
+
+def decompress(payload: bytes):
+    """
+    Утилита распаковки сжатых данных кадра. Размер распакованных данных
+    ограничен MAX_FRAME_LENGTH.
+
+    :param payload: сжатые данные,
+    :return: bytes: распакованные данные.
+    """
+
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, MAX_FRAME_LENGTH)
+    except zlib.error:
+        raise ProtocolError('Получен повреждённый сжатый кадр.')
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ProtocolError('Сжатый кадр превышает допустимый размер.')
+    return data
+
+
+class MessageBuffer:
+    """
+    Класс - буфер приёма и параметры передачи сообщений одного сокета.
+
+    Накапливает принятые байты и выделяет из них целые сообщения, поэтому
+    склеенные и разбитые на части сообщения разбираются корректно.
+    Понимает кадры с заголовком длины и старый формат - JSON без
+    заголовка, который используется до согласования кадров в presence.
+    Данные кадра могут быть в JSON или в двоичном формате (флаг
+    FRAME_BINARY) и могут быть сжаты zlib (флаг FRAME_COMPRESSED).
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offset = 0
+        # Отправлять ли сообщения кадрами. Включается при согласовании
+        # или автоматически, как только собеседник прислал кадр.
+        self.framed = False
+        # Формат данных кадров. Двоичный формат включается при
+        # согласовании или автоматически, как только собеседник прислал
+        # двоичный кадр.
+        self.codec = CODEC_JSON
+        # Параметры сжатия отправляемых кадров, если собеседник
+        # согласовал сжатие. Сжатые кадры принимаются всегда.
+        self.compressor = None
+        self.decoder = json.JSONDecoder()
+        # Всего принято байт.
+        self.received = 0
+
+    def feed(self, data: bytes):
+        """
+        Метод добавляет принятые байты в буфер.
+
+        :param data: принятые байты,
+        :return: ничего не возвращает.
+        """
+
+        if self.offset:
+            del self.data[:self.offset]
+            self.offset = 0
+        self.data += data
+        self.received += len(data)
+
+    def next_message(self):
+        """
+        Метод выделяет из буфера следующее целое сообщение.
+
+        :return: dict: сообщение или None, если данных пока недостаточно.
+        """
+
+        if self.offset >= len(self.data):
+            return None
+        if self.data[self.offset] == ord('{'):
+            return self._next_legacy()
+
+        if len(self.data) - self.offset < FRAME_HEADER.size:
+            return None
+        flags, length = FRAME_HEADER.unpack_from(self.data, self.offset)
+        if not flags & FRAME_MARKER or flags & ~FRAME_FLAGS or \
+                length > MAX_FRAME_LENGTH:
+            raise ProtocolError('Получен некорректный заголовок кадра.')
+        start = self.offset + FRAME_HEADER.size
+        end = start + length
+        if len(self.data) < end:
+            return None
+        self.offset = end
+        self.framed = True
+        payload = bytes(self.data[start:end])
+        if flags & FRAME_COMPRESSED:
+            payload = decompress(payload)
+        if flags & FRAME_BINARY:
+            self.codec = CODEC_BINARY
+            return decode_binary(payload)
+        try:
+            return decode_message(payload)
+        except UnicodeDecodeError:
+            raise ProtocolError('Получен кадр в неверной кодировке.')
+
+    def _next_legacy(self):
+        """
+        Метод выделяет сообщение старого формата - JSON без заголовка.
+
+        Декодируется только окно буфера, которое удваивается, пока в нём
+        не поместится сообщение, поэтому серия сообщений разбирается за
+        линейное время. Байты, которые не декодируются (символ, разрезанный
+        между чтениями, или следующий кадр), заменяются суррогатами и не
+        мешают разобрать сообщение перед ними.
+
+        :return: dict: сообщение или None, если данных пока недостаточно.
+        """
+
+        available = len(self.data) - self.offset
+        size = MAX_PACKAGE_LENGTH
+        while True:
+            text = self.data[self.offset:self.offset + size].decode(
+                ENCODING, 'surrogateescape')
+            try:
+                message, end = self.decoder.raw_decode(text)
+                break
+            except json.JSONDecodeError:
+                if size < available:
+                    size *= 2
+                    continue
+                if available >= MAX_PACKAGE_LENGTH:
+                    raise ProtocolError('Получено некорректное сообщение.')
+                return None
+        try:
+            self.offset += len(text[:end].encode(ENCODING))
+        except UnicodeEncodeError:
+            raise ProtocolError('Получено сообщение в неверной кодировке.')
+        if not isinstance(message, dict):
+            raise TypeError
+        return message
+
+    def pack(self, message: dict):
+        """
+        Метод кодирует сообщение для отправки в согласованном формате.
+
+        :param message: словарь - сообщение,
+        :return: bytes: данные для отправки.
+        """
+
+        if not self.framed:
+            return encode_message(message)
+        payload = None
+        if self.codec == CODEC_BINARY:
+            # Сообщение, которое двоичный формат не представляет,
+            # отправляется кадром JSON: формат задаёт флаг каждого кадра.
+            try:
+                payload, flags = encode_binary(message), FRAME_BINARY
+            except TypeError:
+                pass
+        if payload is None:
+            payload, flags = encode_message(message), 0
+        if self.compressor is not None:
+            payload, compressed = self.compressor.compress(payload)
+            flags |= compressed
+        return pack_frame(payload, flags)
+
+
+def get_buffer(sock):
+    """
+    Утилита возвращает буфер сообщений сокета, создавая его при
+    необходимости.
+
+    :param sock: сокет,
+    :return: MessageBuffer: буфер сокета.
+    """
+
+    buffer = _buffers.get(sock)
+    if buffer is None:
+        buffer = _buffers[sock] = MessageBuffer()
+    return buffer
+
+
+def recv_data(sock):
+    """
+    Утилита однократного чтения данных из сокета.
+
+    Если собеседник закрыл соединение, то генерирует ConnectionResetError.
+
+    :param sock: сокет,
+    :return: bytes: принятые байты.
+    """
+
+    data = sock.recv(RECV_BUFFER_LENGTH)
+    if not data:
+        raise ConnectionResetError(errno.ECONNRESET,
+                                   'Соединение закрыто собеседником.')
+    return data
+
+
+def receive_messages(sock):
+    """
+    Утилита для циклов событий: читает из сокета один раз и возвращает
+    все сообщения, собранные в буфере сокета полностью.
+
+    :param sock: сокет, готовый к чтению,
+    :return: list: список словарей - сообщений, возможно пустой.
+    """
+
+    buffer = get_buffer(sock)
+    buffer.feed(recv_data(sock))
+    messages = []
+    message = buffer.next_message()
+    while message is not None:
+        messages.append(message)
+        message = buffer.next_message()
+    return messages
+
+
+def get_message(client):
+    """
+    Утилита приёма и декодирования сообщения.
+
+    Читает из сокета, пока в буфере не окажется целое сообщение, выдает
+    словарь если принято, что-то другое отдаёт ошибку значения.
+    Остаток принятых данных сохраняется в буфере сокета.
+
+    :param client: сокет для передачи данных,
+    :return: возвращает сообщения от сервера.
+    """
+
+    buffer = get_buffer(client)
+    message = buffer.next_message()
+    while message is None:
+        buffer.feed(recv_data(client))
+        message = buffer.next_message()
+    return message
+
+
 def send_message(sock, message):
     """
     Утилита кодирования и отправки сообщения принимает словарь, отправляет его.
@@ -36,6 +357,4 @@ def send_message(sock, message):
     :return: ничего не возвращает.
     """
 
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    sock.sendall(get_buffer(sock).pack(message))
@@ -6,15 +6,132 @@ DEFAULT_PORT = 7777
 # IP-адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
 # Максимальная очередь подключений
-MAX_CONNECTIONS = 5
-# Максимальная длинна сообщений в байтах
+MAX_CONNECTIONS = 128
+# Максимальная длинна сообщений в байтах (старый формат без кадров)
 MAX_PACKAGE_LENGTH = 1024
+# Максимальная длина данных одного кадра в байтах
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
+# Размер буфера для однократного чтения из сокета
+RECV_BUFFER_LENGTH = 64 * 1024
+# Маркер кадра - старший бит первого байта заголовка. Сообщения старого
+# формата начинаются с символа "{", поэтому форматы не пересекаются.
+FRAME_MARKER = 0x80
+# Флаг кадра: данные в двоичном формате (common.codec), а не в JSON
+FRAME_BINARY = 0x01
+# Флаг кадра: данные сжаты zlib
+FRAME_COMPRESSED = 0x02
+# Все допустимые биты первого байта заголовка кадра
+FRAME_FLAGS = FRAME_MARKER | FRAME_BINARY | FRAME_COMPRESSED
+# Размер данных кадра в байтах, начиная с которого кадр сжимается, и
+# уровень сжатия zlib
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
 # Кодировка проекта
 ENCODING = 'utf-8'
 # Уровень логирования
 LOGGING_LEVEL = logging.DEBUG
 # База данных для хранения данных сервера:
 SERVER_DATABASE = 'server.ini'
+# Максимальное время ожидания событий в селекторе сервера в секундах
+SELECT_TIMEOUT = 1
+# Верхняя и нижняя границы буфера исходящих данных соединения в байтах
+OUTBOX_HIGH_WATER = 256 * 1024
+OUTBOX_LOW_WATER = 64 * 1024
+# Политики для клиентов, не успевающих принимать данные: отбросить
+# сообщение, отключить клиента или выгрузить данные во временный файл
+SLOW_CONSUMER_POLICIES = ('drop', 'disconnect', 'spill')
+SLOW_CONSUMER_POLICY = 'disconnect'
+# Максимальное количество буферов в одном вызове sendmsg
+MAX_SEND_BUFFERS = 64
+# Время хранения сообщений для пользователей не в сети в секундах и
+# максимальное количество таких сообщений на одного пользователя
+OFFLINE_MESSAGES_TTL = 7 * 24 * 60 * 60
+OFFLINE_MESSAGES_LIMIT = 1000
+# Максимальное количество записей кэша пользователей базы сервера (0 -
+# без ограничения, в кэше все пользователи)
+USER_CACHE_SIZE = 0
+# Интервал записи накопленных счётчиков отправленных и полученных
+# сообщений в базу сервера в секундах (0 - только по порогу) и
+# количество сообщений, после которого счётчики записываются сразу
+STATS_FLUSH_INTERVAL = 1.0
+STATS_FLUSH_THRESHOLD = 1000
+# Настройки SQLite базы сервера (PRAGMA): режим журнала, режим
+# синхронизации, размер отображения файла в память в байтах, размер кэша
+# страниц (отрицательный - в килобайтах) и время ожидания блокировки в
+# миллисекундах. В server.ini задаются параметрами sqlite_<настройка>.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+    'busy_timeout': 5000
+}
+# Допустимые значения строковых настроек SQLite
+SQLITE_PRAGMA_VALUES = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal'),
+    'synchronous': ('off', 'normal', 'full', 'extra')
+}
+# Версия схемы базы сервера: базы более старых версий обновляются при
+# запуске (хранится в PRAGMA user_version)
+SERVER_SCHEMA_VERSION = 1
+# Количество соединений только для чтения, которыми читает базу окно
+# управления сервером
+SQLITE_READERS = 4
+# Максимальное количество задач базы данных, изменения которых
+# записываются одним коммитом
+STORAGE_BATCH = 256
+# Время, за которое клиент должен пройти авторизацию, в секундах
+AUTH_TIMEOUT = 5
+# Пауза в приёме соединений после ошибки accept (например, исчерпаны
+# дескрипторы файлов), в секундах
+ACCEPT_RETRY_INTERVAL = 0.1
+# Время молчания клиента, после которого сервер отправляет ему ping, и
+# время молчания, после которого соединение закрывается, в секундах.
+# Нулевое значение отключает проверку.
+HEARTBEAT_INTERVAL = 30.0
+IDLE_TIMEOUT = 90.0
+# Состояния авторизации соединения: ожидание presence, отправлен запрос
+# 511, клиент авторизован
+AUTH_AWAITING_PRESENCE = 'awaiting-presence'
+AUTH_CHALLENGE_SENT = 'challenge-sent'
+AUTH_AUTHENTICATED = 'authenticated'
+# Ограничение частоты сообщений клиента: сообщений в секунду (0 -
+# без ограничения) и допустимый всплеск. Ограничения для отдельных
+# действий задаются строкой вида "message:20:40, get_users:1:5".
+RATE_LIMIT = 50.0
+RATE_BURST = 100.0
+RATE_LIMITS = ''
+# Действия с клиентом, превысившим ограничение: отложить обработку его
+# сообщений или отключить его
+RATE_LIMIT_POLICIES = ('delay', 'disconnect')
+RATE_LIMIT_POLICY = 'delay'
+# Количество сообщений одного клиента, обрабатываемых за проход цикла
+# сервера, и количество принятых, но не обработанных сообщений, при
+# котором чтение от клиента приостанавливается
+MESSAGE_BUDGET = 16
+INBOX_LIMIT = 256
+# Максимальный размер события, передаваемого между шардами сервера, и
+# интервал повторной отправки событий, не поместившихся в буфер, в
+# секундах
+MAX_SHARD_DATAGRAM = 256 * 1024
+SHARD_RETRY_INTERVAL = 0.01
+# Количество исполнителей пула вычислений сервера и их тип: потоки или
+# процессы
+WORKERS = 4
+WORKER_KINDS = ('thread', 'process')
+WORKER_KIND = 'thread'
+# Время ожидания клиентом ответа сервера на запрос в секундах
+REQUEST_TIMEOUT = 5
+# Доступные движки сервера
+SERVER_ENGINES = ('thread', 'asyncio')
+# Адрес и порт HTTP-сервера метрик в формате Prometheus (0 - метрики не
+# публикуются) и время ожидания сбора метрик основным циклом в секундах
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORT = 0
+METRICS_TIMEOUT = 5
+# Верхние границы корзин гистограмм времени в секундах
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
 
 # Протокол JIM основные ключи
 ACTION = 'action'
@@ -25,6 +142,14 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+FRAMING = 'framing'
+CODEC = 'codec'
+COMPRESSION = 'compression'
+# Идентификатор запроса клиента, сервер возвращает его в ответе
+REQUEST_ID = 'request_id'
+SUBSCRIBE = 'subscribe'
+EVENT = 'event'
+ACTIVE = 'active'
 
 # Прочие ключи, используемые в протоколе
 PRESENCE = 'presence'
@@ -40,6 +165,24 @@ ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 ACTIVE_USERS = 'action_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+PING = 'ping'
+PONG = 'pong'
+# Формат передачи с заголовком длины, предлагаемый клиентом в presence
+FRAMING_LENGTH = 'length'
+# Форматы сообщений: JSON и двоичный, предлагаемый клиентом в presence
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary'
+# Сжатие кадров, предлагаемое клиентом в presence
+COMPRESSION_ZLIB = 'zlib'
+# Подписка на события контактов, предлагаемая клиентом в presence
+SUBSCRIBE_CONTACTS = 'contacts'
+# Событие контакта, отправляемое сервером подписчику, и его виды:
+# контакт вошёл, вышел, добавлен в список контактов, удалён из него
+CONTACT_EVENT = 'contact_event'
+EVENT_ONLINE = 'online'
+EVENT_OFFLINE = 'offline'
+EVENT_ADDED = 'added'
+EVENT_REMOVED = 'removed'
 
 # Словари - ответы:
 # 200 - Удачный ответ.
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import selectors
+import socket
+
+import threading
+import logging
+
+from common.variables import *
+from common.utils import get_buffer
+from server.connection import Connection
+from server.core import MessageProcessor
+from server.database import ServerStorage
+import logs.server_log_config
+
+LOGGER = logging.getLogger('server')
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    Асинхронный вариант сервера на основе asyncio.
+
+    Приём соединений, чтение и запись выполняются сопрограммами в цикле
+    событий, работающем в отдельном потоке. Обработчики протокола JIM и
+    работа с базой данных наследуются от MessageProcessor без изменений.
+    """
+
+    def __init__(self, listen_address: str, listen_port: int,
+                 database: ServerStorage, settings=None):
+        super().__init__(listen_address, listen_port, database, settings)
+
+        # Цикл событий и признак его остановки.
+        self.loop = None
+        self.stop_event = None
+
+        # Задачи чтения клиентов.
+        self.tasks = dict()
+
+        # События возобновления чтения перегруженных клиентов.
+        self.read_gates = dict()
+
+    def run(self):
+        """Метод основной цикл потока."""
+
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """
+        Метод остановки сервера, безопасен для вызова из другого потока.
+
+        :return: ничего не возвращает.
+        """
+
+        super().stop()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def serve(self):
+        """
+        Сопрограмма работы сервера: запускает приём соединений и ждёт
+        остановки.
+
+        :return: ничего не возвращает.
+        """
+
+        self.stop_event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.init_socket()
+        if self.shards is not None:
+            self.loop.add_reader(self.shards.sock, self.read_shards)
+        self.start_metrics()
+        self.schedule_stats_flush()
+
+        accept_task = self.loop.create_task(self.accept_clients())
+        if self.running:
+            await self.stop_event.wait()
+
+        accept_task.cancel()
+        tasks = list(self.tasks.values())
+        for client in list(self.clients):
+            self.remove_client(client)
+        await asyncio.gather(accept_task, *tasks, return_exceptions=True)
+        self.stop_metrics()
+        self.flush_storage()
+        self.flush_stats()
+        self.workers.shutdown()
+        self.sock.close()
+
+    async def accept_clients(self):
+        """
+        Сопрограмма приёма новых соединений.
+
+        :return: ничего не возвращает.
+        """
+
+        while True:
+            try:
+                client, client_address = await self.loop.sock_accept(
+                    self.sock)
+            except OSError as err:
+                # Ошибка обычно означает нехватку дескрипторов файлов,
+                # поэтому приём соединений ненадолго приостанавливается.
+                LOGGER.error(f'Ошибка работы с сокетами: {err.errno}.')
+                await asyncio.sleep(ACCEPT_RETRY_INTERVAL)
+                continue
+            LOGGER.info(
+                f'Установлено соединение, '
+                f'IP-адрес подключения {client_address}.')
+            self.add_client(client, client_address)
+
+    def add_client(self, client: socket.socket, client_address):
+        """
+        Метод регистрирует новое соединение и запускает задачу чтения.
+
+        :param client: объект сокета пользователя,
+        :param client_address: адрес клиента,
+        :return: Connection: состояние соединения.
+        """
+
+        client.setblocking(False)
+        connection = Connection(client, client_address, self.high_water,
+                                self.low_water)
+        self.clients[client] = connection
+        self.metrics.connections += 1
+        self.tasks[client] = self.loop.create_task(self.read_messages(client))
+        self.set_handshake_deadline(connection)
+        return connection
+
+    def clock(self):
+        """
+        Метод возвращает текущее время часов цикла событий.
+
+        :return: float: время в секундах.
+        """
+
+        return self.loop.time()
+
+    def call_at(self, when: float, callback, *args):
+        """
+        Метод планирует вызов таймером цикла событий.
+
+        :param when: время вызова по часам цикла событий,
+        :param callback: вызываемый объект,
+        :param args: его аргументы,
+        :return: ничего не возвращает.
+        """
+
+        self.loop.call_at(when, self.run_callback, callback, args)
+
+    async def receive(self, client: socket.socket):
+        """
+        Сопрограмма приёма одного сообщения от клиента.
+
+        :param client: объект сокета пользователя,
+        :return: dict: сообщение клиента.
+        """
+
+        buffer = get_buffer(client)
+        message = buffer.next_message()
+        while message is None:
+            data = await self.loop.sock_recv(client, RECV_BUFFER_LENGTH)
+            if not data:
+                raise ConnectionResetError('Клиент закрыл соединение.')
+            buffer.feed(data)
+            message = buffer.next_message()
+        return message
+
+    async def read_messages(self, client: socket.socket):
+        """
+        Сопрограмма чтения и обработки сообщений одного клиента.
+
+        Чтение у перегруженного клиента приостанавливается. Сообщения
+        клиента, превысившего ограничение частоты, обрабатываются по мере
+        появления токенов.
+
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        connection = self.clients[client]
+        budget = self.message_budget
+        try:
+            while client in self.clients:
+                gate = self.read_gates.get(client)
+                if gate is not None:
+                    await gate.wait()
+                    continue
+                message = await self.receive(client)
+                delay = self.rate_delay(connection, message)
+                while delay:
+                    await asyncio.sleep(delay)
+                    delay = self.rate_delay(connection, message)
+                if delay is None:
+                    return
+                self.route_client_message(message, client)
+                # Сообщения, уже собранные в буфере, читаются без
+                # ожидания, поэтому после порции сообщений управление
+                # передаётся другим клиентам.
+                budget -= 1
+                if not budget:
+                    budget = self.message_budget
+                    await asyncio.sleep(0)
+        except (OSError, json.JSONDecodeError, TypeError) as err:
+            LOGGER.debug(
+                f'Получение данных из клиентского исключения.',
+                exc_info=err)
+            if client in self.clients:
+                self.remove_client(client)
+        except Exception as err:
+            LOGGER.error(
+                f'Ошибка обработки сообщения клиента '
+                f'{connection.address}: {err}.', exc_info=err)
+            if client in self.clients:
+                self.remove_client(client)
+
+    def call_soon(self, callback, *args):
+        """
+        Метод ставит вызов в очередь цикла событий. Безопасен для вызова
+        из других потоков.
+
+        :param callback: вызываемый объект,
+        :param args: его аргументы,
+        :return: ничего не возвращает.
+        """
+
+        self.loop.call_soon_threadsafe(self.run_callback, callback, args)
+
+    def schedule_storage_flush(self):
+        """
+        Метод планирует пакетную запись накопленных изменений в базу
+        на следующую итерацию цикла событий.
+
+        :return: ничего не возвращает.
+        """
+
+        if not self.storage_flush_pending:
+            self.storage_flush_pending = True
+            self.loop.call_soon(self.flush_storage)
+
+    def update_events(self, connection: Connection):
+        """
+        Метод приводит подписку соединения в цикле событий к его
+        состоянию: ожидание записи, пока в буфере есть данные, и пауза
+        чтения у перегруженного клиента.
+
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        client = connection.sock
+        if connection.queued and not connection.events:
+            connection.events = selectors.EVENT_WRITE
+            self.loop.add_writer(client, self.write_client, connection)
+        elif not connection.queued and connection.events:
+            connection.events = 0
+            self.loop.remove_writer(client)
+
+        if connection.congested and client not in self.read_gates:
+            self.read_gates[client] = asyncio.Event()
+        elif not connection.congested and client in self.read_gates:
+            self.read_gates.pop(client).set()
+
+    def close_client(self, client: socket.socket):
+        """
+        Метод закрытия соединения с клиентом.
+
+        Останавливает задачу чтения и снимает ожидание записи.
+
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        connection = self.clients.get(client)
+        if connection is not None and connection.events:
+            self.loop.remove_writer(client)
+        gate = self.read_gates.pop(client, None)
+        if gate is not None:
+            gate.set()
+        task = self.tasks.pop(client, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        super().close_client(client)
+
+    def remove_client(self, client: socket.socket):
+        """
+        Метод обработчик клиента с которым прервана связь.
+
+        При вызове из другого потока (например, из GUI) передаёт
+        выполнение в цикл событий.
+
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        if self.loop and threading.get_ident() != self.ident:
+            self.loop.call_soon_threadsafe(super().remove_client, client)
+            return
+        super().remove_client(client)
+
+    def service_update_lists(self):
+        """
+        Метод отправки сервисного сообщения 205 клиентам.
+
+        При вызове из другого потока передаёт выполнение в цикл событий.
+
+        :return: ничего не возвращает.
+        """
+
+        if self.loop and threading.get_ident() != self.ident:
+            self.loop.call_soon_threadsafe(super().service_update_lists)
+            return
+        super().service_update_lists()
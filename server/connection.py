@@ -0,0 +1,189 @@
+import socket
+import tempfile
+from collections import deque
+from itertools import islice
+
+from common.variables import *
+
+
+class Connection:
+    """
+    Класс - состояние соединения сервера с одним клиентом.
+
+    Хранит сокет, адрес клиента и ограниченный буфер исходящих данных.
+    Данные отправляются без блокировки, когда сокет готов к записи.
+    При превышении верхней границы буфера соединение считается
+    перегруженным, пока объём данных не опустится до нижней границы.
+    Данные, выгруженные на диск (политика spill), отправляются после
+    данных из памяти с сохранением порядка.
+    """
+
+    def __init__(self, sock: socket.socket, address,
+                 high_water: int = OUTBOX_HIGH_WATER,
+                 low_water: int = OUTBOX_LOW_WATER):
+        self.sock = sock
+        self.address = address
+        self.high_water = high_water
+        self.low_water = low_water
+
+        # Очередь исходящих данных в памяти и объём всех ожидающих данных.
+        self.outbox = deque()
+        self.queued = 0
+
+        # Файл для данных, не поместившихся в буфер, и позиция чтения.
+        self.spill_file = None
+        self.spilled = 0
+        self.spill_pos = 0
+
+        # Признак перегрузки, события селектора, счётчик отброшенных
+        # сообщений и всего отправлено байт.
+        self.congested = False
+        self.events = 0
+        self.dropped = 0
+        self.sent = 0
+
+        # Состояние авторизации, исходный presence и ожидаемый дайджест
+        # ответа на запрос 511, срок завершения авторизации.
+        self.state = AUTH_AWAITING_PRESENCE
+        self.handshake = None
+        self.deadline = None
+
+        # Время последнего сообщения клиента и время отправки ему ping.
+        self.last_seen = 0.0
+        self.ping_sent = 0.0
+
+        # Принятые, но ещё не обработанные сообщения, признаки очереди
+        # обработки и ожидания токенов, вёдра ограничения частоты.
+        self.inbox = deque()
+        self.scheduled = False
+        self.throttled = False
+        self.buckets = dict()
+
+        # Сообщения, отложенные до доставки сохранённых сообщений после
+        # входа пользователя, или None.
+        self.backlog = None
+
+    def __repr__(self):
+        return f'Соединение {self.address}, в очереди {self.queued} байт.'
+
+    def is_full(self):
+        """
+        Метод проверяет, достигнута ли верхняя граница буфера.
+
+        :return: bool: True, если буфер переполнен.
+        """
+
+        return self.queued >= self.high_water
+
+    def append(self, data):
+        """
+        Метод добавляет данные в очередь отправки без копирования.
+
+        Если часть данных уже выгружена на диск, то новые данные тоже
+        выгружаются, чтобы не нарушить порядок.
+
+        :param data: байты для отправки,
+        :return: ничего не возвращает.
+        """
+
+        if self.spilled:
+            self.spill(data)
+            return
+        self.outbox.append(data)
+        self.queued += len(data)
+        if self.is_full():
+            self.congested = True
+
+    def spill(self, data):
+        """
+        Метод выгружает данные во временный файл.
+
+        :param data: байты для отправки,
+        :return: ничего не возвращает.
+        """
+
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile()
+        self.spill_file.seek(0, 2)
+        self.spill_file.write(data)
+        self.spilled += len(data)
+        self.queued += len(data)
+        self.congested = True
+
+    def unspill(self):
+        """
+        Метод возвращает очередную порцию выгруженных данных в очередь.
+
+        :return: ничего не возвращает.
+        """
+
+        self.spill_file.seek(self.spill_pos)
+        chunk = self.spill_file.read(min(self.spilled, RECV_BUFFER_LENGTH))
+        self.spill_pos += len(chunk)
+        self.spilled -= len(chunk)
+        self.outbox.append(chunk)
+        if not self.spilled:
+            self.spill_file.seek(0)
+            self.spill_file.truncate()
+            self.spill_pos = 0
+
+    def flush(self):
+        """
+        Метод отправляет столько данных, сколько принимает сокет.
+
+        Если сокет поддерживает sendmsg, то несколько буферов
+        отправляются одним системным вызовом без склейки.
+
+        :return: bool: True, если все данные отправлены.
+        """
+
+        while self.queued:
+            if not self.outbox:
+                self.unspill()
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    sent = self.sock.sendmsg(
+                        list(islice(self.outbox, MAX_SEND_BUFFERS)))
+                else:
+                    sent = self.sock.send(self.outbox[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.consume(sent)
+            if self.congested and self.queued <= self.low_water:
+                self.congested = False
+            if not sent:
+                return False
+        return True
+
+    def consume(self, sent: int):
+        """
+        Метод удаляет из очереди отправленные байты.
+
+        :param sent: количество отправленных байт,
+        :return: ничего не возвращает.
+        """
+
+        self.queued -= sent
+        self.sent += sent
+        while sent:
+            chunk = self.outbox[0]
+            if sent < len(chunk):
+                self.outbox[0] = memoryview(chunk)[sent:]
+                return
+            sent -= len(chunk)
+            self.outbox.popleft()
+
+    def close(self):
+        """
+        Метод закрывает сокет и освобождает буферы соединения.
+
+        :return: ничего не возвращает.
+        """
+
+        self.outbox.clear()
+        self.inbox.clear()
+        self.queued = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.sock.close()
@@ -1,24 +1,82 @@
 
-import select
+import heapq
+import itertools
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import selectors
 import socket
 import json
-import os
 
 import threading
 import logging
+import time
 import hmac
 import binascii
 
 from common.descryptors import Port, Address
 from common.variables import *
-from common.utils import send_message, get_message
+from common.utils import get_buffer, receive_messages, Compressor
 from common.decos import login_required
+from common.errors import ShardEventTooLarge
+from server.connection import Connection
 from server.database import ServerStorage
+from server.dispatch import ActionRegistry, ActionStats
+from server.limits import RateLimits
+from server.metrics import Metrics, MetricsExporter, Exposition
+from server.workers import WorkerPool, make_challenge
 import logs.server_log_config
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
 LOGGER = logging.getLogger('server')
 
 
+def raise_open_files_limit():
+    """
+    Функция поднимает мягкий лимит открытых файлов процесса до жёсткого.
+
+    Каждое соединение занимает дескриптор, и лимит по умолчанию (1024)
+    ограничивает число клиентов. На системах без модуля resource
+    ничего не делает.
+
+    :return: ничего не возвращает.
+    """
+
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as err:
+            LOGGER.debug(f'Не удалось поднять лимит открытых файлов - {err}.')
+
+
+def get_setting(settings, name: str, default):
+    """
+    Функция чтения параметра из секции конфигурации сервера.
+
+    Значение приводится к типу значения по умолчанию. Если секция не
+    передана или параметра в ней нет, то возвращается значение по
+    умолчанию.
+
+    :param settings: секция конфигурации или словарь, может быть None,
+    :param name: имя параметра,
+    :param default: значение по умолчанию,
+    :return: значение параметра.
+    """
+
+    if settings is None or not settings.get(name):
+        return default
+    value = settings[name]
+    if isinstance(default, bool):
+        return str(value).lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+
 class MessageProcessor(threading.Thread):
     """
     Основной класс сервера.
@@ -30,8 +88,11 @@ class MessageProcessor(threading.Thread):
     port = Port()
     addr = Address()
 
+    # Реестр действий протокола, заполняется декоратором actions.register.
+    actions = ActionRegistry()
+
     def __init__(self, listen_address: str, listen_port: int,
-                 database: ServerStorage):
+                 database: ServerStorage, settings=None):
         # Параметры Подключения.
         self.addr = listen_address
         self.port = listen_port
@@ -42,12 +103,103 @@ class MessageProcessor(threading.Thread):
         # Сокет, через который будет осуществляться работа.
         self.sock = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Словарь подключённых клиентов: сокет и состояние соединения.
+        self.clients = dict()
 
-        # Сокеты.
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Селектор (epoll в Linux), в котором зарегистрированы слушающий
+        # сокет и все клиенты, и пара сокетов для его пробуждения.
+        self.selector = None
+        self.wakeup_recv = None
+        self.wakeup_send = None
+
+        # Границы буфера исходящих данных соединения и политика для
+        # клиентов, которые не успевают принимать данные.
+        self.high_water = get_setting(settings, 'outbox_high_water',
+                                      OUTBOX_HIGH_WATER)
+        self.low_water = get_setting(settings, 'outbox_low_water',
+                                     OUTBOX_LOW_WATER)
+        self.slow_consumer_policy = get_setting(
+            settings, 'slow_consumer_policy', SLOW_CONSUMER_POLICY)
+        if self.slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            LOGGER.error(
+                f'Неизвестная политика для медленных клиентов - '
+                f'{self.slow_consumer_policy}, используется '
+                f'{SLOW_CONSUMER_POLICY}.')
+            self.slow_consumer_policy = SLOW_CONSUMER_POLICY
+
+        # Ограничения частоты сообщений клиентов и количество сообщений
+        # клиента, обрабатываемых за проход цикла.
+        self.rate_limits = RateLimits(
+            get_setting(settings, 'rate_limit', RATE_LIMIT),
+            get_setting(settings, 'rate_burst', RATE_BURST),
+            get_setting(settings, 'rate_limits', RATE_LIMITS))
+        self.rate_limit_policy = get_setting(settings, 'rate_limit_policy',
+                                             RATE_LIMIT_POLICY)
+        if self.rate_limit_policy not in RATE_LIMIT_POLICIES:
+            LOGGER.error(
+                f'Неизвестная политика ограничения частоты - '
+                f'{self.rate_limit_policy}, используется '
+                f'{RATE_LIMIT_POLICY}.')
+            self.rate_limit_policy = RATE_LIMIT_POLICY
+        self.message_budget = max(
+            get_setting(settings, 'message_budget', MESSAGE_BUDGET), 1)
+
+        # Соединения с необработанными сообщениями в порядке очереди.
+        self.runnable = deque()
+
+        # Счётчики вызовов и времени обработки действий протокола,
+        # остальные счётчики сервера и HTTP-сервер метрик (если задан
+        # порт метрик).
+        self.action_stats = dict()
+        self.metrics = Metrics()
+        self.metrics_address = get_setting(settings, 'metrics_address',
+                                           METRICS_ADDRESS)
+        self.metrics_port = get_setting(settings, 'metrics_port',
+                                        METRICS_PORT)
+        self.metrics_exporter = None
+
+        # Параметры и счётчики сжатия кадров для клиентов, согласовавших
+        # сжатие.
+        self.compressor = Compressor(
+            get_setting(settings, 'compression_threshold',
+                        COMPRESSION_THRESHOLD),
+            get_setting(settings, 'compression_level', COMPRESSION_LEVEL))
+
+        # Фоновые исполнители для работы с базой данных и вычислений и
+        # очередь их результатов для обработки в основном цикле.
+        self.workers = WorkerPool(get_setting(settings, 'workers', WORKERS),
+                                  get_setting(settings, 'worker_kind',
+                                              WORKER_KIND),
+                                  self.database,
+                                  get_setting(settings, 'storage_batch',
+                                              STORAGE_BATCH))
+        self.ready = deque()
+
+        # Интервал проверки молчащих клиентов и время, после которого
+        # молчащий клиент отключается.
+        self.heartbeat_interval = get_setting(settings, 'heartbeat_interval',
+                                              HEARTBEAT_INTERVAL)
+        self.idle_timeout = get_setting(settings, 'idle_timeout',
+                                        IDLE_TIMEOUT)
+        if 0 < self.idle_timeout <= self.heartbeat_interval:
+            LOGGER.error(
+                f'Время отключения молчащих клиентов {self.idle_timeout} с. '
+                f'не больше интервала ping {self.heartbeat_interval} с., '
+                f'клиенты не успеют ответить.')
+
+        # Таймеры: куча из кортежей (срок, порядковый номер, функция,
+        # аргументы). У каждого соединения не больше одного таймера
+        # авторизации и одного таймера молчания, поэтому активность
+        # клиента не меняет кучу, а лишь сдвигает время, которое таймер
+        # проверит при срабатывании.
+        self.timers = []
+        self.timer_sequence = itertools.count()
+
+        # Флаг отложенной пакетной записи в базу данных и интервал записи
+        # накопленных счётчиков сообщений.
+        self.storage_flush_pending = False
+        self.stats_flush_interval = get_setting(
+            settings, 'stats_flush_interval', STATS_FLUSH_INTERVAL)
 
         # Флаг продолжения работы.
         self.running = True
@@ -55,6 +207,24 @@ class MessageProcessor(threading.Thread):
         # Словарь, содержащий имена пользователей и соответствующие им сокеты.
         self.names = dict()
 
+        # Обратный словарь: сокеты авторизованных клиентов и их имена.
+        self.sessions = dict()
+
+        # Подписки на события контактов: имя подписчика и множество его
+        # контактов, имя пользователя и множество подписчиков, у которых
+        # он в контактах.
+        self.subscriptions = dict()
+        self.watchers = dict()
+
+        # Связь с другими процессами - шардами (None, если сервер
+        # работает в одном процессе), пользователи, подключённые к другим
+        # шардам, и номера этих шардов, флаг повторной отправки событий
+        # шардам. Если reuse_port, то порт сервера делится с шардами.
+        self.shards = None
+        self.remote_names = dict()
+        self.shard_flush_pending = False
+        self.reuse_port = False
+
         # Конструктор предка
         super().__init__()
 
@@ -65,335 +235,1923 @@ class MessageProcessor(threading.Thread):
             f'Сервер успешно запущен, порт для подключения - {self.port},'
             f'адрес для подключения к серверу - {self.addr}.'
         )
+        raise_open_files_limit()
         # Готовим сокет.
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
 
+    def init_selector(self):
+        """
+        Метод создаёт селектор и регистрирует в нём слушающий сокет
+        и сокет пробуждения.
+
+        :return: ничего не возвращает.
+        """
+
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        if self.shards is not None:
+            self.selector.register(self.shards.sock, selectors.EVENT_READ)
+
     def run(self):
         """Метод основной цикл потока."""
 
         self.init_socket()
+        self.init_selector()
+        self.start_metrics()
+        self.schedule_stats_flush()
 
-        # Основной цикл программы сервера
+        # Основной цикл программы сервера. Поток спит в селекторе, пока
+        # не появится новое соединение, данные от клиента, готовность
+        # сокета к записи или вызов stop().
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
             try:
-                client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                LOGGER.info(
-                    f'Установлено соединение, '
-                    f'IP-адрес подключения {client_address}.')
-                client.settimeout(5)
-                self.clients.append(client)
+                events = self.selector.select(self.select_timeout())
+            except OSError as err:
+                LOGGER.error(f'Ошибка работы с сокетами: {err.errno}.')
+                continue
+
+            for key, mask in events:
+                if key.fileobj is self.sock:
+                    self.accept_clients()
+                elif key.fileobj is self.wakeup_recv:
+                    self.drain_wakeup()
+                elif self.shards is not None and \
+                        key.fileobj is self.shards.sock:
+                    self.read_shards()
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        self.write_client(key.data)
+                    if mask & selectors.EVENT_READ:
+                        self.read_client(key.fileobj)
+
+            self.run_ready()
+            self.run_timers()
+            self.process_inboxes()
+
+            # Изменения, накопленные за проход цикла, записываются в базу
+            # одной транзакцией.
+            if self.storage_flush_pending:
+                self.flush_storage()
+
+        self.stop_metrics()
+        self.flush_storage()
+        self.flush_stats()
+        self.workers.shutdown()
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+        self.sock.close()
 
-            recv_data = []
-            send_data = []
-            err_data = []
+    def accept_clients(self):
+        """
+        Метод принимает все ожидающие соединения.
+
+        :return: ничего не возвращает.
+        """
 
-            # Проверяем на наличие ждущих клиентов.
+        while True:
             try:
-                if self.clients:
-                    recv_data, self.listen_sockets, \
-                    self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                client, client_address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
             except OSError as err:
+                # Ошибка обычно означает нехватку дескрипторов файлов.
+                # Слушающий сокет остаётся готовым к чтению, поэтому он
+                # снимается с селектора, чтобы цикл не крутился впустую.
                 LOGGER.error(f'Ошибка работы с сокетами: {err.errno}.')
+                self.selector.unregister(self.sock)
+                self.call_at(self.clock() + ACCEPT_RETRY_INTERVAL,
+                             self.resume_accept)
+                return
+            LOGGER.info(
+                f'Установлено соединение, '
+                f'IP-адрес подключения {client_address}.')
+            self.add_client(client, client_address)
+
+    def resume_accept(self):
+        """
+        Метод возобновляет приём соединений после паузы.
 
-            # Принимает сообщения от клиентов для обработки, а если ошибка,
-            # исключаем клиента.
-            if recv_data:
-                for client_message in recv_data:
-                    try:
-                        self.process_clients_message(
-                            get_message(client_message), client_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        LOGGER.debug(
-                            f'Получение данных из клиентского исключения.',
-                            exc_info=err)
-                        self.remove_client(client_message)
+        :return: ничего не возвращает.
+        """
 
-    def remove_client(self, client):
+        if self.running:
+            self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def add_client(self, client: socket.socket, client_address):
         """
-        Метод обработчик клиента с которым прервана связь.
-        Ищет клиента и удаляет его из списков и базы.
+        Метод регистрирует новое соединение.
 
-        :param client: id клиента,
+        :param client: объект сокета пользователя,
+        :param client_address: адрес клиента,
+        :return: Connection: состояние соединения.
+        """
+
+        client.setblocking(False)
+        connection = Connection(client, client_address, self.high_water,
+                                self.low_water)
+        self.clients[client] = connection
+        self.metrics.connections += 1
+        connection.events = selectors.EVENT_READ
+        self.selector.register(client, connection.events, connection)
+        self.set_handshake_deadline(connection)
+        return connection
+
+    def clock(self):
+        """
+        Метод возвращает текущее время часов, по которым работают
+        таймеры.
+
+        :return: float: время в секундах.
+        """
+
+        return time.monotonic()
+
+    def call_at(self, when: float, callback, *args):
+        """
+        Метод планирует вызов на указанное время часов clock.
+
+        :param when: время вызова,
+        :param callback: вызываемый объект,
+        :param args: его аргументы,
+        :return: ничего не возвращает.
+        """
+
+        heapq.heappush(self.timers,
+                       (when, next(self.timer_sequence), callback, args))
+
+    def select_timeout(self):
+        """
+        Метод вычисляет время ожидания селектора до ближайшего таймера.
+
+        :return: float: время ожидания в секундах.
+        """
+
+        if self.runnable:
+            return 0
+        if not self.timers:
+            return SELECT_TIMEOUT
+        timeout = self.timers[0][0] - time.monotonic()
+        return min(max(timeout, 0), SELECT_TIMEOUT)
+
+    def run_timers(self):
+        """
+        Метод выполняет вызовы, время которых наступило.
+
+        :return: ничего не возвращает.
+        """
+
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            self.run_callback(callback, args)
+
+    def set_handshake_deadline(self, connection: Connection):
+        """
+        Метод назначает срок, за который клиент должен пройти очередной
+        шаг авторизации.
+
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        connection.deadline = self.clock() + AUTH_TIMEOUT
+        self.call_at(connection.deadline, self.expire_handshake, connection,
+                     connection.deadline)
+
+    def expire_handshake(self, connection: Connection, deadline: float):
+        """
+        Метод отключает клиента, если он не прошёл авторизацию к
+        назначенному сроку.
+
+        Срабатывания устаревших сроков (клиент уже авторизован, перешёл к
+        следующему шагу или отключён) игнорируются.
+
+        :param connection: состояние соединения,
+        :param deadline: срок, для которого сработал таймер,
         :return: ничего не возвращает.
         """
 
+        if connection.deadline != deadline or \
+                self.clients.get(connection.sock) is not connection:
+            return
         LOGGER.info(
-            f'Клиент - {client.getpeername()}, отключился от сервера. ')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
-        client.close()
+            f'Клиент {connection.address} не прошёл авторизацию за '
+            f'{AUTH_TIMEOUT} с. и будет отключён.')
+        self.metrics.increment(self.metrics.handshakes, 'timeout')
+        self.reject_client(connection.sock)
 
-    def process_message(self, message: dict):
+    def start_heartbeat(self, connection: Connection):
         """
-        Функция адресной отправки сообщения определенному пользователю.
+        Метод запускает проверку молчания авторизованного клиента.
 
-        :param message: сообщение пользователя в формате словаря,
+        :param connection: состояние соединения,
         :return: ничего не возвращает.
         """
 
-        # message[DESTINATION] - имя
-        # names[message[DESTINATION]] получатель
-        if message[DESTINATION] in self.names and \
-                self.names[message[DESTINATION]] in self.listen_sockets:
-            try:
-                send_message(self.names[message[DESTINATION]], message)
-                LOGGER.info(
-                    f'Отправлено сообщение пользователю {message[DESTINATION]}'
-                    f' от пользователя {message[SENDER]}.')
-            except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and \
-                self.names[message[DESTINATION]] not in self.listen_sockets:
-            LOGGER.error(
-                f'Связь с клиентом {message[DESTINATION]} была потеряна. '
-                f'Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
-        else:
-            LOGGER.error(
-                f'Пользователь {message[DESTINATION]} не зарегистрирован '
-                f'на сервере, отправка сообщения невозможна.')
+        connection.last_seen = self.clock()
+        if self.idle_timeout > 0:
+            self.call_at(connection.last_seen + self.next_check(connection),
+                         self.check_idle, connection)
 
-    @login_required
-    def process_clients_message(self, message, client: socket.socket):
+    def next_check(self, connection: Connection):
+        """
+        Метод вычисляет, через сколько секунд после последнего сообщения
+        клиента нужна следующая проверка: отправка ping или отключение.
+
+        :param connection: состояние соединения,
+        :return: float: время в секундах.
         """
-        Обработчик сообщений от клиентов.
 
-        Принимает словарь - сообщение от клиента,
-        проверяет корректность, возвращает словарь-ответ для клиента.
+        if 0 < self.heartbeat_interval < self.idle_timeout and \
+                connection.ping_sent < connection.last_seen:
+            return self.heartbeat_interval
+        return self.idle_timeout
 
-        :param message: сообщение клиента,
-        :param client: объект сокета пользователя,
-        :return: dict: если есть необходимость в ответе.
+    def check_idle(self, connection: Connection):
         """
+        Метод срабатывания таймера молчания клиента.
 
-        global new_connection
-        LOGGER.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE \
-                and TIME in message and USER in message:
-            # Если сообщение о присутствии – то вызываем функцию авторизации.
-            self.user_authorization(message, client)
-
-        # Если это сообщение, то отправляем его получателю.
-        elif ACTION in message and message[
-            ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and \
-                self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(message[SENDER],
-                                              message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_444
-                user_name = self.database.get_user(message[DESTINATION]).name
-                response[ERROR] = f'Пользователь {user_name} - не в сети.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
+        Если клиент молчит дольше idle_timeout, то отключается. Если
+        дольше heartbeat_interval, то ему отправляется ping. Иначе таймер
+        переносится на срок, отсчитанный от последнего сообщения.
+
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        if self.clients.get(connection.sock) is not connection:
             return
+        now = self.clock()
+        idle = now - connection.last_seen
+        if idle >= self.idle_timeout:
+            LOGGER.info(
+                f'Клиент {connection.address} молчит {idle:.1f} с. и будет '
+                f'отключён.')
+            self.remove_client(connection.sock)
+            return
+        if idle >= self.next_check(connection):
+            connection.ping_sent = now
+            self.send(connection.sock, {ACTION: PING, TIME: time.time()})
+            if self.clients.get(connection.sock) is not connection:
+                return
+        self.call_at(connection.last_seen + self.next_check(connection),
+                     self.check_idle, connection)
 
-        # Если клиент выходит.
-        elif ACTION in message and message[
-            ACTION] == EXIT and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            self.remove_client(client)
-
-        # Если запрос контакт-листа.
-        elif ACTION in message and message[
-            ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    def read_client(self, client: socket.socket):
+        """
+        Метод принимает сообщение от клиента для обработки, а если ошибка,
+        исключает клиента.
 
-        # Если это добавление контакта в список контактов пользователя.
-        elif ACTION in message and message[
-            ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER \
-                in message and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
 
-        # Если это удаление контакта из списка контактов пользователя.
-        elif ACTION in message and message[
-            ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER \
-                in message and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
+        # Клиент мог быть отключён при обработке предыдущего события.
+        connection = self.clients.get(client)
+        if connection is None:
+            return
+        try:
+            # За одно чтение может прийти несколько сообщений или только
+            # часть сообщения, она останется в буфере сокета.
+            connection.inbox.extend(receive_messages(client))
+        except (OSError, json.JSONDecodeError, TypeError) as err:
+            LOGGER.debug(
+                f'Получение данных из клиентского исключения.',
+                exc_info=err)
+            if client in self.clients:
                 self.remove_client(client)
+            return
+        self.schedule_inbox(connection)
+        self.update_events(connection)
 
-        # Если это запрос о зарегистрированных пользователях.
-        elif ACTION in message and message[
-            ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in
-                                   self.database.users_list()]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    def schedule_inbox(self, connection: Connection):
+        """
+        Метод ставит соединение с необработанными сообщениями в конец
+        очереди обработки.
 
-        # Если это запрос публичного ключа пользователя.
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST \
-                and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            # Может быть, что ключа ещё нет (пользователь никогда не входил,
-            # то тогда шлём ошибку - 400)
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        if connection.inbox and not connection.scheduled and \
+                not connection.throttled:
+            connection.scheduled = True
+            self.runnable.append(connection)
+
+    def process_inboxes(self):
+        """
+        Метод обрабатывает сообщения клиентов по кругу: за проход цикла
+        каждому соединению из очереди достаётся не больше message_budget
+        сообщений, поэтому клиент, присылающий много сообщений, не
+        задерживает остальных.
+
+        :return: ничего не возвращает.
+        """
+
+        for _ in range(len(self.runnable)):
+            connection = self.runnable.popleft()
+            connection.scheduled = False
+            if self.clients.get(connection.sock) is connection:
+                self.process_inbox(connection)
+
+    def process_inbox(self, connection: Connection):
+        """
+        Метод обрабатывает очередную порцию сообщений одного клиента.
+
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        client = connection.sock
+        for _ in range(self.message_budget):
+            if not connection.inbox:
+                break
+            # Ошибка обработки сообщения (в том числе сообщение
+            # неавторизованного клиента, на которое login_required
+            # отвечает TypeError) отключает только этого клиента.
+            try:
+                delay = self.rate_delay(connection, connection.inbox[0])
+                if delay is None:
+                    return
+                if delay:
+                    connection.throttled = True
+                    self.call_at(self.clock() + delay, self.resume_inbox,
+                                 connection)
+                    break
+                self.route_client_message(connection.inbox.popleft(), client)
+            except (OSError, json.JSONDecodeError, TypeError) as err:
+                LOGGER.debug(
+                    f'Обработка сообщения клиента завершилась исключением.',
+                    exc_info=err)
+                if client in self.clients:
                     self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[
-                    ERROR] = 'Нет публичного ключа для данного пользователя.'
-                try:
-                    send_message(client, response)
-                except OSError:
+                return
+            except Exception as err:
+                LOGGER.error(
+                    f'Ошибка обработки сообщения клиента '
+                    f'{connection.address}: {err}.', exc_info=err)
+                if client in self.clients:
                     self.remove_client(client)
+                return
+            if self.clients.get(client) is not connection:
+                return
+        self.schedule_inbox(connection)
+        self.update_events(connection)
 
-        # Запрос активных пользователей.
-        elif ACTION in message and message[ACTION] == ACTIVE_USERS:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user for user in self.names]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    def resume_inbox(self, connection: Connection):
+        """
+        Метод возвращает в очередь обработки соединение, для которого
+        появились токены.
+
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        connection.throttled = False
+        if self.clients.get(connection.sock) is connection:
+            self.schedule_inbox(connection)
+
+    def rate_delay(self, connection: Connection, message: dict):
+        """
+        Метод проверяет ограничение частоты для сообщения клиента.
+
+        Если ограничение превышено, а политика - disconnect, то клиент
+        отключается.
+
+        :param connection: состояние соединения,
+        :param message: сообщение клиента,
+        :return: float: 0, если сообщение можно обработать, через сколько
+        секунд его можно обработать или None, если клиент отключён.
+        """
+
+        delay = self.rate_limits.delay(connection.buckets,
+                                       message.get(ACTION), self.clock())
+        if delay and self.rate_limit_policy == 'disconnect':
+            LOGGER.warning(
+                f'Клиент {connection.address} превысил ограничение частоты '
+                f'сообщений и будет отключён.')
+            self.remove_client(connection.sock)
+            return None
+        return delay
+
+    def write_client(self, connection: Connection):
+        """
+        Метод отправляет накопленные данные клиенту, сокет которого
+        готов к записи.
+
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        if connection.sock not in self.clients:
+            return
+        try:
+            connection.flush()
+        except OSError as err:
+            LOGGER.debug('Ошибка отправки данных клиенту.', exc_info=err)
+            self.remove_client(connection.sock)
+            return
+        self.update_events(connection)
+
+    def update_events(self, connection: Connection):
+        """
+        Метод приводит подписку соединения в селекторе к его состоянию.
 
-        # Иначе отдаём Bad request.
+        Запись ожидается, пока в буфере есть данные. Чтение у
+        перегруженного клиента приостанавливается, пока он не примет
+        данные до нижней границы буфера, а у клиента с длинной очередью
+        необработанных сообщений - пока очередь не сократится.
+
+        :param connection: состояние соединения,
+        :return: ничего не возвращает.
+        """
+
+        events = 0 if connection.congested or \
+            len(connection.inbox) >= INBOX_LIMIT else selectors.EVENT_READ
+        if connection.queued:
+            events |= selectors.EVENT_WRITE
+        if events == connection.events:
+            return
+        if not events:
+            self.selector.unregister(connection.sock)
+        elif not connection.events:
+            self.selector.register(connection.sock, events, connection)
         else:
-            response = RESPONSE_400
-            response[ERROR] = 'Запрос некорректен.'
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+            self.selector.modify(connection.sock, events, connection)
+        connection.events = events
 
-    def user_authorization(self, message: dict, sock: socket.socket):
+    def drain_wakeup(self):
         """
-        Метод реализующий авторизацию пользователей.
+        Метод вычитывает данные из сокета пробуждения.
 
-        :param message: запрос от клиента,
-        :param sock: объект сокета пользователя,
-        :return: dict: возвращаем словарь с ответом.
+        :return: ничего не возвращает.
         """
 
-        # Если имя пользователя уже занято – то возвращаем - 400 ошибку.
-        LOGGER.debug(
-            f'Запущен процесс авторизации пользователя - {message[USER]}.')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
-            response[ERROR] = 'Имя пользователя уже занято.'
-            try:
-                LOGGER.debug(
-                    f'Имя пользователя занято, отправитель - {response}.')
-                send_message(sock, response)
-            except OSError as err:
-                LOGGER.debug(f'Ошибка - {err}.')
+        try:
+            while self.wakeup_recv.recv(MAX_PACKAGE_LENGTH):
                 pass
-            self.clients.remove(sock)
-            sock.close()
-        # Проверяем что пользователь зарегистрирован на сервере.
-        elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = 'Пользователь не зарегистрирован.'
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def wakeup(self):
+        """
+        Метод пробуждает основной цикл, ожидающий в селекторе.
+
+        :return: ничего не возвращает.
+        """
+
+        if self.wakeup_send is not None:
             try:
-                LOGGER.debug(
-                    f'Неизвестный пользователь, отправитель - {response}.')
-                send_message(sock, response)
+                self.wakeup_send.send(b'\0')
             except OSError:
                 pass
-            self.clients.remove(sock)
-            sock.close()
-        else:
-            LOGGER.debug('Имя пользователя корректное, проверка пароля.')
-            # Иначе отвечаем 511 и проводим процедуру авторизации.
-            message_auth = RESPONSE_511
-            random_str = binascii.hexlify(os.urandom(64))
-            message_auth[DATA] = random_str.decode('ascii')
-            HASH = hmac.new(
-                self.database.get_hash(message[USER][ACCOUNT_NAME]),
-                random_str, 'MD5')
-            digest = HASH.digest()
-            LOGGER.debug(f'Сообщение об авторизации - f{message_auth}')
-            try:
-                send_message(sock, message_auth)
-                answer = get_message(sock)
-            except OSError as err:
-                LOGGER.debug('Ошибка авторизации, данные:', exc_info=err)
-                sock.close()
-                return
-            client_digest = binascii.a2b_base64(answer[DATA])
-
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in answer and answer[
-                RESPONSE] == 511 and hmac.compare_digest(digest,
-                                                         client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY]
-                )
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Не верный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
 
-    def service_update_lists(self):
+    def stop(self):
         """
-        Метод реализующий отправки сервисного сообщения 205 клиентам.
+        Метод остановки основного цикла сервера.
 
         :return: ничего не возвращает.
         """
 
-        for client in self.names:
-            try:
-                send_message(self.names[client], RESPONSE_205)
-            except OSError:
-                self.remove_client(self.names[client])
+        self.running = False
+        LOGGER.info(f'Сжатие кадров: {self.compressor}')
+        self.wakeup()
+
+    def start_metrics(self):
+        """
+        Метод запускает HTTP-сервер метрик, если задан порт метрик.
+        Шарды публикуют метрики на портах metrics_port + номер шарда.
+
+        :return: ничего не возвращает.
+        """
+
+        if not self.metrics_port:
+            return
+        port = self.metrics_port
+        if self.shards is not None:
+            port += self.shards.index
+        self.metrics_exporter = MetricsExporter(
+            self.metrics_address, port, self.collect_metrics)
+        self.metrics_exporter.start()
+
+    def stop_metrics(self):
+        """
+        Метод останавливает HTTP-сервер метрик.
+
+        :return: ничего не возвращает.
+        """
+
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
+
+    def collect_metrics(self, timeout: float = METRICS_TIMEOUT):
+        """
+        Метод собирает метрики в основном цикле и ждёт результата.
+        Безопасен для вызова из других потоков, но не из основного
+        цикла.
+
+        :param timeout: время ожидания в секундах,
+        :return: str: текст метрик или None, если цикл не ответил.
+        """
+
+        future = Future()
+
+        def collect():
+            try:
+                future.set_result(self.metrics_text())
+            except Exception as err:
+                future.set_exception(err)
+
+        self.call_soon(collect)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            LOGGER.error('Основной цикл не собрал метрики вовремя.')
+        except Exception as err:
+            LOGGER.error(f'Ошибка сбора метрик: {err}.', exc_info=err)
+        return None
+
+    def metrics_text(self):
+        """
+        Метод формирует метрики сервера в формате Prometheus.
+        Выполняется в основном цикле.
+
+        :return: str: текст метрик.
+        """
+
+        metrics = self.metrics
+        connections = list(self.clients.values())
+        text = Exposition()
+
+        text.sample('connections_accepted_total', 'counter',
+                    'Принятые соединения.', metrics.connections)
+        for result, count in sorted(metrics.handshakes.items()):
+            text.sample('handshakes_total', 'counter',
+                        'Завершённые авторизации по результатам.', count,
+                        {'result': result})
+        for route, count in sorted(metrics.routed.items()):
+            text.sample('messages_routed_total', 'counter',
+                        'Сообщения пользователей по способу доставки.',
+                        count, {'route': route})
+        for code, count in sorted(metrics.responses.items(),
+                                  key=lambda item: str(item[0])):
+            text.sample('responses_total', 'counter',
+                        'Ответы на запросы клиентов по кодам.', count,
+                        {'code': code})
+        text.sample('received_bytes_total', 'counter',
+                    'Принято байт от клиентов.',
+                    metrics.bytes_received + sum(
+                        get_buffer(connection.sock).received
+                        for connection in connections))
+        text.sample('sent_bytes_total', 'counter',
+                    'Отправлено байт клиентам.',
+                    metrics.bytes_sent + sum(
+                        connection.sent for connection in connections))
+        text.sample('dropped_messages_total', 'counter',
+                    'Сообщения, отброшенные из-за переполнения буфера.',
+                    metrics.dropped + sum(
+                        connection.dropped for connection in connections))
+        compressor = self.compressor
+        text.sample('compressed_frames_total', 'counter',
+                    'Сжатые кадры.', compressor.frames)
+        text.sample('compression_skipped_frames_total', 'counter',
+                    'Кадры, сжатие которых не уменьшило размер.',
+                    compressor.skipped)
+        text.sample('compression_input_bytes_total', 'counter',
+                    'Данные сжатых кадров до сжатия, байт.',
+                    compressor.raw_bytes)
+        text.sample('compression_output_bytes_total', 'counter',
+                    'Данные сжатых кадров после сжатия, байт.',
+                    compressor.compressed_bytes)
+        text.sample('compression_cpu_seconds_total', 'counter',
+                    'Процессорное время сжатия кадров.', compressor.cpu_time)
+
+        text.sample('connections', 'gauge', 'Открытые соединения.',
+                    len(connections))
+        text.sample('sessions', 'gauge',
+                    'Авторизованные клиенты этого процесса.',
+                    len(self.names))
+        text.sample('remote_sessions', 'gauge',
+                    'Пользователи, подключённые к другим шардам.',
+                    len(self.remote_names))
+        text.sample('runnable_connections', 'gauge',
+                    'Соединения в очереди обработки сообщений.',
+                    len(self.runnable))
+        text.sample('inbox_messages', 'gauge',
+                    'Принятые, но не обработанные сообщения.',
+                    sum(len(connection.inbox) for connection in connections))
+        text.sample('outbox_bytes', 'gauge',
+                    'Данные, ожидающие отправки клиентам.',
+                    sum(connection.queued for connection in connections))
+        text.sample('congested_connections', 'gauge',
+                    'Соединения с переполненным буфером отправки.',
+                    sum(connection.congested for connection in connections))
+        text.sample('throttled_connections', 'gauge',
+                    'Соединения, ожидающие токенов ограничения частоты.',
+                    sum(connection.throttled for connection in connections))
+        text.sample('storage_queue', 'gauge',
+                    'Задачи базы данных, ожидающие выполнения.',
+                    metrics.storage_submitted - metrics.storage_completed)
+        text.sample('storage_commits_total', 'counter',
+                    'Групповые коммиты потока базы данных.',
+                    self.workers.storage.commits)
+        text.sample('storage_committed_tasks_total', 'counter',
+                    'Задачи базы данных, зафиксированные коммитами.',
+                    self.workers.storage.committed)
+
+        users = self.database.users
+        text.sample('user_cache_hits_total', 'counter',
+                    'Попадания в кэш пользователей базы данных.', users.hits)
+        text.sample('user_cache_misses_total', 'counter',
+                    'Промахи кэша пользователей базы данных.', users.misses)
+        text.sample('user_cache_evictions_total', 'counter',
+                    'Записи, вытесненные из кэша пользователей.',
+                    users.evictions)
+        text.sample('user_cache_entries', 'gauge',
+                    'Записи в кэше пользователей.', len(users.records))
+
+        for action, stats in sorted(self.action_stats.items()):
+            text.sample('action_errors_total', 'counter',
+                        'Ошибки обработки действий протокола.',
+                        stats.errors, {'action': action})
+        for action, stats in sorted(self.action_stats.items()):
+            text.histogram('action_seconds',
+                           'Время обработки действий протокола.',
+                           stats.latency, {'action': action})
+        for operation, histogram in sorted(metrics.storage_time.items()):
+            text.histogram('storage_seconds',
+                           'Время выполнения задач базы данных.',
+                           histogram, {'operation': operation})
+        return text.text()
+
+    def call_soon(self, callback, *args):
+        """
+        Метод ставит вызов в очередь основного цикла и пробуждает его.
+        Безопасен для вызова из других потоков.
+
+        :param callback: вызываемый объект,
+        :param args: его аргументы,
+        :return: ничего не возвращает.
+        """
+
+        self.ready.append((callback, args))
+        self.wakeup()
+
+    def run_ready(self):
+        """
+        Метод выполняет вызовы, поставленные в очередь основного цикла.
+
+        :return: ничего не возвращает.
+        """
+
+        while self.ready:
+            callback, args = self.ready.popleft()
+            self.run_callback(callback, args)
+
+    def run_callback(self, callback, args: tuple):
+        """
+        Метод выполняет вызов из очереди или таймера основного цикла.
+
+        Ошибка вызова не останавливает цикл: отключается только клиент,
+        к которому относится вызов. Клиент ищется среди аргументов и
+        переменных замыкания вызова.
+
+        :param callback: вызываемый объект,
+        :param args: его аргументы,
+        :return: ничего не возвращает.
+        """
+
+        try:
+            callback(*args)
+        except Exception as err:
+            LOGGER.error(f'Ошибка вызова {callback}: {err}.', exc_info=err)
+            values = list(args)
+            for cell in getattr(callback, '__closure__', None) or ():
+                try:
+                    values.append(cell.cell_contents)
+                except ValueError:
+                    pass
+            for value in values:
+                if isinstance(value, Connection):
+                    value = value.sock
+                if isinstance(value, socket.socket) and \
+                        value in self.clients:
+                    self.remove_client(value)
+                    return
+
+    def run_storage(self, func, *args, callback=None, errback=None):
+        """
+        Метод выполняет функцию работы с базой данных в потоке базы
+        данных.
+
+        :param func: функция,
+        :param args: её аргументы,
+        :param callback: функция, которая получит результат в основном
+        цикле, может быть None,
+        :param errback: функция, которая получит исключение в основном
+        цикле, может быть None,
+        :return: ничего не возвращает.
+        """
+
+        self.metrics.storage_submitted += 1
+        self.submit(self.workers.storage, self.metrics.timed_storage(func),
+                    args, callback, errback)
+
+    def run_compute(self, func, *args, callback=None):
+        """
+        Метод выполняет вычисления в пуле вычислений.
+
+        :param func: функция уровня модуля,
+        :param args: её аргументы,
+        :param callback: функция, которая получит результат в основном
+        цикле, может быть None,
+        :return: ничего не возвращает.
+        """
+
+        self.submit(self.workers.compute, func, args, callback)
+
+    def submit(self, executor, func, args: tuple, callback, errback=None):
+        """
+        Метод передаёт задачу исполнителю. Результат передаётся в
+        callback в основном цикле, ошибки записываются в журнал и
+        передаются в errback.
+
+        :param executor: исполнитель,
+        :param func: функция,
+        :param args: её аргументы,
+        :param callback: функция для результата или None,
+        :param errback: функция для исключения или None,
+        :return: ничего не возвращает.
+        """
+
+        def done(future):
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is not None:
+                LOGGER.error(
+                    f'Ошибка фоновой задачи {func.__name__}: {error}.',
+                    exc_info=error)
+                if errback is not None:
+                    self.call_soon(errback, error)
+            elif callback is not None:
+                self.call_soon(callback, future.result())
+
+        try:
+            executor.submit(func, *args).add_done_callback(done)
+        except RuntimeError:
+            LOGGER.debug(f'Задача {func.__name__} отброшена: сервер '
+                         f'остановлен.')
+
+    def schedule_storage_flush(self):
+        """
+        Метод планирует пакетную запись накопленных изменений в базу
+        после обработки текущих событий.
+
+        :return: ничего не возвращает.
+        """
+
+        self.storage_flush_pending = True
+
+    def flush_storage(self):
+        """
+        Метод выполняет пакетную запись накопленных изменений в базу.
+
+        :return: ничего не возвращает.
+        """
+
+        self.storage_flush_pending = False
+        self.run_storage(self.database.flush_offline_messages)
+
+    def schedule_stats_flush(self):
+        """
+        Метод планирует запись накопленных счётчиков сообщений через
+        stats_flush_interval секунд.
+
+        :return: ничего не возвращает.
+        """
+
+        if self.stats_flush_interval > 0:
+            self.call_at(self.clock() + self.stats_flush_interval,
+                         self.flush_stats)
+
+    def flush_stats(self):
+        """
+        Метод записывает накопленные счётчики сообщений в базу и, пока
+        сервер работает, планирует следующую запись.
+
+        :return: ничего не возвращает.
+        """
+
+        self.run_storage(self.database.flush_history)
+        if self.running:
+            self.schedule_stats_flush()
+
+    def send(self, client: socket.socket, message: dict):
+        """
+        Метод отправки сообщения клиенту.
+
+        Сообщение кодируется сразу и помещается в буфер соединения,
+        отправка выполняется без блокировки, а остаток отправляется,
+        когда сокет будет готов к записи. Поэтому медленный клиент не
+        задерживает остальных. Ошибки отправки обрабатываются здесь же
+        отключением клиента.
+
+        :param client: объект сокета пользователя,
+        :param message: словарь - сообщение,
+        :return: ничего не возвращает.
+        """
+
+        connection = self.clients.get(client)
+        if connection is None:
+            LOGGER.debug('Сообщение для закрытого соединения отброшено.')
+            return
+        self.send_data(connection, get_buffer(client).pack(message))
+
+    def broadcast(self, message: dict, clients=None):
+        """
+        Метод рассылки одного сообщения многим клиентам.
+
+        Сообщение кодируется (и сжимается) один раз для каждого формата
+        передачи (старый JSON, кадры JSON, двоичные кадры), и в буферы всех
+        получателей с одинаковым форматом помещается один и тот же
+        объект байтов без копирования. Список получателей копируется
+        заранее, поэтому отключение клиента при отправке не нарушает
+        рассылку, а отключённые клиенты пропускаются.
+
+        :param message: словарь - сообщение,
+        :param clients: сокеты получателей, по умолчанию - все
+        авторизованные клиенты,
+        :return: int: количество клиентов, которым поставлено сообщение.
+        """
+
+        if clients is None:
+            clients = list(self.names.values())
+        else:
+            clients = list(clients)
+        encoded = dict()
+        sent = 0
+        for client in clients:
+            connection = self.clients.get(client)
+            if connection is None:
+                continue
+            buffer = get_buffer(client)
+            wire_format = (buffer.framed, buffer.codec, buffer.compressor)
+            data = encoded.get(wire_format)
+            if data is None:
+                data = encoded[wire_format] = buffer.pack(message)
+            self.send_data(connection, data)
+            sent += 1
+        return sent
+
+    def send_data(self, connection: Connection, data: bytes):
+        """
+        Метод помещает закодированные данные в буфер соединения и
+        применяет политику для переполненного буфера.
+
+        :param connection: состояние соединения,
+        :param data: байты для отправки,
+        :return: ничего не возвращает.
+        """
+
+        if connection.is_full():
+            if self.slow_consumer_policy == 'drop':
+                connection.dropped += 1
+                LOGGER.warning(
+                    f'Буфер клиента {connection.address} переполнен, '
+                    f'сообщение отброшено.')
+                return
+            elif self.slow_consumer_policy == 'disconnect':
+                LOGGER.warning(
+                    f'Клиент {connection.address} не успевает принимать '
+                    f'данные и будет отключён.')
+                self.remove_client(connection.sock)
+                return
+            connection.spill(data)
+        else:
+            connection.append(data)
+
+        try:
+            connection.flush()
+        except OSError as err:
+            LOGGER.debug('Ошибка отправки данных клиенту.', exc_info=err)
+            self.remove_client(connection.sock)
+            return
+        self.update_events(connection)
+
+    def is_writable(self, client: socket.socket):
+        """
+        Метод проверяет, что соединение с клиентом не закрыто.
+
+        :param client: объект сокета пользователя,
+        :return: bool: True, если соединение открыто.
+        """
+
+        return client in self.clients
+
+    def close_client(self, client: socket.socket):
+        """
+        Метод закрытия соединения с клиентом.
+
+        Перед закрытием пытается без блокировки отправить остаток
+        буфера, например, ответ 400 отклонённому клиенту.
+
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        if self.selector is not None:
+            try:
+                self.selector.unregister(client)
+            except (KeyError, ValueError):
+                pass
+        connection = self.clients.pop(client, None)
+        if connection is None:
+            client.close()
+            return
+        try:
+            connection.flush()
+        except OSError:
+            pass
+        self.metrics.bytes_received += get_buffer(client).received
+        self.metrics.bytes_sent += connection.sent
+        self.metrics.dropped += connection.dropped
+        connection.close()
+
+    def reject_client(self, client: socket.socket):
+        """
+        Метод отключения клиента, не прошедшего авторизацию.
+
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.close_client(client)
+
+    def remove_client(self, client):
+        """
+        Метод обработчик клиента с которым прервана связь.
+        Ищет клиента и удаляет его из списков и базы.
+
+        :param client: id клиента,
+        :return: ничего не возвращает.
+        """
+
+        connection = self.clients.get(client)
+        LOGGER.info(
+            f'Клиент - {connection.address if connection else None}, '
+            f'отключился от сервера. ')
+        name = self.drop_session(client)
+        if name is not None:
+            self.unsubscribe(name)
+            self.notify_watchers(name, EVENT_OFFLINE)
+            self.run_storage(self.database.user_logout, name)
+        self.close_client(client)
+
+    def add_session(self, name: str, client: socket.socket):
+        """
+        Метод связывает сокет авторизованного клиента с именем
+        пользователя.
+
+        :param name: имя пользователя,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.names[name] = client
+        self.sessions[client] = name
+        self.notify_shards('login', name)
+
+    def drop_session(self, client: socket.socket):
+        """
+        Метод удаляет связь сокета клиента с именем пользователя.
+
+        :param client: объект сокета пользователя,
+        :return: str: имя пользователя или None, если клиент не
+        авторизован.
+        """
+
+        name = self.sessions.pop(client, None)
+        if name is not None and self.names.get(name) is client:
+            del self.names[name]
+            self.notify_shards('logout', name)
+        return name
+
+    def is_online(self, name: str):
+        """
+        Метод проверяет, подключён ли пользователь к этому или другому
+        шарду сервера.
+
+        :param name: имя пользователя,
+        :return: bool: True, если пользователь в сети.
+        """
+
+        return name in self.names or name in self.remote_names
+
+    def notify_shards(self, kind: str, *payload, shard: int = None):
+        """
+        Метод отправляет событие одному или всем остальным шардам.
+
+        :param kind: вид события,
+        :param payload: данные события,
+        :param shard: номер шарда, по умолчанию - все шарды,
+        :return: ничего не возвращает.
+        """
+
+        if self.shards is None:
+            return
+        if shard is None:
+            sent = self.shards.broadcast(kind, *payload)
+        else:
+            sent = self.shards.send(shard, kind, *payload)
+        if not sent and not self.shard_flush_pending:
+            self.shard_flush_pending = True
+            self.call_at(self.clock() + SHARD_RETRY_INTERVAL,
+                         self.flush_shards)
+
+    def flush_shards(self):
+        """
+        Метод повторяет отправку событий, не поместившихся в буферы
+        шардов.
+
+        :return: ничего не возвращает.
+        """
+
+        self.shard_flush_pending = False
+        if not self.shards.flush():
+            self.shard_flush_pending = True
+            self.call_at(self.clock() + SHARD_RETRY_INTERVAL,
+                         self.flush_shards)
+
+    def read_shards(self):
+        """
+        Метод обрабатывает события, поступившие от других шардов.
+
+        :return: ничего не возвращает.
+        """
+
+        for kind, shard, payload in self.shards.receive():
+            if kind == 'login':
+                self.remote_login(payload[0], shard)
+            elif kind == 'logout':
+                self.remote_logout(payload[0], shard)
+            elif kind == 'message':
+                self.remote_message(payload[0])
+            elif kind == 'broadcast':
+                self.broadcast(payload[0])
+            else:
+                LOGGER.error(f'Неизвестное событие шарда - {kind}.')
+
+    def remote_login(self, name: str, shard: int):
+        """
+        Метод учитывает вход пользователя на другом шарде.
+
+        Если пользователь одновременно вошёл на двух шардах, то остаётся
+        вход на шарде с меньшим номером, а второй шард отключает своего
+        клиента. Все шарды применяют одно правило, поэтому приходят к
+        одному результату.
+
+        :param name: имя пользователя,
+        :param shard: номер шарда,
+        :return: ничего не возвращает.
+        """
+
+        # Вход на другом шарде мог изменить публичный ключ пользователя,
+        # поэтому запись кэша пользователей удаляется.
+        self.run_storage(self.database.users.discard, name)
+        local = self.names.get(name)
+        if local is not None:
+            if self.shards.index < shard:
+                return
+            LOGGER.warning(
+                f'Пользователь {name} вошёл на шарде {shard + 1}, '
+                f'повторное подключение закрыто.')
+            self.remove_client(local)
+        current = self.remote_names.get(name)
+        if current is not None and current < shard:
+            return
+        self.remote_names[name] = shard
+        if current is None:
+            self.notify_watchers(name, EVENT_ONLINE)
+
+    def remote_logout(self, name: str, shard: int):
+        """
+        Метод учитывает выход пользователя на другом шарде.
+
+        :param name: имя пользователя,
+        :param shard: номер шарда,
+        :return: ничего не возвращает.
+        """
+
+        if self.remote_names.get(name) != shard:
+            return
+        del self.remote_names[name]
+        if name not in self.names:
+            self.notify_watchers(name, EVENT_OFFLINE)
+
+    def remote_message(self, message: dict):
+        """
+        Метод доставляет сообщение, пересланное другим шардом. Если
+        получатель уже отключился, то сообщение сохраняется до его
+        подключения.
+
+        :param message: сообщение пользователя,
+        :return: ничего не возвращает.
+        """
+
+        if message[DESTINATION] in self.names:
+            self.process_message(message)
+        else:
+            self.run_storage(
+                self.database.add_offline_message, message[DESTINATION],
+                message, callback=lambda stored: self.schedule_storage_flush())
+
+    def process_message(self, message: dict):
+        """
+        Функция адресной отправки сообщения определенному пользователю.
+
+        :param message: сообщение пользователя в формате словаря,
+        :return: ничего не возвращает.
+        """
+
+        # message[DESTINATION] - имя
+        # names[message[DESTINATION]] получатель
+        if message[DESTINATION] in self.names and \
+                self.is_writable(self.names[message[DESTINATION]]):
+            connection = self.clients[self.names[message[DESTINATION]]]
+            # Пока получателю не доставлены сохранённые сообщения, новые
+            # откладываются.
+            if connection.backlog is not None:
+                connection.backlog.append(message)
+                self.metrics.increment(self.metrics.routed, 'local')
+                return
+            try:
+                self.send(self.names[message[DESTINATION]], message)
+                self.metrics.increment(self.metrics.routed, 'local')
+                LOGGER.info(
+                    f'Отправлено сообщение пользователю {message[DESTINATION]}'
+                    f' от пользователя {message[SENDER]}.')
+            except OSError:
+                self.remove_client(self.names[message[DESTINATION]])
+        elif message[DESTINATION] in self.names:
+            LOGGER.error(
+                f'Связь с клиентом {message[DESTINATION]} была потеряна. '
+                f'Соединение закрыто, доставка невозможна.')
+            self.metrics.increment(self.metrics.routed, 'lost')
+            self.remove_client(self.names[message[DESTINATION]])
+        elif message[DESTINATION] in self.remote_names:
+            self.notify_shards('message', message,
+                               shard=self.remote_names[message[DESTINATION]])
+            self.metrics.increment(self.metrics.routed, 'shard')
+        else:
+            self.metrics.increment(self.metrics.routed, 'lost')
+            LOGGER.error(
+                f'Пользователь {message[DESTINATION]} не зарегистрирован '
+                f'на сервере, отправка сообщения невозможна.')
+
+    def route_client_message(self, message: dict, client: socket.socket):
+        """
+        Метод передаёт сообщение клиента обработчику в зависимости от
+        состояния авторизации соединения.
+
+        Пока клиенту отправлен запрос 511, следующее сообщение считается
+        ответом на него, остальные сообщения разбираются как запросы.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        connection = self.clients[client]
+        connection.last_seen = self.clock()
+        if connection.state == AUTH_CHALLENGE_SENT:
+            presence, digest = connection.handshake
+            connection.handshake = None
+            self.auth_finish(presence, client, message, digest)
+        else:
+            self.process_clients_message(message, client)
+
+    @login_required
+    def process_clients_message(self, message, client: socket.socket):
+        """
+        Обработчик сообщений от клиентов.
+
+        Принимает словарь - сообщение от клиента, находит обработчик
+        действия в реестре actions, один раз проверяет обязательные поля
+        и отправителя и вызывает обработчик. Для каждого действия ведутся
+        счётчики вызовов, ошибок и времени обработки.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        LOGGER.debug(f'Разбор сообщения от клиента : {message}')
+        spec = self.actions.get(message.get(ACTION))
+        if spec is None or not spec.validate(message) or (
+                spec.sender and
+                self.sessions.get(client) != message[spec.sender]):
+            # Иначе отдаём Bad request.
+            response = RESPONSE_400
+            response[ERROR] = 'Запрос некорректен.'
+            self.reply(client, message, response)
+            return
+
+        stats = self.action_stats.get(spec.name)
+        if stats is None:
+            stats = self.action_stats[spec.name] = ActionStats()
+        stats.calls += 1
+        started = time.perf_counter()
+        try:
+            getattr(self, spec.handler)(message, client)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.total_time += elapsed
+            stats.latency.observe(elapsed)
+
+    @actions.register(PRESENCE, TIME, USER, check=lambda message: isinstance(
+        message[USER], dict) and isinstance(
+            message[USER].get(ACCOUNT_NAME), str) and isinstance(
+            message[USER].get(PUBLIC_KEY), str))
+    def handle_presence(self, message: dict, client: socket.socket):
+        """
+        Обработчик сообщения о присутствии - запускает авторизацию.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        # Повторная авторизация на том же соединении не допускается.
+        if client in self.sessions:
+            response = RESPONSE_400
+            response[ERROR] = 'Клиент уже авторизован.'
+            self.reply(client, message, response)
+            return
+        self.user_authorization(message, client)
+
+    @actions.register(MESSAGE, DESTINATION, TIME, SENDER, MESSAGE_TEXT,
+                      sender=SENDER)
+    def handle_message(self, message: dict, client: socket.socket):
+        """
+        Обработчик сообщения пользователя - отправляет его получателю.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        # Идентификатор запроса отправителя получателю не передаётся.
+        request = message
+        if REQUEST_ID in message:
+            message = {key: value for key, value in message.items()
+                       if key != REQUEST_ID}
+
+        if self.is_online(message[DESTINATION]):
+            # Сообщение для другого шарда должно поместиться в датаграмму,
+            # иначе отправителю возвращается ошибка.
+            try:
+                self.process_message(message)
+            except ShardEventTooLarge as err:
+                LOGGER.error(f'Сообщение не передано шарду: {err}')
+                response = RESPONSE_400
+                response[ERROR] = 'Сообщение слишком велико.'
+                self.reply(client, request, response)
+                return
+            self.run_storage(self.database.process_message, message[SENDER],
+                             message[DESTINATION])
+            self.reply(client, request, RESPONSE_200)
+        # Если получатель не в сети, то сохраняем сообщение до его
+        # подключения.
+        else:
+            self.run_storage(
+                self.storage_offline_message, message,
+                callback=lambda stored: self.offline_message_stored(
+                    request, client, stored))
+
+    def storage_offline_message(self, message: dict):
+        """
+        Метод сохраняет сообщение для пользователя не в сети и
+        обновляет статистику. Выполняется в потоке базы данных.
+
+        :param message: сообщение пользователя,
+        :return: bool: True, если сообщение сохранено.
+        """
+
+        if not self.database.add_offline_message(message[DESTINATION],
+                                                 message):
+            return False
+        self.database.process_message(message[SENDER], message[DESTINATION])
+        # Получатель может подключиться к другому шарду, который читает
+        # сообщения из базы, поэтому шард записывает сообщение сразу:
+        # результат задачи, а с ним и ответ отправителю, передаётся
+        # после коммита.
+        if self.shards is not None:
+            self.database.flush_offline_messages()
+        return True
+
+    def offline_message_stored(self, message: dict, client: socket.socket,
+                               stored: bool):
+        """
+        Метод отвечает отправителю после попытки сохранить сообщение
+        для пользователя не в сети.
+
+        :param message: сообщение пользователя,
+        :param client: объект сокета отправителя,
+        :param stored: сохранено ли сообщение,
+        :return: ничего не возвращает.
+        """
+
+        if stored:
+            self.schedule_storage_flush()
+            self.metrics.increment(self.metrics.routed, 'offline')
+            LOGGER.info(
+                f'Сообщение для пользователя {message[DESTINATION]} '
+                f'сохранено до его подключения.')
+            self.reply(client, message, RESPONSE_200)
+        else:
+            response = RESPONSE_444
+            response[ERROR] = f'Пользователь {message[DESTINATION]} - ' \
+                              f'не в сети.'
+            self.reply(client, message, response)
+
+    @actions.register(EXIT, ACCOUNT_NAME, sender=ACCOUNT_NAME)
+    def handle_exit(self, message: dict, client: socket.socket):
+        """
+        Обработчик выхода клиента.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.remove_client(client)
+
+    @actions.register(PING)
+    def handle_ping(self, message: dict, client: socket.socket):
+        """
+        Обработчик проверки связи клиентом.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.reply(client, message, {ACTION: PONG, TIME: time.time()})
+
+    @actions.register(PONG)
+    def handle_pong(self, message: dict, client: socket.socket):
+        """
+        Обработчик ответа клиента на ping. Время последнего сообщения
+        клиента уже обновлено при приёме.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+    @actions.register(GET_CONTACTS, USER, sender=USER)
+    def handle_get_contacts(self, message: dict, client: socket.socket):
+        """
+        Обработчик запроса контакт-листа.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.run_storage(self.database.get_contacts, message[USER],
+                         callback=lambda contacts: self.send_list(
+                             client, message, contacts))
+
+    @actions.register(ADD_CONTACT, ACCOUNT_NAME, USER, sender=USER)
+    def handle_add_contact(self, message: dict, client: socket.socket):
+        """
+        Обработчик добавления контакта в список контактов пользователя.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.run_storage(self.database.add_contact, message[USER],
+                         message[ACCOUNT_NAME],
+                         callback=lambda result: self.contact_added(
+                             client, message))
+
+    def contact_added(self, client: socket.socket, message: dict):
+        """
+        Метод подтверждает добавление контакта и, если клиент подписан на
+        события контактов, начинает следить за контактом и сообщает
+        клиенту его состояние.
+
+        :param client: объект сокета пользователя,
+        :param message: запрос клиента,
+        :return: ничего не возвращает.
+        """
+
+        self.reply(client, message, RESPONSE_200)
+        user, contact = message[USER], message[ACCOUNT_NAME]
+        contacts = self.subscriptions.get(user)
+        if contacts is None or self.sessions.get(client) != user:
+            return
+        contacts.add(contact)
+        self.watchers.setdefault(contact, set()).add(user)
+        self.send(client, self.contact_event(
+            contact, EVENT_ADDED, self.is_online(contact)))
+
+    @actions.register(REMOVE_CONTACT, ACCOUNT_NAME, USER, sender=USER)
+    def handle_remove_contact(self, message: dict, client: socket.socket):
+        """
+        Обработчик удаления контакта из списка контактов пользователя.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.run_storage(self.database.remove_contact, message[USER],
+                         message[ACCOUNT_NAME],
+                         callback=lambda result: self.contact_removed(
+                             client, message))
+
+    def contact_removed(self, client: socket.socket, message: dict):
+        """
+        Метод подтверждает удаление контакта и, если клиент подписан на
+        события контактов, прекращает следить за контактом.
+
+        :param client: объект сокета пользователя,
+        :param message: запрос клиента,
+        :return: ничего не возвращает.
+        """
+
+        self.reply(client, message, RESPONSE_200)
+        user, contact = message[USER], message[ACCOUNT_NAME]
+        contacts = self.subscriptions.get(user)
+        if contacts is None or self.sessions.get(client) != user:
+            return
+        contacts.discard(contact)
+        self.unwatch(user, contact)
+        self.send(client, self.contact_event(contact, EVENT_REMOVED))
+
+    @actions.register(USERS_REQUEST, ACCOUNT_NAME, sender=ACCOUNT_NAME)
+    def handle_users_request(self, message: dict, client: socket.socket):
+        """
+        Обработчик запроса списка зарегистрированных пользователей.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.run_storage(self.database.users_list,
+                         callback=lambda users: self.send_list(
+                             client, message, [user[0] for user in users]))
+
+    @actions.register(PUBLIC_KEY_REQUEST, ACCOUNT_NAME)
+    def handle_public_key_request(self, message: dict,
+                                  client: socket.socket):
+        """
+        Обработчик запроса публичного ключа пользователя.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        # Ключ, записанный другим шардом, есть только в базе.
+        self.run_storage(self.database.get_pubkey, message[ACCOUNT_NAME],
+                         self.shards is None,
+                         callback=lambda key: self.send_public_key(
+                             client, message, key))
+
+    def send_public_key(self, client: socket.socket, request: dict,
+                        key: str):
+        """
+        Метод отправляет клиенту публичный ключ пользователя.
+
+        :param client: объект сокета пользователя,
+        :param request: запрос клиента,
+        :param key: публичный ключ или None,
+        :return: ничего не возвращает.
+        """
+
+        response = RESPONSE_511
+        response[DATA] = key
+        # Может быть, что ключа ещё нет (пользователь никогда не входил,
+        # то тогда шлём ошибку - 400)
+        if response[DATA]:
+            self.reply(client, request, response)
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Нет публичного ключа для данного пользователя.'
+            self.reply(client, request, response)
+
+    @actions.register(ACTIVE_USERS)
+    def handle_active_users(self, message: dict, client: socket.socket):
+        """
+        Обработчик запроса активных пользователей.
+
+        :param message: сообщение клиента,
+        :param client: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.send_list(client, message,
+                       list(self.names) + list(self.remote_names))
+
+    def send_list(self, client: socket.socket, request: dict, items: list):
+        """
+        Метод отправляет клиенту ответ 202 со списком.
+
+        :param client: объект сокета пользователя,
+        :param request: запрос клиента,
+        :param items: список,
+        :return: ничего не возвращает.
+        """
+
+        response = RESPONSE_202
+        response[LIST_INFO] = items
+        self.reply(client, request, response)
+
+    def reply(self, client: socket.socket, request: dict, response: dict):
+        """
+        Метод отправляет ответ на запрос клиента.
+
+        Если в запросе был идентификатор, то он возвращается в ответе,
+        чтобы клиент мог сопоставить ответ с запросом.
+
+        :param client: объект сокета пользователя,
+        :param request: запрос клиента,
+        :param response: словарь - ответ,
+        :return: ничего не возвращает.
+        """
+
+        if RESPONSE in response:
+            self.metrics.increment(self.metrics.responses, response[RESPONSE])
+        if REQUEST_ID in request:
+            response = dict(response)
+            response[REQUEST_ID] = request[REQUEST_ID]
+        self.send(client, response)
+
+    def user_authorization(self, message: dict, sock: socket.socket):
+        """
+        Метод реализующий авторизацию пользователей.
+
+        Проверяет, что имя не занято, и запрашивает хэш пароля в потоке
+        базы данных. Запрос 511 отправляется, когда хэш получен и
+        дайджест рассчитан, после чего соединение ожидает ответа, не
+        блокируя цикл событий. Ответ клиента проверяется при его
+        получении в route_client_message, а если он не придёт за
+        AUTH_TIMEOUT, то клиент будет отключён по таймеру.
+
+        :param message: запрос от клиента,
+        :param sock: объект сокета пользователя,
+        :return: ничего не возвращает.
+        """
+
+        # Если клиент поддерживает кадры с заголовком длины, то
+        # переключаем соединение на них, начиная с ответа на presence.
+        # Двоичный формат используется только в кадрах.
+        buffer = get_buffer(sock)
+        if message.get(FRAMING) == FRAMING_LENGTH:
+            buffer.framed = True
+            if message.get(CODEC) == CODEC_BINARY:
+                buffer.codec = CODEC_BINARY
+            if message.get(COMPRESSION) == COMPRESSION_ZLIB:
+                buffer.compressor = self.compressor
+
+        # Если имя пользователя уже занято – то возвращаем - 400 ошибку.
+        LOGGER.debug(
+            f'Запущен процесс авторизации пользователя - {message[USER]}.')
+        if self.is_online(message[USER][ACCOUNT_NAME]):
+            response = RESPONSE_400
+            response[ERROR] = 'Имя пользователя уже занято.'
+            LOGGER.debug(f'Имя пользователя занято, отправитель - {response}.')
+            self.metrics.increment(self.metrics.handshakes, 'rejected')
+            self.send(sock, response)
+            self.reject_client(sock)
+            return
+        self.run_storage(
+            self.database.get_hash, message[USER][ACCOUNT_NAME],
+            callback=lambda password_hash: self.auth_challenge(
+                message, sock, password_hash))
+
+    def auth_challenge(self, message: dict, sock: socket.socket,
+                       password_hash: bytes):
+        """
+        Первый шаг авторизации: проверка регистрации пользователя и
+        расчёт дайджеста для запроса 511 в пуле вычислений.
+
+        :param message: запрос от клиента,
+        :param sock: объект сокета пользователя,
+        :param password_hash: хэш пароля пользователя или None, если
+        пользователь не зарегистрирован,
+        :return: ничего не возвращает.
+        """
+
+        if sock not in self.clients:
+            return
+        # Проверяем что пользователь зарегистрирован на сервере.
+        if password_hash is None:
+            response = RESPONSE_400
+            response[ERROR] = 'Пользователь не зарегистрирован.'
+            LOGGER.debug(
+                f'Неизвестный пользователь, отправитель - {response}.')
+            self.metrics.increment(self.metrics.handshakes, 'rejected')
+            self.send(sock, response)
+            self.reject_client(sock)
+            return
+        LOGGER.debug('Имя пользователя корректное, проверка пароля.')
+        self.run_compute(make_challenge, password_hash,
+                         callback=lambda challenge: self.send_challenge(
+                             message, sock, *challenge))
+
+    def send_challenge(self, message: dict, sock: socket.socket,
+                       random_str: str, digest: bytes):
+        """
+        Метод отправляет клиенту запрос 511 и переводит соединение в
+        состояние ожидания ответа.
+
+        :param message: запрос от клиента,
+        :param sock: объект сокета пользователя,
+        :param random_str: случайная строка запроса,
+        :param digest: ожидаемый дайджест ответа клиента,
+        :return: ничего не возвращает.
+        """
+
+        connection = self.clients.get(sock)
+        if connection is None:
+            return
+        message_auth = RESPONSE_511
+        message_auth[DATA] = random_str
+        LOGGER.debug(f'Сообщение об авторизации - f{message_auth}')
+        connection.state = AUTH_CHALLENGE_SENT
+        connection.handshake = (message, digest)
+        self.set_handshake_deadline(connection)
+        self.send(sock, message_auth)
+
+    def auth_finish(self, message: dict, sock: socket.socket, answer: dict,
+                    digest: bytes):
+        """
+        Второй шаг авторизации: проверка ответа клиента на запрос 511.
+
+        Запись о входе и выборка сообщений, накопленных пока
+        пользователь был не в сети, выполняются в потоке базы данных.
+        Сообщения, пришедшие пользователю до их доставки, откладываются,
+        чтобы сохранить порядок.
+
+        :param message: исходный запрос presence от клиента,
+        :param sock: объект сокета пользователя,
+        :param answer: ответ клиента на запрос 511,
+        :param digest: ожидаемый дайджест,
+        :return: ничего не возвращает.
+        """
+
+        try:
+            client_digest = binascii.a2b_base64(answer[DATA])
+        except (KeyError, TypeError, binascii.Error):
+            client_digest = b''
+
+        # Если ответ клиента корректный, то сохраняем его в список
+        # пользователей. Имя проверяется повторно: пока шла авторизация,
+        # его мог занять другой клиент.
+        name = message[USER][ACCOUNT_NAME]
+        if RESPONSE in answer and answer[
+            RESPONSE] == 511 and hmac.compare_digest(
+                digest, client_digest) and not self.is_online(name):
+            self.add_session(name, sock)
+            self.metrics.increment(self.metrics.handshakes, 'ok')
+            connection = self.clients[sock]
+            connection.state = AUTH_AUTHENTICATED
+            connection.deadline = None
+            connection.backlog = []
+            self.start_heartbeat(connection)
+            client_ip, client_port = connection.address
+            self.send(sock, RESPONSE_200)
+            self.notify_watchers(name, EVENT_ONLINE)
+            self.run_storage(
+                self.storage_login, name, client_ip, client_port,
+                message[USER][PUBLIC_KEY],
+                callback=lambda offline_messages: self.deliver_offline(
+                    sock, connection, name, offline_messages),
+                errback=lambda error: self.login_failed(
+                    sock, connection, name))
+            if message.get(SUBSCRIBE) == SUBSCRIBE_CONTACTS:
+                self.run_storage(
+                    self.database.get_contacts, name,
+                    callback=lambda contacts: self.subscribe(
+                        sock, name, contacts))
+        else:
+            response = RESPONSE_400
+            response[ERROR] = 'Не верный пароль.' \
+                if not self.is_online(name) else \
+                'Имя пользователя уже занято.'
+            self.metrics.increment(self.metrics.handshakes, 'rejected')
+            self.send(sock, response)
+            self.reject_client(sock)
+
+    def storage_login(self, name: str, ip_address: str, port: int,
+                      key: str):
+        """
+        Метод фиксирует вход пользователя и выбирает сообщения,
+        накопленные пока он был не в сети. Выполняется в потоке базы
+        данных.
+
+        :param name: имя пользователя,
+        :param ip_address: IP-адрес клиента,
+        :param port: порт клиента,
+        :param key: публичный ключ пользователя,
+        :return: list: сообщения для пользователя.
+        """
+
+        self.database.user_login(name, ip_address, port, key)
+        return self.database.get_offline_messages(name)
+
+    def login_failed(self, sock: socket.socket, connection: Connection,
+                     name: str):
+        """
+        Метод отключает пользователя, вход которого не удалось записать
+        в базу. Сообщения, отложенные во время входа, сохраняются до его
+        подключения.
+
+        :param sock: объект сокета пользователя,
+        :param connection: состояние соединения,
+        :param name: имя пользователя,
+        :return: ничего не возвращает.
+        """
+
+        if self.clients.get(sock) is connection:
+            self.remove_client(sock)
+        self.deliver_offline(sock, connection, name, [])
+
+    def deliver_offline(self, sock: socket.socket, connection: Connection,
+                        name: str, offline_messages: list):
+        """
+        Метод доставляет пользователю сообщения, накопленные пока он был
+        не в сети, а затем сообщения, отложенные во время входа. Если
+        пользователь успел отключиться, то сообщения возвращаются в
+        очередь сохранённых сообщений.
+
+        :param sock: объект сокета пользователя,
+        :param connection: состояние соединения,
+        :param name: имя пользователя,
+        :param offline_messages: сохранённые сообщения,
+        :return: ничего не возвращает.
+        """
+
+        if offline_messages:
+            self.schedule_storage_flush()
+        backlog, connection.backlog = connection.backlog, None
+        messages = offline_messages + backlog
+        if self.clients.get(sock) is not connection:
+            # Пользователь мог снова войти, пока сообщения выбирались из
+            # базы, тогда они отправляются в новое соединение.
+            if name in self.names:
+                for message in messages:
+                    self.process_message(message)
+            elif messages:
+                self.run_storage(self.storage_restore_offline, name,
+                                 messages)
+            return
+        for message in messages:
+            self.send(sock, message)
+        if offline_messages:
+            LOGGER.info(
+                f'Пользователю {name} доставлено '
+                f'{len(offline_messages)} сохранённых сообщений.')
+
+    def storage_restore_offline(self, name: str, messages: list):
+        """
+        Метод возвращает в базу сообщения, которые не удалось доставить
+        отключившемуся пользователю. Выполняется в потоке базы данных.
+
+        :param name: имя пользователя,
+        :param messages: сообщения пользователя,
+        :return: ничего не возвращает.
+        """
+
+        # Выданные строки сначала удаляются, иначе они учитываются в
+        # ограничении очереди вместе со своими копиями.
+        self.database.flush_offline_messages()
+        lost = 0
+        for message in messages:
+            if not self.database.add_offline_message(name, message):
+                lost += 1
+        self.database.flush_offline_messages()
+        if lost:
+            LOGGER.warning(
+                f'Очередь сообщений пользователя {name} заполнена, '
+                f'потеряно {lost} сообщений.')
+
+    def subscribe(self, sock: socket.socket, name: str, contacts: list):
+        """
+        Метод подписывает пользователя на события его контактов и
+        присылает ему список контактов событиями добавления с отметкой,
+        в сети ли контакт.
+
+        :param sock: объект сокета пользователя,
+        :param name: имя пользователя,
+        :param contacts: список контактов пользователя,
+        :return: ничего не возвращает.
+        """
+
+        if self.sessions.get(sock) != name:
+            return
+        self.subscriptions[name] = set(contacts)
+        for contact in contacts:
+            self.watchers.setdefault(contact, set()).add(name)
+            self.send(sock, self.contact_event(
+                contact, EVENT_ADDED, self.is_online(contact)))
+
+    def unsubscribe(self, name: str):
+        """
+        Метод отменяет подписку пользователя на события контактов.
+
+        :param name: имя пользователя,
+        :return: ничего не возвращает.
+        """
+
+        for contact in self.subscriptions.pop(name, ()):
+            self.unwatch(name, contact)
+
+    def unwatch(self, name: str, contact: str):
+        """
+        Метод удаляет пользователя из подписчиков событий контакта.
+
+        :param name: имя подписчика,
+        :param contact: имя контакта,
+        :return: ничего не возвращает.
+        """
+
+        watchers = self.watchers.get(contact)
+        if watchers is not None:
+            watchers.discard(name)
+            if not watchers:
+                del self.watchers[contact]
+
+    def notify_watchers(self, name: str, event: str):
+        """
+        Метод рассылает событие пользователя подписчикам, у которых он
+        в контактах. Сообщение кодируется один раз для всех получателей.
+
+        :param name: имя пользователя,
+        :param event: вид события,
+        :return: ничего не возвращает.
+        """
+
+        watchers = self.watchers.get(name)
+        if not watchers:
+            return
+        clients = [self.names[watcher] for watcher in watchers
+                   if watcher in self.names]
+        self.broadcast(self.contact_event(name, event), clients)
+
+    @staticmethod
+    def contact_event(name: str, event: str, active: bool = None):
+        """
+        Метод формирует событие контакта для подписчика.
+
+        :param name: имя контакта,
+        :param event: вид события,
+        :param active: в сети ли контакт (для события добавления),
+        :return: dict: сообщение о событии.
+        """
+
+        message = {
+            ACTION: CONTACT_EVENT,
+            TIME: time.time(),
+            ACCOUNT_NAME: name,
+            EVENT: event
+        }
+        if active is not None:
+            message[ACTIVE] = active
+        return message
+
+    def service_update_lists(self):
+        """
+        Метод реализующий отправки сервисного сообщения 205 клиентам.
+
+        :return: ничего не возвращает.
+        """
+
+        self.broadcast(RESPONSE_205)
+        self.notify_shards('broadcast', RESPONSE_205)
@@ -1,10 +1,155 @@
 import os
-from datetime import datetime
+import json
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 import configparser
-from sqlalchemy import create_engine, Table, Column, Integer, String, \
-    MetaData, ForeignKey, DateTime, Text
+from sqlalchemy import create_engine, event, Table, Column, Index, \
+    Integer, String, MetaData, ForeignKey, DateTime, Text, bindparam, \
+    inspect, select
 from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from common.variables import OFFLINE_MESSAGES_TTL, OFFLINE_MESSAGES_LIMIT, \
+    USER_CACHE_SIZE, STATS_FLUSH_THRESHOLD, SQLITE_PRAGMAS, \
+    SQLITE_PRAGMA_VALUES, SQLITE_READERS, SERVER_SCHEMA_VERSION
+import logs.server_log_config
+
+LOGGER = logging.getLogger('server')
+
+# Настройки SQLite, которые применяются и к соединениям только для
+# чтения: режим журнала хранится в файле базы, а синхронизация касается
+# только записи.
+READER_PRAGMAS = ('mmap_size', 'cache_size', 'busy_timeout')
+
+
+def pragma_statements(pragmas: dict):
+    """
+    Функция формирует команды PRAGMA из настроек SQLite. Недопустимые
+    значения строковых настроек заменяются значениями по умолчанию.
+
+    :param pragmas: словарь настройка - значение,
+    :return: list: команды PRAGMA.
+    """
+
+    statements = []
+    for name, value in pragmas.items():
+        allowed = SQLITE_PRAGMA_VALUES.get(name)
+        if allowed is None:
+            value = int(value)
+        elif str(value).lower() in allowed:
+            value = str(value).lower()
+        else:
+            LOGGER.error(f'Недопустимое значение настройки SQLite {name} - '
+                         f'{value}, используется {SQLITE_PRAGMAS[name]}.')
+            value = SQLITE_PRAGMAS[name]
+        statements.append(f'PRAGMA {name} = {value}')
+    return statements
+
+
+def apply_pragmas(engine, statements: list):
+    """
+    Функция выполняет команды PRAGMA на каждом новом соединении движка.
+
+    :param engine: движок SQLAlchemy,
+    :param statements: команды PRAGMA,
+    :return: ничего не возвращает.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+
+class UserRecord:
+    """
+    Класс - запись каталога пользователей: id, имя, хэш пароля, публичный
+    ключ и id строки статистики сообщений.
+    """
+
+    __slots__ = ('id', 'name', 'password_hash', 'pubkey', 'history_id')
+
+    def __init__(self, user_id: int, name: str, password_hash, pubkey,
+                 history_id: int):
+        self.id = user_id
+        self.name = name
+        self.password_hash = password_hash
+        self.pubkey = pubkey
+        self.history_id = history_id
+
+    def __repr__(self):
+        return f'Пользователь {self.name} c ID - {self.id}.'
+
+
+class UserDirectory:
+    """
+    Класс - кэш каталога пользователей: имя пользователя и его запись.
+
+    Без ограничения размера хранит всех пользователей. С ограничением
+    при переполнении вытесняет запись, которая дольше всех не
+    использовалась.
+    """
+
+    def __init__(self, size: int = USER_CACHE_SIZE):
+        self.size = max(size, 0)
+        self.records = OrderedDict()
+        # Попадания, промахи и вытесненные записи.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f'Кэш пользователей: записей - {len(self.records)}, ' \
+               f'попаданий - {self.hits}, промахов - {self.misses}, ' \
+               f'вытеснено - {self.evictions}.'
+
+    def get(self, name: str):
+        """
+        Метод возвращает запись пользователя из кэша.
+
+        :param name: имя пользователя,
+        :return: UserRecord: запись или None, если её нет в кэше.
+        """
+
+        record = self.records.get(name)
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.size:
+            self.records.move_to_end(name)
+        return record
+
+    def put(self, record: UserRecord):
+        """
+        Метод добавляет или заменяет запись пользователя.
+
+        :param record: запись пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.records[record.name] = record
+        if self.size:
+            self.records.move_to_end(record.name)
+            if len(self.records) > self.size:
+                self.records.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, name: str):
+        """
+        Метод удаляет запись пользователя из кэша.
+
+        :param name: имя пользователя,
+        :return: ничего не возвращает.
+        """
+
+        self.records.pop(name, None)
 
 
 class ServerStorage:
@@ -13,6 +158,18 @@ class ServerStorage:
 
     Использует SQLite базу данных, реализован с помощью
     SQLAlchemy ORM и используется классический подход.
+
+    Id, хэши паролей, публичные ключи и id строк статистики
+    пользователей кэшируются (UserDirectory): кэш заполняется при
+    запуске и обновляется при регистрации, удалении и входе
+    пользователя. Изменения, внесённые в базу в обход ServerStorage, в
+    кэше не отражаются.
+
+    Соединение записи и сессия session используются одним потоком -
+    потоком базы данных сервера (StorageWriter), который может
+    объединять изменения нескольких задач в один коммит (begin_group и
+    commit_group). Окно управления читает базу через пул соединений
+    только для чтения (reader).
     """
 
     class AllUsers:
@@ -82,13 +239,68 @@ class ServerStorage:
                    f'отправил {self.sent} шт. сообщений, а получил ' \
                    f'столько {self.accepted} шт.'
 
-    def __init__(self, path: str):
-        # Создаём движок базы данных.
+    class OfflineMessages:
+        """Класс - отображение таблицы сообщений для пользователей не в
+        сети."""
+
+        def __init__(self, user, message):
+            self.id = None
+            self.user = user
+            self.message = message
+            self.created = datetime.now()
+
+        def __repr__(self):
+            return f'Сообщение для пользователя {self.user}, ' \
+                   f'сохранено {self.created}.'
+
+    def __init__(self, path: str, offline_ttl: int = OFFLINE_MESSAGES_TTL,
+                 offline_limit: int = OFFLINE_MESSAGES_LIMIT,
+                 user_cache_size: int = USER_CACHE_SIZE,
+                 stats_flush_threshold: int = STATS_FLUSH_THRESHOLD,
+                 pragmas: dict = None, readers: int = SQLITE_READERS):
+        # Время хранения (в секундах) и максимальное количество сообщений
+        # для одного пользователя не в сети.
+        self.offline_ttl = offline_ttl
+        self.offline_limit = offline_limit
+
+        # Сообщения, ожидающие пакетной записи, доставленные сообщения,
+        # ожидающие пакетного удаления, и счётчики очередей пользователей.
+        self.offline_pending = []
+        self.offline_delivered = set()
+        self.offline_counts = dict()
+
+        # Кэш каталога пользователей (0 - без ограничения размера).
+        self.users = UserDirectory(user_cache_size)
+
+        # Приращения счётчиков сообщений, ожидающие пакетной записи: id
+        # строки статистики и пара (отправлено, получено), количество
+        # учтённых сообщений и порог немедленной записи.
+        # Приращения читает и окно управления, поэтому они изменяются под
+        # блокировкой.
+        self.history_pending = dict()
+        self.history_pending_count = 0
+        self.history_lock = threading.Lock()
+        self.stats_flush_threshold = max(stats_flush_threshold, 1)
+
+        # Флаг группового коммита: пока он установлен, методы не
+        # фиксируют изменения, это делает commit_group. Состояние в
+        # памяти на начало группы восстанавливает rollback_group.
+        self.grouped = False
+        self.group_state = None
+
+        # Создаём движок базы данных и настраиваем его соединения.
+        # Соединение записи остаётся открытым между транзакциями, чтобы
+        # не терять кэш страниц и не повторять настройку соединения.
+        statements = pragma_statements({**SQLITE_PRAGMAS, **(pragmas or {})})
         self.database_engine = create_engine(
             f'sqlite:///{path}',
             echo=False,
+            poolclass=QueuePool,
+            pool_size=1,
+            max_overflow=2,
             pool_recycle=7200,
             connect_args={'check_same_thread': False})
+        apply_pragmas(self.database_engine, statements)
         self.metadata = MetaData()
 
         # Создаём таблицу пользователей.
@@ -115,44 +327,321 @@ class ServerStorage:
                                           Column('id', Integer,
                                                  primary_key=True),
                                           Column('name',
-                                                 ForeignKey('Users.id')),
+                                                 ForeignKey('Users.id'),
+                                                 index=True),
                                           Column('ip_address', String),
                                           Column('port', String),
                                           Column('date_time', DateTime)
                                           )
 
-        # Создаем таблицу контактов пользователей.
+        # Создаем таблицу контактов пользователей. Пара пользователь -
+        # контакт уникальна, её индекс используется и для поиска
+        # контактов пользователя.
         table_users_contacts = Table('Contacts', self.metadata,
                                      Column('id', Integer, primary_key=True),
                                      Column('user', ForeignKey('Users.id')),
-                                     Column('contact', ForeignKey('Users.id'))
+                                     Column('contact', ForeignKey('Users.id'),
+                                            index=True),
+                                     Index('ix_Contacts_user_contact', 'user',
+                                           'contact', unique=True)
                                      )
 
         # Создаем таблицу истории пользователей.
         table_users_history = Table('Users_history', self.metadata,
                                     Column('id', Integer, primary_key=True),
-                                    Column('user', ForeignKey('Users.id')),
+                                    Column('user', ForeignKey('Users.id'),
+                                           index=True),
                                     Column('sent', Integer),
                                     Column('accepted', Integer)
                                     )
 
-        # Создаем таблицы, отображения и связываем их.
+        # Создаем таблицу сообщений для пользователей не в сети.
+        table_offline_messages = Table('Offline_messages', self.metadata,
+                                       Column('id', Integer,
+                                              primary_key=True),
+                                       Column('user', ForeignKey('Users.id'),
+                                              index=True),
+                                       Column('message', Text),
+                                       Column('created', DateTime)
+                                       )
+
+        # Запрос пакетного увеличения счётчиков статистики.
+        self.history_update = table_users_history.update().where(
+            table_users_history.c.id == bindparam('history_id')
+        ).values(
+            sent=table_users_history.c.sent + bindparam('sent_delta'),
+            accepted=table_users_history.c.accepted +
+            bindparam('accepted_delta'))
+
+        # Запросы Core горячих методов. Они создаются один раз, поэтому
+        # SQLAlchemy берёт их компиляцию из кэша, а строки возвращаются
+        # кортежами без создания объектов отображений.
+        self.user_select = select(
+            table_users.c.id, table_users.c.name,
+            table_users.c.password_hash, table_users.c.pubkey
+        ).where(table_users.c.name == bindparam('name'))
+        self.user_exists = select(
+            select(table_users.c.id).where(
+                table_users.c.name == bindparam('name')).exists())
+        self.history_select = select(table_users_history.c.id).where(
+            table_users_history.c.user == bindparam('user_id'))
+        self.contacts_select = select(table_users.c.name).select_from(
+            table_users_contacts.join(
+                table_users,
+                table_users_contacts.c.contact == table_users.c.id)
+        ).where(table_users_contacts.c.user == bindparam('user_id'))
+        self.contact_exists = select(
+            select(table_users_contacts.c.id).where(
+                table_users_contacts.c.user == bindparam('user_id'),
+                table_users_contacts.c.contact == bindparam('contact_id')
+            ).exists())
+        self.pubkey_update = table_users.update().where(
+            table_users.c.id == bindparam('user_id')
+        ).values(pubkey=bindparam('key'))
+        self.active_delete = table_active_users.delete().where(
+            table_active_users.c.user == bindparam('user_id'))
+        self.active_insert = table_active_users.insert()
+        self.login_insert = table_users_login_history.insert()
+
+        # Создаем таблицы, обновляем схему существующей базы, создаём
+        # отображения и связываем их. Классы отображений общие для всех
+        # экземпляров (схема у всех баз одна), поэтому отображения
+        # создаются первым экземпляром.
         self.metadata.create_all(self.database_engine)
-        mapper(self.AllUsers, table_users)
-        mapper(self.ActiveUsers, table_active_users)
-        mapper(self.UsersLoginHistory, table_users_login_history)
-        mapper(self.UsersContacts, table_users_contacts)
-        mapper(self.UsersHistory, table_users_history)
+        self.migrate()
+        if inspect(self.AllUsers, raiseerr=False) is None:
+            mapper(self.AllUsers, table_users)
+            mapper(self.ActiveUsers, table_active_users)
+            mapper(self.UsersLoginHistory, table_users_login_history)
+            mapper(self.UsersContacts, table_users_contacts)
+            mapper(self.UsersHistory, table_users_history)
+            mapper(self.OfflineMessages, table_offline_messages)
 
         # Создаём сессию.
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
 
+        # Пул соединений только для чтения и фабрика их сессий.
+        self.reader_engine = create_engine(
+            f'sqlite:///{path}',
+            echo=False,
+            poolclass=QueuePool,
+            pool_size=max(readers, 1),
+            max_overflow=0,
+            connect_args={'check_same_thread': False})
+        apply_pragmas(self.reader_engine, [
+            statement for statement in statements
+            if statement.split()[1] in READER_PRAGMAS
+        ] + ['PRAGMA query_only = ON'])
+        self.reader_sessions = sessionmaker(bind=self.reader_engine)
+
         # Когда устанавливаем соединение, очищаем таблицу активных
         # пользователей.
         self.session.query(self.ActiveUsers).delete()
         self.session.commit()
 
+        # Удаляем сообщения, срок хранения которых истёк.
+        self.purge_offline_messages()
+
+        # Заполняем кэш пользователей.
+        self.load_users()
+
+    def migrate(self):
+        """
+        Метод обновляет схему базы, созданной предыдущими версиями
+        сервера: create_all не добавляет индексы в существующие таблицы.
+        Версия схемы хранится в PRAGMA user_version.
+
+        :return: ничего не возвращает.
+        """
+
+        with self.database_engine.begin() as connection:
+            version = connection.exec_driver_sql(
+                'PRAGMA user_version').scalar()
+            if version >= SERVER_SCHEMA_VERSION:
+                return
+            if version < 1:
+                # Версия 1: индексы внешних ключей и уникальный индекс
+                # контактов, перед созданием которого удаляются дубли.
+                connection.exec_driver_sql(
+                    'DELETE FROM "Contacts" WHERE id NOT IN '
+                    '(SELECT MIN(id) FROM "Contacts" '
+                    'GROUP BY "user", contact)')
+                for table in self.metadata.sorted_tables:
+                    for index in table.indexes:
+                        index.create(connection, checkfirst=True)
+            connection.exec_driver_sql(
+                f'PRAGMA user_version = {SERVER_SCHEMA_VERSION}')
+        LOGGER.info(f'Схема базы сервера обновлена с версии {version} до '
+                    f'{SERVER_SCHEMA_VERSION}.')
+
+    def reconnect(self):
+        """
+        Метод закрывает соединения с базой и создаёт новую сессию.
+        Вызывается до и после запуска процессов - шардов, чтобы процессы
+        не использовали общие соединения.
+
+        :return: ничего не возвращает.
+        """
+
+        self.session.close()
+        self.database_engine.dispose()
+        self.reader_engine.dispose()
+        self.session = sessionmaker(bind=self.database_engine)()
+
+    def execute(self, statement, parameters=None):
+        """
+        Метод выполняет запрос Core в текущей транзакции сессии.
+
+        :param statement: запрос,
+        :param parameters: словарь или список словарей параметров,
+        :return: результат запроса.
+        """
+
+        return self.session.connection().execute(statement,
+                                                 parameters or {})
+
+    def commit(self):
+        """
+        Метод фиксирует изменения. Во время группового коммита изменения
+        только отправляются в базу, а фиксирует их commit_group.
+
+        :return: ничего не возвращает.
+        """
+
+        if self.grouped:
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    def begin_group(self):
+        """
+        Метод начинает групповой коммит: изменения следующих вызовов
+        фиксируются вместе.
+
+        :return: ничего не возвращает.
+        """
+
+        self.grouped = True
+        # Состояние в памяти, которое отменяется вместе с транзакцией
+        # группы: очереди сообщений и приращения счётчиков.
+        with self.history_lock:
+            history = {key: list(delta)
+                       for key, delta in self.history_pending.items()}
+        self.group_state = (
+            list(self.offline_pending), set(self.offline_delivered),
+            dict(self.offline_counts), history, self.history_pending_count)
+
+    def commit_group(self):
+        """
+        Метод завершает групповой коммит и фиксирует накопленные
+        изменения одной транзакцией.
+
+        :return: ничего не возвращает.
+        """
+
+        self.grouped = False
+        self.group_state = None
+        self.session.commit()
+
+    def rollback_group(self):
+        """
+        Метод завершает групповой коммит и отменяет накопленные
+        изменения, в том числе изменения состояния в памяти.
+
+        :return: ничего не возвращает.
+        """
+
+        self.grouped = False
+        self.session.rollback()
+        if self.group_state is not None:
+            with self.history_lock:
+                self.offline_pending, self.offline_delivered, \
+                    self.offline_counts, self.history_pending, \
+                    self.history_pending_count = self.group_state
+            self.group_state = None
+        # Кэш мог получить записи из отменённой транзакции, поэтому он
+        # заполняется заново при следующих обращениях.
+        self.users.records.clear()
+
+    def group_failed(self):
+        """
+        Метод проверяет, нужно ли отменить групповой коммит: после ошибки
+        записи транзакцию сессии можно только откатить.
+
+        :return: bool: True, если транзакция не может быть продолжена.
+        """
+
+        return not self.session.is_active
+
+    @contextmanager
+    def reader(self):
+        """
+        Метод - контекст сессии только для чтения из пула соединений.
+        Сессия видит только зафиксированные изменения.
+
+        :return: сессия SQLAlchemy.
+        """
+
+        session = self.reader_sessions()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    def load_users(self):
+        """
+        Метод заполняет кэш пользователей: всеми пользователями или, если
+        размер кэша ограничен, не больше чем размер кэша.
+
+        :return: ничего не возвращает.
+        """
+
+        query = self.session.query(
+            self.AllUsers.id, self.AllUsers.name,
+            self.AllUsers.password_hash, self.AllUsers.pubkey,
+            self.UsersHistory.id
+        ).outerjoin(self.UsersHistory,
+                    self.UsersHistory.user == self.AllUsers.id)
+        if self.users.size:
+            query = query.limit(self.users.size)
+        for row in query:
+            self.users.put(UserRecord(*row))
+
+    def find_user(self, name: str):
+        """
+        Метод возвращает запись пользователя из кэша, а при промахе - из
+        базы, добавляя её в кэш.
+
+        :param name: имя пользователя,
+        :return: UserRecord: запись или None, если пользователь не
+        зарегистрирован.
+        """
+
+        record = self.users.get(name)
+        if record is None:
+            row = self.execute(self.user_select, {'name': name}).first()
+            if row is None:
+                return None
+            record = UserRecord(*row, None)
+            self.users.put(record)
+        return record
+
+    def history_id(self, user: UserRecord):
+        """
+        Метод возвращает id строки статистики пользователя. Для записей,
+        добавленных в кэш при промахе, id читается из базы при первом
+        обращении.
+
+        :param user: запись пользователя,
+        :return: int: id строки статистики.
+        """
+
+        if user.history_id is None:
+            user.history_id = self.execute(
+                self.history_select, {'user_id': user.id}).scalar()
+        return user.history_id
+
     def user_login(self, username: str, ip_address: str, port: int, key: str):
         """
         Метод выполняющаяся при входе пользователя.
@@ -167,22 +656,28 @@ class ServerStorage:
         :return: ничего не возвращает.
         """
 
-        result = self.session.query(self.AllUsers).filter_by(name=username)
-        # Если имя пользователя уже присутствует в таблице, обновляем время
-        # последнего подключения.
-        if result.count():
-            user = result.first()
-            if user.pubkey != key:
-                user.pubkey = key
-        else:
+        user = self.find_user(username)
+        if user is None:
             raise ValueError('Пользователь не зарегистрирован.')
+        connection = self.session.connection()
+        if user.pubkey != key:
+            connection.execute(self.pubkey_update,
+                               {'user_id': user.id, 'key': key})
 
         # Производим запись в таблицу активных пользователей и в таблицу
         # истории входов пользователя - о факте подключения пользователя.
-        new_active_user = self.ActiveUsers(user.id, ip_address, port)
-        history = self.UsersLoginHistory(user.id, ip_address, port)
-        self.session.add_all([new_active_user, history])
-        self.session.commit()
+        # Запись о прошлом подключении может остаться, если его выход
+        # обрабатывает другой процесс - шард.
+        now = datetime.now()
+        connection.execute(self.active_delete, {'user_id': user.id})
+        connection.execute(self.active_insert, {
+            'user': user.id, 'ip_address': ip_address, 'port': port,
+            'login_time': now})
+        connection.execute(self.login_insert, {
+            'name': user.id, 'ip_address': ip_address, 'port': port,
+            'date_time': now})
+        self.commit()
+        user.pubkey = key
 
     def user_logout(self, user_id: str):
         """
@@ -194,10 +689,12 @@ class ServerStorage:
         return: ничего не возвращает.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(
-            name=user_id).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.commit()
+        user = self.find_user(user_id)
+        # Пользователь мог быть удалён из окна управления.
+        if user is None:
+            return
+        self.execute(self.active_delete, {'user_id': user.id})
+        self.commit()
 
     def add_user(self, name: str, password_hash):
         """
@@ -212,10 +709,14 @@ class ServerStorage:
 
         user_row = self.AllUsers(name, password_hash)
         self.session.add(user_row)
-        self.session.commit()
+        self.session.flush()
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
-        self.session.commit()
+        self.session.flush()
+        record = UserRecord(user_row.id, name, password_hash, None,
+                            history_row.id)
+        self.commit()
+        self.users.put(record)
 
     def remove_user(self, user_id: str):
         """
@@ -227,8 +728,11 @@ class ServerStorage:
         :return: ничего не возвращает.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(
-            name=user_id).first()
+        user = self.find_user(user_id)
+        if user is None:
+            return
+        with self.history_lock:
+            self.history_pending.pop(user.history_id, None)
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.query(self.UsersLoginHistory).filter_by(
             name=user.id).delete()
@@ -236,45 +740,58 @@ class ServerStorage:
         self.session.query(self.UsersContacts).filter_by(
             contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.session.query(self.OfflineMessages).filter_by(
+            user=user.id).delete()
+        self.offline_pending = [row for row in self.offline_pending
+                                if row['user'] != user.id]
+        self.offline_counts.pop(user_id, None)
         self.session.query(self.AllUsers).filter_by(name=user_id).delete()
-        self.session.commit()
+        self.commit()
+        self.users.discard(user_id)
 
     def get_hash(self, user_id: str):
         """
         Метод получения хэша пароля пользователя.
 
         :param user_id: id пользователя,
-        :return: list[tuple]: возвращает хэш пароля пользователя.
+        :return: bytes: возвращает хэш пароля пользователя или None.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(
-            name=user_id).first()
-        return user.password_hash
+        user = self.find_user(user_id)
+        return user.password_hash if user else None
 
-    def get_pubkey(self, user_id: str):
+    def get_pubkey(self, user_id: str, cached: bool = True):
         """
         Метод получения публичного ключа пользователя.
 
+        Ключ в кэше может устареть, если пользователь вошёл через другой
+        процесс - шард, поэтому шарды читают ключ из базы (cached=False),
+        обновляя запись кэша.
+
         :param user_id: id пользователя,
-        :return: list[tuple]: возвращает публичный ключ пользователя.
+        :param cached: можно ли взять ключ из кэша,
+        :return: str: возвращает публичный ключ пользователя или None.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(
-            name=user_id).first()
-        return user.pubkey
+        if not cached:
+            self.users.discard(user_id)
+        user = self.find_user(user_id)
+        return user.pubkey if user else None
 
     def check_user(self, user_id: str):
         """
         Метод проверяющий существование пользователя.
 
+        При промахе кэша проверяет наличие строки, не загружая запись,
+        чтобы проверки не вытесняли из кэша пользователей в сети.
+
         :param user_id: id пользователя,
-        :return: ничего не возвращает.
+        :return: bool: True, если пользователь зарегистрирован.
         """
 
-        if self.session.query(self.AllUsers).filter_by(name=user_id).count():
+        if self.users.get(user_id) is not None:
             return True
-        else:
-            return False
+        return self.execute(self.user_exists, {'name': user_id}).scalar()
 
     def get_user(self, user_name: str):
         """
@@ -284,8 +801,8 @@ class ServerStorage:
         :return: возвращает объект БД - пользователя.
         """
 
-        return self.session.query(self.AllUsers).filter_by(
-            name=user_name).first()
+        user = self.find_user(user_name)
+        return self.session.get(self.AllUsers, user.id) if user else None
 
     def add_contact(self, user: str, contact: str):
         """
@@ -296,19 +813,18 @@ class ServerStorage:
         :return: если не проходит проверку, то возвращает None.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.find_user(user)
+        contact = self.find_user(contact)
 
         # Проверяем что не дубль и что контакт может существовать (полю
         # пользователь мы доверяем).
-        if not contact or self.session.query(self.UsersContacts).filter_by(
-                user=user.id, contact=contact.id).count():
+        if not contact or self.execute(self.contact_exists, {
+                'user_id': user.id, 'contact_id': contact.id}).scalar():
             return
 
         contact_row = self.UsersContacts(user.id, contact.id)
         self.session.add(contact_row)
-        self.session.commit()
+        self.commit()
 
     def remove_contact(self, user: str, contact: str):
         """
@@ -319,9 +835,8 @@ class ServerStorage:
         :return: если не проходит проверку, то возвращает None.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.find_user(user)
+        contact = self.find_user(contact)
         if not contact:
             return
 
@@ -329,7 +844,7 @@ class ServerStorage:
             self.UsersContacts.user == user.id,
             self.UsersContacts.contact == contact.id
         ).delete()
-        self.session.commit()
+        self.commit()
 
     def get_contacts(self, username: str):
         """
@@ -339,37 +854,172 @@ class ServerStorage:
         :return: list: возвращает список контактов пользователя.
         """
 
-        user = self.session.query(self.AllUsers).filter_by(
-            name=username).first()
-        query = self.session.query(self.UsersContacts,
-                                   self.AllUsers.name).filter_by(
-            user=user.id).join(
-            self.AllUsers, self.UsersContacts.contact == self.AllUsers.id
-        )
-
-        return [contact[1] for contact in query.all()]
+        user = self.find_user(username)
+        return self.execute(self.contacts_select,
+                            {'user_id': user.id}).scalars().all()
 
     def process_message(self, sender: int, recipient: int):
         """
-        Метод фиксирует передачу сообщения и производит запись в БД.
+        Метод фиксирует передачу сообщения в статистике пользователей.
 
         :param sender: id отправителя,
         :param recipient: id получателя,
         :return: ничего не возвращает.
         """
 
-        sender = self.session.query(self.AllUsers).filter_by(
-            name=sender).first().id
-        recipient = self.session.query(self.AllUsers).filter_by(
-            name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики.
-        sender_row = self.session.query(self.UsersHistory).filter_by(
-            user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UsersHistory).filter_by(
-            user=recipient).first()
-        recipient_row.accepted += 1
-        self.session.commit()
+        # Приращения накапливаются в памяти и записываются в базу
+        # flush_history пакетом, по таймеру сервера или по достижении
+        # порога.
+        users = [self.find_user(name) for name in (sender, recipient)]
+        if None in users:
+            return
+        history_ids = [self.history_id(user) for user in users]
+        with self.history_lock:
+            for column, history_id in enumerate(history_ids):
+                delta = self.history_pending.get(history_id)
+                if delta is None:
+                    delta = self.history_pending[history_id] = [0, 0]
+                delta[column] += 1
+            self.history_pending_count += 1
+        if self.history_pending_count >= self.stats_flush_threshold:
+            self.flush_history()
+
+    def flush_history(self):
+        """
+        Метод записывает накопленные приращения счётчиков сообщений
+        одной транзакцией.
+
+        :return: ничего не возвращает.
+        """
+
+        with self.history_lock:
+            if not self.history_pending:
+                return
+            pending, count = self.history_pending, self.history_pending_count
+            self.history_pending = dict()
+            self.history_pending_count = 0
+        try:
+            self.session.execute(self.history_update, [
+                {'history_id': history_id, 'sent_delta': sent,
+                 'accepted_delta': accepted}
+                for history_id, (sent, accepted) in pending.items()])
+            self.commit()
+        except Exception:
+            # Приращения возвращаются, чтобы записать их следующей
+            # попыткой.
+            with self.history_lock:
+                for history_id, (sent, accepted) in pending.items():
+                    delta = self.history_pending.setdefault(history_id,
+                                                            [0, 0])
+                    delta[0] += sent
+                    delta[1] += accepted
+                self.history_pending_count += count
+            raise
+
+    def add_offline_message(self, username: str, message: dict):
+        """
+        Метод сохраняет сообщение для пользователя, который не в сети.
+
+        Запись в базу откладывается до flush_offline_messages, чтобы
+        сообщения записывались пакетами одной транзакцией.
+
+        :param username: имя получателя,
+        :param message: словарь - сообщение,
+        :return: bool: False, если пользователь не найден или его очередь
+        заполнена.
+        """
+
+        user = self.find_user(username)
+        if not user:
+            return False
+        count = self.offline_counts.get(username)
+        if count is None:
+            count = self.session.query(self.OfflineMessages).filter_by(
+                user=user.id).count()
+        if count >= self.offline_limit:
+            return False
+        self.offline_counts[username] = count + 1
+        self.offline_pending.append({
+            'user': user.id,
+            'message': json.dumps(message),
+            'created': datetime.now()
+        })
+        return True
+
+    def get_offline_messages(self, username: str):
+        """
+        Метод возвращает сообщения, накопленные для пользователя.
+
+        Просроченные сообщения пропускаются. Выданные сообщения помечаются
+        для пакетного удаления при следующем flush_offline_messages.
+
+        :param username: имя пользователя,
+        :return: list: список словарей - сообщений в порядке поступления.
+        """
+
+        user = self.find_user(username)
+        self.offline_counts.pop(username, None)
+        if not user:
+            return []
+        expired = datetime.now() - timedelta(seconds=self.offline_ttl)
+
+        rows = self.session.query(
+            self.OfflineMessages.id,
+            self.OfflineMessages.message,
+            self.OfflineMessages.created
+        ).filter_by(user=user.id).order_by(self.OfflineMessages.id).all()
+        messages = []
+        for row_id, message, created in rows:
+            if row_id in self.offline_delivered:
+                continue
+            self.offline_delivered.add(row_id)
+            if created >= expired:
+                messages.append(json.loads(message))
+
+        # Сообщения, ещё не записанные в базу, выдаются из памяти.
+        pending = []
+        for row in self.offline_pending:
+            if row['user'] == user.id:
+                messages.append(json.loads(row['message']))
+            else:
+                pending.append(row)
+        self.offline_pending = pending
+        return messages
+
+    def flush_offline_messages(self):
+        """
+        Метод записывает накопленные сообщения и удаляет доставленные
+        одной транзакцией.
+
+        :return: ничего не возвращает.
+        """
+
+        if not self.offline_pending and not self.offline_delivered:
+            return
+        if self.offline_pending:
+            self.session.bulk_insert_mappings(self.OfflineMessages,
+                                              self.offline_pending)
+            self.offline_pending = []
+        if self.offline_delivered:
+            self.session.query(self.OfflineMessages).filter(
+                self.OfflineMessages.id.in_(self.offline_delivered)
+            ).delete(synchronize_session=False)
+            self.offline_delivered = set()
+        self.commit()
+
+    def purge_offline_messages(self):
+        """
+        Метод удаляет сообщения, срок хранения которых истёк.
+
+        :return: ничего не возвращает.
+        """
+
+        expired = datetime.now() - timedelta(seconds=self.offline_ttl)
+        self.session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.created < expired
+        ).delete(synchronize_session=False)
+        self.commit()
+        self.offline_counts.clear()
 
     def users_list(self):
         """
@@ -378,11 +1028,11 @@ class ServerStorage:
         :return:list[tuple]: возвращает список зарегистрированных пользователей.
         """
 
-        query = self.session.query(
-            self.AllUsers.name,
-            self.AllUsers.last_login
-        )
-        return query.all()
+        with self.reader() as session:
+            return session.query(
+                self.AllUsers.name,
+                self.AllUsers.last_login
+            ).all()
 
     def active_users_list(self):
         """
@@ -391,12 +1041,12 @@ class ServerStorage:
         :return: list[tuple]: Возвращает список активных пользователей.
         """
 
-        query = self.session.query(self.AllUsers.name,
-                                   self.ActiveUsers.ip_address,
-                                   self.ActiveUsers.port,
-                                   self.ActiveUsers.login_time
-                                   ).join(self.AllUsers)
-        return query.all()
+        with self.reader() as session:
+            return session.query(self.AllUsers.name,
+                                 self.ActiveUsers.ip_address,
+                                 self.ActiveUsers.port,
+                                 self.ActiveUsers.login_time
+                                 ).join(self.AllUsers).all()
 
     def login_history(self, username: str = None):
         """
@@ -407,29 +1057,43 @@ class ServerStorage:
         или одно пользователя.
         """
 
-        query = self.session.query(self.AllUsers.name,
-                                   self.UsersLoginHistory.ip_address,
-                                   self.UsersLoginHistory.port,
-                                   self.UsersLoginHistory.date_time
-                                   ).join(self.AllUsers)
-        if username:
-            query = query.filter(self.AllUsers.name == username)
-        return query.all()
+        with self.reader() as session:
+            query = session.query(self.AllUsers.name,
+                                  self.UsersLoginHistory.ip_address,
+                                  self.UsersLoginHistory.port,
+                                  self.UsersLoginHistory.date_time
+                                  ).join(self.AllUsers)
+            if username:
+                query = query.filter(self.AllUsers.name == username)
+            return query.all()
 
     def message_history(self):
         """
         Метод возвращающий количество переданных и полученных сообщений.
 
+        К записанным в базу счётчикам добавляются приращения, ещё не
+        записанные flush_history.
+
         :return: list[tuple]: возвращает список кортежей с данными.
         """
 
-        query = self.session.query(
-            self.AllUsers.name,
-            self.AllUsers.last_login,
-            self.UsersHistory.sent,
-            self.UsersHistory.accepted
-        ).join(self.AllUsers)
-        return query.all()
+        with self.history_lock:
+            pending = {key: tuple(delta)
+                       for key, delta in self.history_pending.items()}
+        with self.reader() as session:
+            rows = session.query(
+                self.AllUsers.name,
+                self.AllUsers.last_login,
+                self.UsersHistory.id,
+                self.UsersHistory.sent,
+                self.UsersHistory.accepted
+            ).join(self.AllUsers).all()
+        history = []
+        for name, last_login, history_id, sent, accepted in rows:
+            sent_delta, accepted_delta = pending.get(history_id, (0, 0))
+            history.append((name, last_login, sent + sent_delta,
+                            accepted + accepted_delta))
+        return history
 
 
 # Отладка
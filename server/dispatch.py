@@ -0,0 +1,92 @@
+from server.metrics import Histogram
+
+
+class ActionSpec:
+    """
+    Класс - описание действия протокола JIM.
+
+    Хранит имя метода - обработчика, обязательные поля сообщения, поле с
+    именем отправителя, которое должно соответствовать сокету клиента, и
+    необязательную дополнительную проверку сообщения.
+    """
+
+    def __init__(self, name: str, handler: str, fields: tuple,
+                 sender: str = None, check=None):
+        self.name = name
+        self.handler = handler
+        self.fields = fields
+        self.sender = sender
+        self.check = check
+
+    def __repr__(self):
+        return f'Действие {self.name} - обработчик {self.handler}.'
+
+    def validate(self, message: dict):
+        """
+        Метод проверяет наличие обязательных полей в сообщении.
+
+        :param message: словарь - сообщение,
+        :return: bool: True, если сообщение корректно.
+        """
+
+        for field in self.fields:
+            if field not in message:
+                return False
+        return self.check is None or bool(self.check(message))
+
+
+class ActionStats:
+    """
+    Класс - счётчики вызовов, ошибок и времени обработки действия и
+    гистограмма времени обработки.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.latency = Histogram()
+
+    def __repr__(self):
+        return f'Вызовов - {self.calls}, ошибок - {self.errors}, ' \
+               f'время - {self.total_time:.6f} с.'
+
+
+class ActionRegistry(dict):
+    """
+    Класс - реестр действий протокола: имя действия - описание
+    обработчика.
+
+    Используется как атрибут класса сервера. Метод register применяется
+    как декоратор к методам - обработчикам в теле класса. Наследник
+    сервера может добавить свои действия в копию реестра, не изменяя
+    реестр предка.
+    """
+
+    def register(self, name: str, *fields, sender: str = None, check=None):
+        """
+        Декоратор, регистрирующий метод как обработчик действия.
+
+        :param name: имя действия (значение поля action),
+        :param fields: обязательные поля сообщения,
+        :param sender: поле с именем отправителя, которое должно
+        принадлежать авторизованному клиенту,
+        :param check: дополнительная проверка сообщения,
+        :return: декоратор, возвращающий метод без изменений.
+        """
+
+        def decorator(func):
+            self[name] = ActionSpec(name, func.__name__, fields, sender,
+                                    check)
+            return func
+
+        return decorator
+
+    def copy(self):
+        """
+        Метод возвращает копию реестра для расширения в наследнике.
+
+        :return: ActionRegistry: копия реестра.
+        """
+
+        return ActionRegistry(self)
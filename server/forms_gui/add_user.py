@@ -1,6 +1,6 @@
 from PyQt5.QtWidgets import QDialog, QPushButton, QLineEdit, QApplication, \
     QLabel, QMessageBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 import hashlib
 import binascii
 
@@ -10,6 +10,9 @@ from server.database import ServerStorage
 class RegisterUser(QDialog):
     """Класс диалог регистрации пользователя на сервере."""
 
+    # Результат регистрации из потока базы данных сервера: успех и текст.
+    registered = pyqtSignal(bool, str)
+
     def __init__(self, database, server):
         super().__init__()
 
@@ -56,6 +59,7 @@ class RegisterUser(QDialog):
         self.btn_cancel.clicked.connect(self.close)
 
         self.messages = QMessageBox()
+        self.registered.connect(self.show_result)
         self.show()
 
     def save_data(self):
@@ -76,22 +80,83 @@ class RegisterUser(QDialog):
                 self, 'Ошибка', 'Введённые пароли не совпадают.'
             )
             return
-        elif self.database.check_user(self.client_name.text()):
-            self.messages.critical(
-                self, 'Ошибка', 'Пользователь уже существует.'
-            )
-            return
         else:
             password_bytes = self.client_password.text().encode('utf-8')
             salt = self.client_name.text().lower().encode('utf-8')
             password_hash = hashlib.pbkdf2_hmac('sha512', password_bytes, salt,
                                                 100000)
-            self.database.add_user(self.client_name.text(),
-                                   binascii.hexlify(password_hash))
-            self.messages.information(self, 'Успех',
-                                      'Пользователь успешно зарегистрирован.')
+            # База изменяется только потоком базы данных сервера. Результат
+            # передаётся в окно сигналом, а клиенты получают уведомление
+            # после записи пользователя.
+            self.btn_ok.setEnabled(False)
+            self.server.run_storage(
+                self.add_user, self.client_name.text(),
+                binascii.hexlify(password_hash),
+                callback=self.user_added,
+                errback=lambda error: self.emit_result(
+                    False, 'Не удалось сохранить пользователя.'))
+
+    def add_user(self, name: str, password_hash: bytes):
+        """
+        Метод регистрирует пользователя, если имя свободно. Выполняется
+        в потоке базы данных сервера.
+
+        :param name: имя пользователя,
+        :param password_hash: хэш пароля,
+        :return: bool: True, если пользователь зарегистрирован.
+        """
+
+        if self.database.check_user(name):
+            return False
+        self.database.add_user(name, password_hash)
+        return True
+
+    def user_added(self, added: bool):
+        """
+        Метод обрабатывает результат регистрации в основном цикле
+        сервера.
+
+        :param added: зарегистрирован ли пользователь,
+        :return: ничего не возвращает.
+        """
+
+        if added:
             self.server.service_update_lists()
+            self.emit_result(True, 'Пользователь успешно зарегистрирован.')
+        else:
+            self.emit_result(False, 'Пользователь уже существует.')
+
+    def emit_result(self, success: bool, text: str):
+        """
+        Метод передаёт результат регистрации в поток графической
+        оболочки.
+
+        :param success: зарегистрирован ли пользователь,
+        :param text: текст сообщения,
+        :return: ничего не возвращает.
+        """
+
+        try:
+            self.registered.emit(success, text)
+        except RuntimeError:
+            # Окно уже закрыто.
+            pass
+
+    def show_result(self, success: bool, text: str):
+        """
+        Метод показывает результат регистрации.
+
+        :param success: зарегистрирован ли пользователь,
+        :param text: текст сообщения,
+        :return: ничего не возвращает.
+        """
+
+        self.btn_ok.setEnabled(True)
+        if success:
+            self.messages.information(self, 'Успех', text)
             self.close()
+        else:
+            self.messages.critical(self, 'Ошибка', text)
 
 
 if __name__ == '__main__':
@@ -55,9 +55,11 @@ class DelUserDialog(QDialog):
         :return: ничего не возвращает.
         """
 
-        self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
+        self.server.run_storage(self.database.remove_user,
+                                self.selector.currentText())
+        sock = self.server.names.get(self.selector.currentText())
+        # Соединения принадлежат основному циклу сервера, поэтому клиент
+        # отключается в нём.
+        if sock is not None:
+            self.server.call_soon(self.server.remove_client, sock)
         self.close()
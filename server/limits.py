@@ -0,0 +1,108 @@
+import logging
+
+from common.variables import *
+import logs.server_log_config
+
+LOGGER = logging.getLogger('server')
+
+
+class TokenBucket:
+    """
+    Класс - ведро токенов для ограничения частоты сообщений.
+
+    Ведро пополняется со скоростью rate токенов в секунду, но не больше
+    burst токенов. Каждое сообщение забирает один токен.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def __repr__(self):
+        return f'Ведро токенов: {self.tokens:.1f} из {self.burst}, ' \
+               f'{self.rate} в секунду.'
+
+    def take(self, now: float):
+        """
+        Метод забирает токен, если он есть.
+
+        :param now: текущее время,
+        :return: float: 0, если токен получен, иначе через сколько
+        секунд он появится.
+        """
+
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimits:
+    """
+    Класс - ограничения частоты сообщений клиента.
+
+    Действия, для которых заданы свои ограничения, расходуют своё ведро,
+    остальные - общее. Нулевая скорость отключает ограничение.
+    """
+
+    def __init__(self, rate: float = RATE_LIMIT, burst: float = RATE_BURST,
+                 actions: str = ''):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.actions = self.parse(actions)
+
+    def __repr__(self):
+        return f'Ограничения: {self.rate} в секунду, запас {self.burst}, ' \
+               f'для действий - {self.actions}.'
+
+    @staticmethod
+    def parse(spec: str):
+        """
+        Метод разбирает ограничения для отдельных действий вида
+        "message:20:40, get_users:1:5" - действие, скорость и запас.
+
+        :param spec: строка с ограничениями,
+        :return: dict: действие и пара (скорость, запас).
+        """
+
+        actions = dict()
+        for item in spec.split(','):
+            if not item.strip():
+                continue
+            try:
+                action, rate, burst = item.split(':')
+                actions[action.strip()] = (float(rate), max(float(burst), 1))
+            except ValueError:
+                LOGGER.error(f'Некорректное ограничение действия - {item}.')
+        return actions
+
+    def delay(self, buckets: dict, action, now: float):
+        """
+        Метод расходует токен на сообщение клиента.
+
+        :param buckets: вёдра клиента: действие (None - общее) и ведро,
+        :param action: действие сообщения,
+        :param now: текущее время,
+        :return: float: 0, если сообщение можно обработать сейчас, иначе
+        через сколько секунд.
+        """
+
+        # Действие из сообщения клиента может быть любого типа JSON.
+        if isinstance(action, str) and action in self.actions:
+            rate, burst = self.actions[action]
+        else:
+            action, rate, burst = None, self.rate, self.burst
+        if rate <= 0:
+            return 0.0
+        bucket = buckets.get(action)
+        if bucket is None:
+            bucket = buckets[action] = TokenBucket(rate, burst, now)
+        return bucket.take(now)
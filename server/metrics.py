@@ -0,0 +1,298 @@
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from common.variables import *
+import logs.server_log_config
+
+LOGGER = logging.getLogger('server')
+
+# Тип содержимого текстового формата Prometheus.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+    Класс - гистограмма значений с фиксированными границами корзин.
+
+    Хранит количество значений в каждой корзине (не накопленное), общее
+    количество и сумму значений.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def __repr__(self):
+        return f'Значений - {self.count}, сумма - {self.total:.6f}.'
+
+    def observe(self, value: float):
+        """
+        Метод добавляет значение в гистограмму.
+
+        :param value: значение,
+        :return: ничего не возвращает.
+        """
+
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+class Metrics:
+    """
+    Класс - счётчики сервера, которые нельзя получить из его состояния
+    в момент сбора метрик.
+
+    Счётчики изменяются в основном цикле сервера, кроме счётчиков и
+    гистограмм задач базы данных, которые изменяются только потоком
+    базы данных.
+    """
+
+    def __init__(self):
+        # Принятые соединения, завершённые авторизации по результатам и
+        # сообщения пользователей по способу доставки.
+        self.connections = 0
+        self.handshakes = dict()
+        self.routed = dict()
+        # Ответы на запросы клиентов по кодам.
+        self.responses = dict()
+        # Байты и отброшенные сообщения закрытых соединений, у открытых
+        # они хранятся в соединении.
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        # Поставленные и выполненные задачи базы данных и время их
+        # выполнения по операциям.
+        self.storage_submitted = 0
+        self.storage_completed = 0
+        self.storage_time = dict()
+
+    def __repr__(self):
+        return f'Соединений - {self.connections}, авторизаций - ' \
+               f'{self.handshakes}, сообщений - {self.routed}.'
+
+    @staticmethod
+    def increment(counters: dict, key: str):
+        """
+        Метод увеличивает счётчик с меткой.
+
+        :param counters: словарь счётчиков,
+        :param key: значение метки,
+        :return: ничего не возвращает.
+        """
+
+        counters[key] = counters.get(key, 0) + 1
+
+    def timed_storage(self, func):
+        """
+        Метод оборачивает задачу базы данных: обёртка измеряет время её
+        выполнения в потоке базы данных.
+
+        :param func: функция работы с базой данных,
+        :return: обёртка с тем же именем.
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                histogram = self.storage_time.get(func.__name__)
+                if histogram is None:
+                    histogram = self.storage_time[func.__name__] = \
+                        Histogram()
+                histogram.observe(time.perf_counter() - started)
+                self.storage_completed += 1
+
+        return wrapper
+
+
+def escape_label(value):
+    """
+    Функция экранирует значение метки.
+
+    :param value: значение метки,
+    :return: str: экранированное значение.
+    """
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def format_labels(labels: dict):
+    """
+    Функция форматирует метки образца метрики.
+
+    :param labels: метки или None,
+    :return: str: метки в фигурных скобках или пустая строка.
+    """
+
+    if not labels:
+        return ''
+    items = ','.join(
+        f'{name}="{escape_label(value)}"' for name, value in labels.items())
+    return f'{{{items}}}'
+
+
+class Exposition:
+    """
+    Класс - текст метрик в формате Prometheus.
+
+    Описание (HELP и TYPE) выводится один раз перед первым образцом
+    метрики, поэтому образцы одной метрики должны добавляться подряд.
+    """
+
+    def __init__(self, prefix: str = 'messenger_'):
+        self.prefix = prefix
+        self.lines = []
+        self.described = set()
+
+    def describe(self, name: str, kind: str, description: str):
+        """
+        Метод добавляет описание метрики, если его ещё нет.
+
+        :param name: имя метрики с префиксом,
+        :param kind: тип метрики,
+        :param description: описание,
+        :return: ничего не возвращает.
+        """
+
+        if name not in self.described:
+            self.described.add(name)
+            self.lines.append(f'# HELP {name} {description}')
+            self.lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, name: str, kind: str, description: str, value,
+               labels: dict = None):
+        """
+        Метод добавляет образец счётчика или измеряемой величины.
+
+        :param name: имя метрики,
+        :param kind: тип метрики (counter или gauge),
+        :param description: описание,
+        :param value: значение,
+        :param labels: метки,
+        :return: ничего не возвращает.
+        """
+
+        name = self.prefix + name
+        self.describe(name, kind, description)
+        self.lines.append(f'{name}{format_labels(labels)} {value}')
+
+    def histogram(self, name: str, description: str, histogram: Histogram,
+                  labels: dict = None):
+        """
+        Метод добавляет гистограмму: накопленные корзины, сумму и
+        количество.
+
+        :param name: имя метрики,
+        :param description: описание,
+        :param histogram: гистограмма,
+        :param labels: метки,
+        :return: ничего не возвращает.
+        """
+
+        name = self.prefix + name
+        self.describe(name, 'histogram', description)
+        labels = labels or dict()
+        cumulative = 0
+        for bound, count in zip(histogram.bounds + ('+Inf',),
+                                histogram.counts):
+            cumulative += count
+            self.lines.append(
+                f'{name}_bucket{format_labels({**labels, "le": bound})} '
+                f'{cumulative}')
+        self.lines.append(f'{name}_sum{format_labels(labels)} '
+                          f'{histogram.total}')
+        self.lines.append(f'{name}_count{format_labels(labels)} '
+                          f'{histogram.count}')
+
+    def text(self):
+        """
+        Метод возвращает текст метрик.
+
+        :return: str: текст в формате Prometheus.
+        """
+
+        return '\n'.join(self.lines) + '\n'
+
+
+class MetricsExporter:
+    """
+    Класс - HTTP-сервер метрик в отдельном потоке.
+
+    На запрос /metrics отдаёт текст, который возвращает функция collect,
+    или ответ 503, если метрики не удалось собрать.
+    """
+
+    def __init__(self, address: str, port: int, collect):
+        self.address = address
+        self.port = port
+        self.collect = collect
+        self.httpd = None
+        self.thread = None
+
+    def __repr__(self):
+        return f'Метрики на http://{self.address}:{self.port}/metrics.'
+
+    def start(self):
+        """
+        Метод запускает HTTP-сервер метрик.
+
+        :return: ничего не возвращает.
+        """
+
+        collect = self.collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                text = collect()
+                if text is None:
+                    self.send_error(503)
+                    return
+                body = text.encode(ENCODING)
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug(f'Запрос метрик: {format % args}')
+
+        try:
+            self.httpd = ThreadingHTTPServer((self.address, self.port),
+                                             Handler)
+        except OSError as err:
+            LOGGER.error(f'Не удалось запустить сервер метрик на порту '
+                         f'{self.port}: {err}.')
+            return
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='metrics', daemon=True)
+        self.thread.start()
+        LOGGER.info(f'{self}')
+
+    def stop(self):
+        """
+        Метод останавливает HTTP-сервер метрик.
+
+        :return: ничего не возвращает.
+        """
+
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
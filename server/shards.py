@@ -0,0 +1,241 @@
+import json
+import multiprocessing
+import signal
+import socket
+from collections import deque
+
+import logging
+
+from common.errors import ShardEventTooLarge
+from common.variables import *
+import logs.server_log_config
+
+LOGGER = logging.getLogger('server')
+
+
+class ShardLink:
+    """
+    Класс - связь процесса - шарда с остальными шардами.
+
+    У каждого шарда есть пара Unix-сокетов датаграмм: из одного сокета
+    шард читает, в другой пишут остальные шарды. Пары создаются до
+    запуска процессов и наследуются ими. Каждая датаграмма - одно
+    событие: список из вида события, номера шарда - отправителя и
+    данных события. Датаграммы, которые нельзя отправить сразу из-за
+    заполненного буфера получателя, откладываются и отправляются
+    методом flush.
+    """
+
+    def __init__(self, index: int, pairs: list):
+        self.index = index
+        self.count = len(pairs)
+        self.sock = pairs[index][0]
+        self.sock.setblocking(False)
+        self.peers = [pair[1] for pair in pairs]
+        for peer in self.peers:
+            peer.setblocking(False)
+        # Отложенные датаграммы: номер шарда и данные.
+        self.pending = deque()
+
+    def __repr__(self):
+        return f'Шард {self.index + 1} из {self.count}.'
+
+    def send(self, shard: int, kind: str, *payload):
+        """
+        Метод отправляет событие шарду. Событие больше
+        MAX_SHARD_DATAGRAM не отправляется: вызывается исключение
+        ShardEventTooLarge.
+
+        :param shard: номер шарда - получателя,
+        :param kind: вид события,
+        :param payload: данные события,
+        :return: bool: True, если отложенных датаграмм нет.
+        """
+
+        data = json.dumps([kind, self.index, *payload]).encode(ENCODING)
+        if len(data) > MAX_SHARD_DATAGRAM:
+            raise ShardEventTooLarge(
+                f'Событие {kind} размером {len(data)} байт не помещается '
+                f'в датаграмму шарда.')
+        if self.pending or not self._send(shard, data):
+            self.pending.append((shard, data))
+            return False
+        return True
+
+    def broadcast(self, kind: str, *payload):
+        """
+        Метод отправляет событие всем остальным шардам.
+
+        :param kind: вид события,
+        :param payload: данные события,
+        :return: bool: True, если отложенных датаграмм нет.
+        """
+
+        sent = True
+        for shard in range(self.count):
+            if shard != self.index:
+                sent = self.send(shard, kind, *payload) and sent
+        return sent
+
+    def _send(self, shard: int, data: bytes):
+        """
+        Метод отправляет датаграмму без блокировки.
+
+        :param shard: номер шарда - получателя,
+        :param data: данные датаграммы,
+        :return: bool: False, если буфер получателя заполнен.
+        """
+
+        try:
+            self.peers[shard].send(data)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError as err:
+            LOGGER.error(
+                f'Не удалось передать событие шарду {shard + 1}: {err}.')
+        return True
+
+    def flush(self):
+        """
+        Метод отправляет отложенные датаграммы в порядке очереди.
+
+        :return: bool: True, если все датаграммы отправлены.
+        """
+
+        while self.pending:
+            shard, data = self.pending[0]
+            if not self._send(shard, data):
+                return False
+            self.pending.popleft()
+        return True
+
+    def receive(self):
+        """
+        Метод читает все поступившие события.
+
+        :return: list: список кортежей (вид, шард - отправитель, данные).
+        """
+
+        events = []
+        while True:
+            try:
+                data = self.sock.recv(MAX_SHARD_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return events
+            try:
+                kind, shard, *payload = json.loads(data.decode(ENCODING))
+            except (ValueError, TypeError):
+                LOGGER.error('Получено некорректное событие шарда.')
+                continue
+            events.append((kind, shard, payload))
+
+
+def run_shard(index: int, pairs: list, engine, listen_address: str,
+              listen_port: int, database, settings):
+    """
+    Функция - основная функция процесса - шарда.
+
+    Создаёт сервер выбранного движка, который принимает соединения на
+    общем порту (SO_REUSEPORT) и связан с остальными шардами. Работает
+    до получения сигнала SIGTERM.
+
+    :param index: номер шарда,
+    :param pairs: пары сокетов связи шардов,
+    :param engine: класс сервера,
+    :param listen_address: адрес сервера,
+    :param listen_port: порт сервера,
+    :param database: база данных сервера,
+    :param settings: секция конфигурации сервера,
+    :return: ничего не возвращает.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    database.reconnect()
+    server = engine(listen_address, listen_port, database, settings)
+    server.shards = ShardLink(index, pairs)
+    server.reuse_port = True
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    server.daemon = True
+    server.start()
+    while server.is_alive():
+        server.join(0.5)
+
+
+class ShardSupervisor:
+    """
+    Класс - запуск сервера в нескольких процессах - шардах.
+
+    Каждый шард принимает соединения на общем порту (ядро распределяет
+    их с помощью SO_REUSEPORT) и обслуживает только свои соединения.
+    Шарды сообщают друг другу о входе и выходе пользователей, поэтому
+    каждый знает, где находится любой пользователь в сети, и
+    пересылают сообщения шарду получателя.
+    """
+
+    def __init__(self, count: int, engine, listen_address: str,
+                 listen_port: int, database, settings=None):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError('Система не поддерживает SO_REUSEPORT.')
+        self.count = count
+        self.engine = engine
+        self.listen_address = listen_address
+        self.listen_port = listen_port
+        self.database = database
+        self.settings = settings
+        self.processes = []
+        # Сокеты для отправки событий шардам.
+        self.peers = []
+
+    def __repr__(self):
+        return f'Сервер из {self.count} шардов.'
+
+    def start(self):
+        """
+        Метод запускает процессы - шарды.
+
+        :return: ничего не возвращает.
+        """
+
+        pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                 for _ in range(self.count)]
+        for pair in pairs:
+            for sock in pair:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                MAX_SHARD_DATAGRAM)
+        # Соединения с базой не должны переходить в дочерние процессы.
+        self.database.reconnect()
+        context = multiprocessing.get_context('fork')
+        for index in range(self.count):
+            process = context.Process(
+                target=run_shard, name=f'shard-{index + 1}',
+                args=(index, pairs, self.engine, self.listen_address,
+                      self.listen_port, self.database, self.settings))
+            process.start()
+            self.processes.append(process)
+        for pair in pairs:
+            pair[0].close()
+        self.peers = [pair[1] for pair in pairs]
+        LOGGER.info(f'Запущен сервер из {self.count} шардов.')
+
+    def stop(self):
+        """
+        Метод останавливает процессы - шарды.
+
+        :return: ничего не возвращает.
+        """
+
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    def join(self):
+        """
+        Метод ожидает завершения процессов - шардов.
+
+        :return: ничего не возвращает.
+        """
+
+        for process in self.processes:
+            process.join()
+        for peer in self.peers:
+            peer.close()
@@ -0,0 +1,231 @@
+import binascii
+import hmac
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, \
+    ProcessPoolExecutor
+
+from common.variables import *
+import logs.server_log_config
+
+LOGGER = logging.getLogger('server')
+
+
+def make_challenge(password_hash: bytes):
+    """
+    Функция формирует случайную строку запроса 511 и ожидаемый дайджест
+    ответа клиента.
+
+    Выполняется в пуле вычислений, поэтому объявлена на уровне модуля и
+    может передаваться в другой процесс.
+
+    :param password_hash: хэш пароля пользователя,
+    :return: tuple: строка запроса и ожидаемый дайджест.
+    """
+
+    random_str = binascii.hexlify(os.urandom(64))
+    digest = hmac.new(password_hash, random_str, 'MD5').digest()
+    return random_str.decode('ascii'), digest
+
+
+class StorageWriter:
+    """
+    Класс - поток базы данных с групповым коммитом.
+
+    Задачи выполняются по очереди в порядке поступления. Все задачи,
+    накопившиеся в очереди (не больше batch), выполняются в одной
+    транзакции базы storage и фиксируются одним коммитом, а их
+    результаты передаются только после коммита. Если ошибка записи
+    сделала транзакцию непригодной, она откатывается вместе с состоянием
+    базы в памяти, а остальные задачи группы повторяются по одной, так
+    что ошибкой завершается только задача, которая её вызвала.
+
+    Интерфейс submit и shutdown совпадает с concurrent.futures.Executor.
+    """
+
+    def __init__(self, storage=None, batch: int = STORAGE_BATCH):
+        self.storage = storage
+        self.batch = max(batch, 1)
+        self.queue = queue.SimpleQueue()
+        self.closed = False
+        self.lock = threading.Lock()
+        # Выполненные коммиты и задачи в них.
+        self.commits = 0
+        self.committed = 0
+        self.thread = threading.Thread(target=self.run, name='storage',
+                                       daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f'Поток базы данных: коммитов - {self.commits}, ' \
+               f'задач - {self.committed}.'
+
+    def submit(self, func, *args):
+        """
+        Метод ставит задачу в очередь.
+
+        :param func: функция,
+        :param args: её аргументы,
+        :return: Future: результат задачи.
+        """
+
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('Поток базы данных остановлен.')
+            self.queue.put((future, func, args))
+        return future
+
+    def shutdown(self, wait: bool = True):
+        """
+        Метод останавливает поток после выполнения поставленных задач.
+
+        :param wait: дождаться остановки потока,
+        :return: ничего не возвращает.
+        """
+
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(None)
+        if wait:
+            self.thread.join()
+
+    def run(self):
+        """
+        Метод - цикл потока: забирает из очереди группу задач и выполняет
+        её.
+
+        :return: ничего не возвращает.
+        """
+
+        while True:
+            tasks = [self.queue.get()]
+            while tasks[-1] is not None and len(tasks) < self.batch:
+                try:
+                    tasks.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = tasks[-1] is None
+            if stop:
+                tasks.pop()
+            tasks = [task for task in tasks
+                     if task[0].set_running_or_notify_cancel()]
+            if tasks:
+                self.execute(tasks)
+            if stop:
+                return
+
+    def execute(self, tasks: list):
+        """
+        Метод выполняет группу задач в одной транзакции и передаёт их
+        результаты после коммита.
+
+        Если группу пришлось откатить, то задачи, выполненные до ошибки,
+        повторяются по одной, ошибкой завершается только задача, которая
+        её вызвала, а остальные задачи выполняются новой группой. Если
+        не удался сам коммит, то по одной повторяются все задачи группы.
+
+        :param tasks: список кортежей (Future, функция, аргументы),
+        :return: ничего не возвращает.
+        """
+
+        while tasks:
+            index, error = self.execute_group(tasks)
+            if error is None:
+                return
+            if len(tasks) == 1:
+                tasks[0][0].set_exception(error)
+                return
+            if index is None:
+                for task in tasks:
+                    self.execute([task])
+                return
+            for task in tasks[:index]:
+                self.execute([task])
+            tasks[index][0].set_exception(error)
+            tasks = tasks[index + 1:]
+
+    def execute_group(self, tasks: list):
+        """
+        Метод выполняет задачи в одной транзакции. Если транзакцию
+        пришлось откатить, то результаты задач не передаются.
+
+        :param tasks: список кортежей (Future, функция, аргументы),
+        :return: tuple: номер задачи, из-за которой группа откачена (None,
+        если не удался коммит), и ошибка или (None, None) при успехе.
+        """
+
+        storage = self.storage
+        if storage is not None:
+            storage.begin_group()
+        results = []
+        for index, (future, func, args) in enumerate(tasks):
+            try:
+                results.append((future, func(*args), None))
+            except BaseException as error:
+                if storage is not None and storage.group_failed():
+                    LOGGER.error(f'Групповой коммит отменён ошибкой задачи '
+                                 f'{func.__name__}: {error}.')
+                    storage.rollback_group()
+                    return index, error
+                results.append((future, None, error))
+        if storage is not None:
+            try:
+                storage.commit_group()
+            except Exception as error:
+                LOGGER.error(f'Ошибка группового коммита: {error}.')
+                storage.rollback_group()
+                return None, error
+            self.commits += 1
+            self.committed += len(results)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        return None, None
+
+
+class WorkerPool:
+    """
+    Класс - фоновые исполнители сервера.
+
+    Работа с базой данных выполняется одним потоком storage
+    (StorageWriter): сессия SQLAlchemy не рассчитана на одновременную
+    работу из нескольких потоков, а запись в SQLite всё равно выполняется
+    последовательно. Порядок задач сохраняется. Вычисления выполняются
+    пулом compute из потоков или процессов, в зависимости от настроек.
+    """
+
+    def __init__(self, workers: int = WORKERS, kind: str = WORKER_KIND,
+                 storage=None, batch: int = STORAGE_BATCH):
+        if kind not in WORKER_KINDS:
+            LOGGER.error(
+                f'Неизвестный тип пула вычислений - {kind}, '
+                f'используется {WORKER_KIND}.')
+            kind = WORKER_KIND
+        self.kind = kind
+        self.storage = StorageWriter(storage, batch)
+        if kind == 'process':
+            self.compute = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.compute = ThreadPoolExecutor(max_workers=workers,
+                                              thread_name_prefix='compute')
+
+    def __repr__(self):
+        return f'Пул исполнителей: база данных - 1 поток, ' \
+               f'вычисления - {self.kind}.'
+
+    def shutdown(self):
+        """
+        Метод дожидается завершения поставленных задач и останавливает
+        исполнители.
+
+        :return: ничего не возвращает.
+        """
+
+        self.storage.shutdown(wait=True)
+        self.compute.shutdown(wait=True)
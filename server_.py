@@ -10,9 +10,11 @@ from PyQt5.QtCore import Qt
 from common.decos import log
 from common.variables import *
 import logs.server_log_config
-from server.core import MessageProcessor
+from server.core import MessageProcessor, get_setting
+from server.async_core import AsyncMessageProcessor
 from server.database import ServerStorage
 from server.main_window import MainWindow
+from server.shards import ShardSupervisor
 
 LOGGER = logging.getLogger('server')
 
@@ -24,7 +26,8 @@ def create_arg_parser(default_port: int, default_address: str):
 
     :param default_port: Передается порт сервера по умолчанию,
     :param default_address: Передается IP-адрес сервера по умолчанию,
-    :return: Возвращается порт и IP-адрес сервера.
+    :return: Возвращается порт и IP-адрес сервера, флаг запуска без GUI,
+    движок сервера и количество процессов - шардов.
     """
 
     LOGGER.debug(
@@ -33,12 +36,17 @@ def create_arg_parser(default_port: int, default_address: str):
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('--not_gui', action='store_true')
+    parser.add_argument('--engine', default=SERVER_ENGINES[0],
+                        choices=SERVER_ENGINES)
+    parser.add_argument('--shards', default=1, type=int)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.not_gui
+    engine = namespace.engine
+    shards = namespace.shards
     LOGGER.debug('Аргументы успешно загружены.')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, engine, shards
 
 
 @log
@@ -68,17 +76,45 @@ def main():
     config = config_load()
     # Загрузка параметров командной строки,
     # если нет параметров, то задаём значения по умолчанию.
-    listen_address, listen_port, gui_flag = create_arg_parser(
-        int(config['SETTINGS']['default_port']),
-        config['SETTINGS']['default_address']
-    )
+    listen_address, listen_port, gui_flag, engine, shards = \
+        create_arg_parser(int(config['SETTINGS']['default_port']),
+                          config['SETTINGS']['default_address'])
 
     # Инициализация базы данных.
-    database = ServerStorage(os.path.join(config['SETTINGS']['database_path'],
-                                          config['SETTINGS']['database_file']))
+    database = ServerStorage(
+        os.path.join(config['SETTINGS']['database_path'],
+                     config['SETTINGS']['database_file']),
+        get_setting(config['SETTINGS'], 'offline_ttl', OFFLINE_MESSAGES_TTL),
+        get_setting(config['SETTINGS'], 'offline_limit',
+                    OFFLINE_MESSAGES_LIMIT),
+        get_setting(config['SETTINGS'], 'user_cache_size', USER_CACHE_SIZE),
+        get_setting(config['SETTINGS'], 'stats_flush_threshold',
+                    STATS_FLUSH_THRESHOLD),
+        {name: get_setting(config['SETTINGS'], f'sqlite_{name}', default)
+         for name, default in SQLITE_PRAGMAS.items()},
+        get_setting(config['SETTINGS'], 'sqlite_readers', SQLITE_READERS))
+
+    # Создание экземпляра класса - сервера выбранного движка.
+    engine_class = AsyncMessageProcessor if engine == 'asyncio' \
+        else MessageProcessor
+
+    # Сервер из нескольких процессов - шардов работает без GUI: окно
+    # управления работает с сервером в своём процессе.
+    if shards > 1:
+        supervisor = ShardSupervisor(shards, engine_class, listen_address,
+                                     listen_port, database,
+                                     config['SETTINGS'])
+        supervisor.start()
+        while True:
+            command = input('Введите "exit" для завершения работы сервера.')
+            if command == 'exit':
+                supervisor.stop()
+                supervisor.join()
+                break
+        return
 
-    # Создание экземпляра класса - сервера.
-    server = MessageProcessor(listen_address, listen_port, database)
+    server = engine_class(listen_address, listen_port, database,
+                          config['SETTINGS'])
     server.daemon = True
     server.start()
 
@@ -86,12 +122,15 @@ def main():
     # обработчик консольного ввода.
     if gui_flag:
         while True:
-            command = input('Введите "exit" для завершения работы сервера.')
+            command = input('Введите "exit" для завершения работы сервера, '
+                            '"metrics" - для вывода метрик.')
             if command == 'exit':
                 # Если выход, то завершаем основной цикл сервера.
-                server.running = False
+                server.stop()
                 server.join()
                 break
+            elif command == 'metrics':
+                print(server.collect_metrics())
 
     # Если не указан запуск без GUI, то запускаем GUI.
     else:
@@ -101,7 +140,10 @@ def main():
 
         server_app.exec_()
 
-        server.running = False
+        # Дожидаемся остановки сервера, чтобы накопленные изменения были
+        # записаны в базу.
+        server.stop()
+        server.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,72 @@
+"""Тесты двоичного формата сообщений"""
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.codec import encode_binary, decode_binary, INT_MAX, INT_MIN, \
+    COUNT_MAX
+from common.errors import ProtocolError
+from common.utils import MessageBuffer
+from common.variables import *
+
+
+class TestCodec(unittest.TestCase):
+    """Класс - тесты encode_binary и decode_binary."""
+
+    def assert_round_trip(self, message: dict):
+        self.assertEqual(decode_binary(encode_binary(message)), message)
+
+    def test_response(self):
+        self.assert_round_trip({RESPONSE: 200})
+        self.assert_round_trip({RESPONSE: 200, REQUEST_ID: 7})
+
+    def test_message(self):
+        message = {ACTION: MESSAGE, TIME: 1.5, SENDER: 'Анна',
+                   DESTINATION: 'Евгений', MESSAGE_TEXT: 'aGVsbG8='}
+        self.assert_round_trip(message)
+        self.assert_round_trip(dict(message, **{REQUEST_ID: 0xFFFFFFFF}))
+        self.assert_round_trip(dict(message, **{MESSAGE_TEXT: 'привет'}))
+
+    def test_generic(self):
+        self.assert_round_trip({
+            ACTION: PRESENCE, TIME: 1, USER: {ACCOUNT_NAME: 'Анна',
+                                              PUBLIC_KEY: 'key'},
+            'extra': [None, True, False, INT_MIN, INT_MAX, 0.25, [1, 'a']],
+            LIST_INFO: ['Анна', 'Евгений'], DATA: 'AAEC'})
+
+    def test_long_names(self):
+        name = 'я' * COUNT_MAX
+        self.assert_round_trip({ACTION: MESSAGE, TIME: 1.0, SENDER: name,
+                                DESTINATION: 'b', MESSAGE_TEXT: 'x'})
+
+    def test_out_of_range(self):
+        for value in (INT_MAX + 1, INT_MIN - 1, 2 ** 70):
+            with self.assertRaises(TypeError):
+                encode_binary({RESPONSE: 200, REQUEST_ID: value})
+        with self.assertRaises(TypeError):
+            encode_binary({ACTION: MESSAGE, TIME: 2 ** 64, SENDER: 'a',
+                           DESTINATION: 'b', MESSAGE_TEXT: 'x'})
+        with self.assertRaises(TypeError):
+            encode_binary({DATA: {str(i): i for i in range(COUNT_MAX + 1)}})
+
+    def test_truncated(self):
+        data = encode_binary({ACTION: PRESENCE, TIME: 1.0,
+                              USER: {ACCOUNT_NAME: 'Анна'}})
+        for end in range(1, len(data)):
+            with self.assertRaises(ProtocolError):
+                decode_binary(data[:end])
+
+    def test_pack_falls_back_to_json(self):
+        sender, receiver = MessageBuffer(), MessageBuffer()
+        sender.framed = True
+        sender.codec = CODEC_BINARY
+        message = {RESPONSE: 200, REQUEST_ID: 2 ** 70}
+        receiver.feed(sender.pack(message))
+        self.assertEqual(receiver.next_message(), message)
+        self.assertEqual(receiver.codec, CODEC_JSON)
+
+
+if __name__ == '__main__':
+    unittest.main()
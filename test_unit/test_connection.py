@@ -0,0 +1,67 @@
+"""Тесты буфера исходящих данных соединения"""
+import os
+import socket
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from server.connection import Connection
+
+
+class TestConnection(unittest.TestCase):
+    """Класс - тесты границ буфера и выгрузки данных на диск."""
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sock.setblocking(False)
+        self.addCleanup(self.peer.close)
+        self.connection = Connection(self.sock, ('127.0.0.1', 0),
+                                     high_water=1000, low_water=100)
+        self.addCleanup(self.connection.close)
+
+    def receive(self, size: int):
+        """Читает из сокета - получателя ровно size байт."""
+        data = b''
+        while len(data) < size:
+            data += self.peer.recv(size - len(data))
+        return data
+
+    def test_watermarks(self):
+        self.connection.append(b'a' * 600)
+        self.assertFalse(self.connection.congested)
+        self.connection.append(b'b' * 600)
+        self.assertTrue(self.connection.is_full())
+        self.assertTrue(self.connection.congested)
+        self.assertTrue(self.connection.flush())
+        self.assertEqual(self.receive(1200), b'a' * 600 + b'b' * 600)
+        self.assertFalse(self.connection.congested)
+        self.assertEqual(self.connection.sent, 1200)
+
+    def test_congested_until_low_water(self):
+        # Пока сокет не принимает данные, соединение остаётся
+        # перегруженным.
+        data = os.urandom(64 * 1024)
+        for _ in range(64):
+            self.connection.append(data)
+        self.assertFalse(self.connection.flush())
+        self.assertTrue(self.connection.congested)
+        self.assertGreater(self.connection.queued, 0)
+        while not self.connection.flush():
+            self.peer.recv(1024 * 1024)
+        self.assertFalse(self.connection.congested)
+        self.assertEqual(self.connection.queued, 0)
+
+    def test_spill_keeps_order(self):
+        self.connection.append(b'memory ')
+        self.connection.spill(b'disk ')
+        self.connection.append(b'after')
+        self.assertTrue(self.connection.congested)
+        self.assertEqual(self.connection.queued, 17)
+        self.assertTrue(self.connection.flush())
+        self.assertEqual(self.receive(17), b'memory disk after')
+        self.assertEqual(self.connection.spilled, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""Тесты хранилища сервера"""
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from server.database import ServerStorage, UserDirectory, UserRecord
+
+
+class TestServerStorage(unittest.TestCase):
+    """Класс - базовый класс тестов с временной базой данных."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'server.db3')
+        self.database = self.open_storage()
+        self.database.add_user('alice', 'hash')
+        self.database.add_user('bob', 'hash')
+
+    def open_storage(self, **kwargs):
+        """Открывает хранилище и регистрирует его закрытие."""
+        database = ServerStorage(self.path, **kwargs)
+        self.addCleanup(database.reader_engine.dispose)
+        self.addCleanup(database.database_engine.dispose)
+        self.addCleanup(database.session.close)
+        return database
+
+    def history(self):
+        """Возвращает счётчики сообщений по именам пользователей."""
+        return {name: (sent, accepted) for name, _, sent, accepted
+                in self.database.message_history()}
+
+
+class TestHistory(TestServerStorage):
+    """Класс - тесты отложенной записи статистики сообщений."""
+
+    def test_pending_deltas_are_visible(self):
+        self.database.process_message('alice', 'bob')
+        self.database.process_message('alice', 'bob')
+        self.assertEqual(self.history(), {'alice': (2, 0), 'bob': (0, 2)})
+        self.database.flush_history()
+        self.assertFalse(self.database.history_pending)
+        self.assertEqual(self.history(), {'alice': (2, 0), 'bob': (0, 2)})
+
+    def test_failed_flush_keeps_deltas(self):
+        self.database.process_message('alice', 'bob')
+        with mock.patch.object(self.database.session, 'execute',
+                               side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.database.flush_history()
+        self.database.process_message('bob', 'alice')
+        self.assertEqual(self.database.history_pending_count, 2)
+        self.database.flush_history()
+        self.assertEqual(self.history(), {'alice': (1, 1), 'bob': (1, 1)})
+
+    def test_removed_user(self):
+        self.database.process_message('alice', 'bob')
+        self.database.remove_user('bob')
+        self.database.process_message('alice', 'bob')
+        self.database.user_logout('bob')
+        self.database.remove_user('bob')
+        self.database.flush_history()
+        self.assertEqual(self.history(), {'alice': (1, 0)})
+
+
+class TestOfflineMessages(TestServerStorage):
+    """Класс - тесты хранения сообщений для пользователей не в сети."""
+
+    def message(self, text: str):
+        return {ACTION: MESSAGE, SENDER: 'alice', DESTINATION: 'bob',
+                TIME: 1, MESSAGE_TEXT: text}
+
+    def test_pending_and_stored(self):
+        self.assertTrue(self.database.add_offline_message(
+            'bob', self.message('first')))
+        self.database.flush_offline_messages()
+        self.assertTrue(self.database.add_offline_message(
+            'bob', self.message('second')))
+        self.assertFalse(self.database.add_offline_message(
+            'nobody', self.message('lost')))
+        self.assertEqual(self.database.get_offline_messages('bob'),
+                         [self.message('first'), self.message('second')])
+        # Выданные сообщения не выдаются повторно и удаляются из базы.
+        self.assertEqual(self.database.get_offline_messages('bob'), [])
+        self.database.flush_offline_messages()
+        self.assertEqual(self.database.session.query(
+            self.database.OfflineMessages).count(), 0)
+
+    def test_limit(self):
+        self.database.offline_limit = 2
+        for text in ('first', 'second'):
+            self.assertTrue(self.database.add_offline_message(
+                'bob', self.message(text)))
+        self.database.flush_offline_messages()
+        self.assertFalse(self.database.add_offline_message(
+            'bob', self.message('third')))
+        self.assertEqual(len(self.database.get_offline_messages('bob')), 2)
+        self.database.flush_offline_messages()
+        self.assertTrue(self.database.add_offline_message(
+            'bob', self.message('third')))
+
+    def test_expired(self):
+        self.database.add_offline_message('bob', self.message('old'))
+        self.database.flush_offline_messages()
+        self.database.offline_ttl = -1
+        self.assertEqual(self.database.get_offline_messages('bob'), [])
+        self.database.add_offline_message('bob', self.message('old'))
+        self.database.flush_offline_messages()
+        self.database.purge_offline_messages()
+        self.assertEqual(self.database.session.query(
+            self.database.OfflineMessages).count(), 0)
+
+
+class TestUserDirectory(TestServerStorage):
+    """Класс - тесты кэша каталога пользователей."""
+
+    def test_lru(self):
+        directory = UserDirectory(2)
+        for name in ('a', 'b'):
+            directory.put(UserRecord(1, name, None, None, None))
+        self.assertIsNotNone(directory.get('a'))
+        directory.put(UserRecord(3, 'c', None, None, None))
+        self.assertIsNone(directory.get('b'))
+        self.assertEqual(list(directory.records), ['a', 'c'])
+        self.assertEqual((directory.hits, directory.misses,
+                          directory.evictions), (1, 1, 1))
+
+    def test_unbounded(self):
+        directory = UserDirectory(0)
+        for index in range(100):
+            directory.put(UserRecord(index, str(index), None, None, None))
+        self.assertEqual(len(directory.records), 100)
+        self.assertEqual(directory.evictions, 0)
+
+    def test_storage_cache(self):
+        database = self.open_storage(user_cache_size=1)
+        alice = database.find_user('alice')
+        self.assertIs(database.find_user('alice'), alice)
+        self.assertEqual(database.find_user('bob').name, 'bob')
+        self.assertNotIn('alice', database.users.records)
+        self.assertEqual(database.find_user('alice').id, alice.id)
+        self.assertIsNone(database.find_user('nobody'))
+
+
+class TestMigration(TestServerStorage):
+    """Класс - тесты обновления схемы базы."""
+
+    def test_from_version_0(self):
+        self.database.add_contact('alice', 'bob')
+        self.database.session.close()
+        self.database.database_engine.dispose()
+        self.database.reader_engine.dispose()
+        # База предыдущей версии: без индекса контактов и с дублями.
+        with sqlite3.connect(self.path) as connection:
+            connection.execute('DROP INDEX ix_Contacts_user_contact')
+            connection.execute('INSERT INTO Contacts ("user", contact) '
+                               'SELECT "user", contact FROM Contacts')
+            connection.execute('PRAGMA user_version = 0')
+        connection.close()
+
+        database = self.open_storage()
+        self.assertEqual(database.get_contacts('alice'), ['bob'])
+        with sqlite3.connect(self.path) as connection:
+            version = connection.execute('PRAGMA user_version').fetchone()
+            indexes = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            ).fetchall()
+        connection.close()
+        self.assertEqual(version, (SERVER_SCHEMA_VERSION,))
+        self.assertIn(('ix_Contacts_user_contact',), indexes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+"""Тесты реестра действий протокола"""
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from server.dispatch import ActionRegistry
+
+
+class TestActionRegistry(unittest.TestCase):
+    """Класс - тесты регистрации и проверки действий."""
+
+    def setUp(self):
+        self.actions = ActionRegistry()
+
+        @self.actions.register(MESSAGE, SENDER, DESTINATION,
+                               sender=SENDER, check=lambda message: isinstance(
+                                   message[DESTINATION], str))
+        def process_message(message):
+            return message
+
+        self.handler = process_message
+
+    def test_register(self):
+        spec = self.actions[MESSAGE]
+        self.assertEqual(spec.handler, 'process_message')
+        self.assertEqual(spec.fields, (SENDER, DESTINATION))
+        self.assertEqual(spec.sender, SENDER)
+        # Декоратор возвращает метод без изменений.
+        self.assertEqual(self.handler(1), 1)
+
+    def test_validate(self):
+        spec = self.actions[MESSAGE]
+        self.assertTrue(spec.validate({SENDER: 'a', DESTINATION: 'b'}))
+        self.assertFalse(spec.validate({SENDER: 'a'}))
+        self.assertFalse(spec.validate({SENDER: 'a', DESTINATION: 1}))
+
+    def test_copy(self):
+        actions = self.actions.copy()
+        actions.register(EXIT)(print)
+        self.assertIsInstance(actions, ActionRegistry)
+        self.assertIn(MESSAGE, actions)
+        self.assertNotIn(EXIT, self.actions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Тесты ограничения частоты сообщений"""
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from server.limits import TokenBucket, RateLimits
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Класс - тесты ведра токенов."""
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, burst=3, now=0)
+        self.assertEqual([bucket.take(0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.take(0), 0.5)
+        self.assertEqual(bucket.take(0.5), 0)
+        self.assertAlmostEqual(bucket.take(0.5), 0.5)
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(rate=10, burst=2, now=0)
+        bucket.take(0)
+        bucket.take(100)
+        self.assertEqual(bucket.tokens, 1)
+
+
+class TestRateLimits(unittest.TestCase):
+    """Класс - тесты ограничений клиента."""
+
+    def test_parse(self):
+        self.assertEqual(
+            RateLimits.parse('message:20:40, get_users:1:0,, bad'),
+            {MESSAGE: (20.0, 40.0), USERS_REQUEST: (1.0, 1)})
+
+    def test_action_buckets(self):
+        limits = RateLimits(rate=1, burst=1, actions='message:1:2')
+        buckets = dict()
+        self.assertEqual(limits.delay(buckets, MESSAGE, 0), 0)
+        self.assertEqual(limits.delay(buckets, MESSAGE, 0), 0)
+        self.assertGreater(limits.delay(buckets, MESSAGE, 0), 0)
+        # Остальные действия расходуют общее ведро.
+        self.assertEqual(limits.delay(buckets, GET_CONTACTS, 0), 0)
+        self.assertGreater(limits.delay(buckets, USERS_REQUEST, 0), 0)
+        self.assertEqual(set(buckets), {MESSAGE, None})
+
+    def test_unhashable_action(self):
+        limits = RateLimits(rate=1, burst=1, actions='message:1:2')
+        buckets = dict()
+        self.assertEqual(limits.delay(buckets, [], 0), 0)
+        self.assertEqual(set(buckets), {None})
+
+    def test_disabled(self):
+        limits = RateLimits(rate=0, actions='message:0:1')
+        buckets = dict()
+        for _ in range(1000):
+            self.assertEqual(limits.delay(buckets, MESSAGE, 0), 0)
+            self.assertEqual(limits.delay(buckets, PRESENCE, 0), 0)
+        self.assertFalse(buckets)
+
+
+if __name__ == '__main__':
+    unittest.main()
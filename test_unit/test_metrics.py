@@ -0,0 +1,83 @@
+"""Тесты метрик сервера"""
+import os
+import sys
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from server.metrics import Histogram, Metrics, Exposition, MetricsExporter
+
+
+class TestHistogram(unittest.TestCase):
+    """Класс - тесты гистограммы и её текста."""
+
+    def test_observe(self):
+        histogram = Histogram((1, 2))
+        for value in (0.5, 1, 1.5, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.total, 6)
+
+    def test_exposition(self):
+        histogram = Histogram((1, 2))
+        histogram.observe(1.5)
+        text = Exposition()
+        text.sample('sent_total', 'counter', 'Отправлено.', 1,
+                    {'code': 'a"b'})
+        text.sample('sent_total', 'counter', 'Отправлено.', 2)
+        text.histogram('latency_seconds', 'Время.', histogram,
+                       {'action': 'message'})
+        self.assertEqual(text.text().splitlines(), [
+            '# HELP messenger_sent_total Отправлено.',
+            '# TYPE messenger_sent_total counter',
+            'messenger_sent_total{code="a\\"b"} 1',
+            'messenger_sent_total 2',
+            '# HELP messenger_latency_seconds Время.',
+            '# TYPE messenger_latency_seconds histogram',
+            'messenger_latency_seconds_bucket{action="message",le="1"} 0',
+            'messenger_latency_seconds_bucket{action="message",le="2"} 1',
+            'messenger_latency_seconds_bucket{action="message",le="+Inf"} 1',
+            'messenger_latency_seconds_sum{action="message"} 1.5',
+            'messenger_latency_seconds_count{action="message"} 1',
+        ])
+
+
+class TestMetrics(unittest.TestCase):
+    """Класс - тесты счётчиков и сервера метрик."""
+
+    def test_timed_storage(self):
+        metrics = Metrics()
+
+        def add_user(name):
+            if not name:
+                raise ValueError(name)
+            return name
+
+        wrapper = metrics.timed_storage(add_user)
+        self.assertEqual(wrapper.__name__, 'add_user')
+        self.assertEqual(wrapper('alice'), 'alice')
+        with self.assertRaises(ValueError):
+            wrapper('')
+        self.assertEqual(metrics.storage_completed, 2)
+        self.assertEqual(metrics.storage_time['add_user'].count, 2)
+
+    def test_exporter(self):
+        texts = ['metric 1\n', None]
+        exporter = MetricsExporter('127.0.0.1', 0, texts.pop)
+        exporter.start()
+        self.addCleanup(exporter.stop)
+        url = 'http://127.0.0.1:%d' % exporter.httpd.server_address[1]
+        for path, code in (('/metrics', 503), ('/other', 404)):
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(url + path, timeout=5)
+            self.assertEqual(error.exception.code, code)
+            error.exception.close()
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as answer:
+            self.assertEqual(answer.read(), b'metric 1\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
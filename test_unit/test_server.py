@@ -0,0 +1,241 @@
+"""Тесты сервера"""
+import binascii
+import hashlib
+import hmac
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.variables import *
+from common.utils import send_message, get_message
+from server.connection import Connection
+from server.async_core import AsyncMessageProcessor
+from server.core import MessageProcessor
+from server.database import ServerStorage
+
+
+def free_port():
+    """
+    Функция возвращает свободный порт.
+
+    :return: int: номер порта.
+    """
+
+    with socket.socket() as sock:
+        sock.bind((DEFAULT_IP_ADDRESS, 0))
+        return sock.getsockname()[1]
+
+
+def password_hash(name: str, password: str):
+    """
+    Функция возвращает хэш пароля так же, как клиент.
+
+    :param name: имя пользователя,
+    :param password: пароль,
+    :return: bytes: хэш пароля.
+    """
+
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha512', password.encode('utf-8'), name.lower().encode('utf-8'),
+        100000))
+
+
+class TestServer(unittest.TestCase):
+    """Класс - тесты сервера на движке thread."""
+
+    engine = MessageProcessor
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.database = ServerStorage(
+            os.path.join(cls.directory.name, 'server.db3'))
+        for name in ('dave', 'erin'):
+            cls.database.add_user(name, password_hash(name, 'secret'))
+        cls.port = free_port()
+        cls.server = cls.engine(DEFAULT_IP_ADDRESS, cls.port, cls.database,
+                                None)
+        cls.server.daemon = True
+        cls.server.start()
+        # Ждём, пока сервер начнёт принимать соединения.
+        for _ in range(50):
+            try:
+                socket.create_connection(
+                    (DEFAULT_IP_ADDRESS, cls.port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server.join(5)
+        cls.database.session.close()
+        cls.database.database_engine.dispose()
+        cls.database.reader_engine.dispose()
+        cls.directory.cleanup()
+
+    def connect(self):
+        sock = socket.create_connection((DEFAULT_IP_ADDRESS, self.port),
+                                        timeout=5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def login(self, name: str, password: str):
+        client = self.connect()
+        send_message(client, {ACTION: PRESENCE, TIME: 1,
+                              USER: {ACCOUNT_NAME: name,
+                                     PUBLIC_KEY: 'key'}})
+        answer = get_message(client)
+        self.assertEqual(answer[RESPONSE], 511)
+        digest = hmac.new(password_hash(name, password),
+                          answer[DATA].encode('utf-8'), 'MD5').digest()
+        send_message(client, {RESPONSE: 511,
+                              DATA: binascii.b2a_base64(digest).decode()})
+        self.assertEqual(get_message(client)[RESPONSE], 200)
+        return client
+
+    def test_unauthorized_request_drops_only_client(self):
+        """Запрос неавторизованного клиента отключает только его."""
+        client = self.connect()
+        send_message(client, {ACTION: USERS_REQUEST, ACCOUNT_NAME: 'x',
+                              TIME: 1})
+        self.assertEqual(client.recv(RECV_BUFFER_LENGTH), b'')
+
+        self.assertTrue(self.server.is_alive())
+        client = self.connect()
+        send_message(client, {ACTION: PRESENCE, TIME: 1,
+                              USER: {ACCOUNT_NAME: 'nobody',
+                                     PUBLIC_KEY: 'key'}})
+        self.assertEqual(get_message(client)[RESPONSE], 400)
+
+    def test_bad_action_type_drops_only_client(self):
+        """Действие, которое не является строкой, не останавливает
+        сервер."""
+        client = self.connect()
+        send_message(client, {ACTION: [], TIME: 1})
+        self.assertEqual(client.recv(RECV_BUFFER_LENGTH), b'')
+
+        self.assertTrue(self.server.is_alive())
+        client = self.connect()
+        send_message(client, {ACTION: PRESENCE, TIME: 1,
+                              USER: {ACCOUNT_NAME: 'nobody',
+                                     PUBLIC_KEY: 'key'}})
+        self.assertEqual(get_message(client)[RESPONSE], 400)
+
+    def test_handler_error_drops_only_client(self):
+        """Непредвиденная ошибка обработчика отключает только клиента."""
+        with mock.patch.object(self.server, 'route_client_message',
+                               side_effect=RuntimeError('ошибка')):
+            client = self.connect()
+            send_message(client, {ACTION: PRESENCE, TIME: 1})
+            self.assertEqual(client.recv(RECV_BUFFER_LENGTH), b'')
+        self.assertTrue(self.server.is_alive())
+
+    def test_presence_key_must_be_string(self):
+        """Публичный ключ, который не является строкой, отклоняется."""
+        client = self.connect()
+        send_message(client, {ACTION: PRESENCE, TIME: 1,
+                              USER: {ACCOUNT_NAME: 'dave',
+                                     PUBLIC_KEY: 1}})
+        self.assertEqual(get_message(client)[RESPONSE], 400)
+
+    def test_failed_callback_drops_only_client(self):
+        """Ошибка вызова из очереди цикла отключает только клиента,
+        к которому относится вызов."""
+        client = self.login('dave', 'secret')
+        sock = self.server.names['dave']
+
+        def fail():
+            raise RuntimeError(sock)
+
+        self.server.call_soon(fail)
+        self.assertEqual(client.recv(RECV_BUFFER_LENGTH), b'')
+        self.assertTrue(self.server.is_alive())
+
+    def test_timers_run_in_order(self):
+        """Таймеры срабатывают по сроку, а не по порядку добавления."""
+        calls = []
+        done = threading.Event()
+
+        def schedule():
+            now = self.server.clock()
+            for delay, name in ((0.2, 'last'), (0.05, 'first'),
+                                (0.1, 'second'), (0.15, 'third')):
+                self.server.call_at(now + delay, calls.append, name)
+            self.server.call_at(now + 0.25, done.set)
+
+        self.server.call_soon(schedule)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(calls, ['first', 'second', 'third', 'last'])
+
+    def test_failed_login_keeps_backlog(self):
+        """Если вход не удалось записать в базу, то пользователь
+        отключается, а отложенные для него сообщения сохраняются."""
+        sender = self.login('erin', 'secret')
+        # Запрос к базе выполняется после записи входа отправителя.
+        send_message(sender, {ACTION: GET_CONTACTS, TIME: 1, USER: 'erin'})
+        self.assertEqual(get_message(sender)[RESPONSE], 202)
+        release = threading.Event()
+
+        def storage_login(*args):
+            release.wait(5)
+            raise RuntimeError('Ошибка записи входа.')
+
+        with mock.patch.object(self.server, 'storage_login', storage_login):
+            client = self.login('dave', 'secret')
+            send_message(sender, {ACTION: MESSAGE, SENDER: 'erin',
+                                  DESTINATION: 'dave', TIME: 1,
+                                  MESSAGE_TEXT: 'backlog'})
+            self.assertEqual(get_message(sender)[RESPONSE], 200)
+            release.set()
+            self.assertEqual(client.recv(RECV_BUFFER_LENGTH), b'')
+
+        client = self.login('dave', 'secret')
+        self.assertEqual(get_message(client)[MESSAGE_TEXT], 'backlog')
+
+    def test_compression_metrics(self):
+        """Метрики показывают объём данных и время сжатия."""
+        compressor = self.server.compressor
+        compressor.compress(b'a' * 4096)
+        text = self.server.collect_metrics()
+        for name, value in (
+                ('compressed_frames_total', compressor.frames),
+                ('compression_input_bytes_total', compressor.raw_bytes),
+                ('compression_output_bytes_total',
+                 compressor.compressed_bytes),
+                ('compression_cpu_seconds_total', compressor.cpu_time)):
+            self.assertIn(f'messenger_{name} {value}\n', text)
+        self.assertGreaterEqual(compressor.raw_bytes, 4096)
+
+    def test_offline_messages_kept_after_disconnect(self):
+        """Сообщения пользователя, отключившегося во время входа,
+        сохраняются до следующего входа."""
+        def message(text):
+            return {ACTION: MESSAGE, SENDER: 'nobody', DESTINATION: 'dave',
+                    TIME: 1, MESSAGE_TEXT: text}
+
+        connection = Connection(None, (DEFAULT_IP_ADDRESS, 0))
+        connection.backlog = [message('backlog')]
+        self.server.call_soon(self.server.deliver_offline, None, connection,
+                              'dave', [message('offline')])
+        client = self.login('dave', 'secret')
+        self.assertEqual([get_message(client)[MESSAGE_TEXT]
+                          for _ in range(2)], ['offline', 'backlog'])
+
+
+class TestAsyncServer(TestServer):
+    """Класс - тесты сервера на движке asyncio."""
+
+    engine = AsyncMessageProcessor
+
+
+if __name__ == '__main__':
+    unittest.main()
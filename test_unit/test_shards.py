@@ -0,0 +1,63 @@
+"""Тесты связи шардов"""
+import os
+import socket
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.errors import ShardEventTooLarge
+from common.variables import *
+from server.shards import ShardLink
+
+
+class TestShardLink(unittest.TestCase):
+    """Класс - тесты передачи событий между шардами."""
+
+    def setUp(self):
+        pairs = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                 for _ in range(3)]
+        for pair in pairs:
+            for sock in pair:
+                self.addCleanup(sock.close)
+        self.links = [ShardLink(index, pairs) for index in range(3)]
+
+    def test_send_and_broadcast(self):
+        self.assertTrue(self.links[0].send(1, 'login', 'alice'))
+        self.assertTrue(self.links[2].broadcast('logout', 'bob'))
+        self.assertEqual(self.links[1].receive(), [
+            ('login', 0, ['alice']), ('logout', 2, ['bob'])])
+        self.assertEqual(self.links[0].receive(), [('logout', 2, ['bob'])])
+        self.assertEqual(self.links[2].receive(), [])
+
+    def test_pending_until_flush(self):
+        # Пока буфер получателя заполнен, события откладываются и
+        # отправляются в исходном порядке.
+        sent = 0
+        while self.links[0].send(1, 'message', sent, 'x' * 1024):
+            sent += 1
+        self.links[0].send(1, 'message', sent + 1, 'last')
+        self.assertEqual(len(self.links[0].pending), 2)
+        received = []
+        while True:
+            received += [payload[0] for _, _, payload
+                         in self.links[1].receive()]
+            if self.links[0].flush():
+                break
+        received += [payload[0] for _, _, payload
+                     in self.links[1].receive()]
+        self.assertEqual(received, list(range(sent + 2)))
+
+    def test_too_large(self):
+        with self.assertRaises(ShardEventTooLarge):
+            self.links[0].send(1, 'message', 'x' * MAX_SHARD_DATAGRAM)
+        self.assertFalse(self.links[0].pending)
+
+    def test_bad_event(self):
+        self.links[0].peers[1].send(b'not json')
+        self.links[0].send(1, 'login', 'alice')
+        self.assertEqual(self.links[1].receive(), [('login', 0, ['alice'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""Тесты буфера сообщений"""
+import json
+import os
+import sys
+import time
+import unittest
+import zlib
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from common.errors import ProtocolError
+from common.utils import MessageBuffer, Compressor, encode_message, \
+    pack_frame, decompress
+from common.variables import *
+
+MESSAGES = [
+    {ACTION: PRESENCE, TIME: 1, USER: {ACCOUNT_NAME: 'Анна'}},
+    {ACTION: MESSAGE, TIME: 2, SENDER: 'Анна', DESTINATION: 'Евгений',
+     MESSAGE_TEXT: 'Привет, как дела?'},
+    {RESPONSE: 200},
+]
+# Заголовок кадра с длиной больше MAX_FRAME_LENGTH.
+TOO_LONG_HEADER = bytes([FRAME_MARKER]) + \
+    (MAX_FRAME_LENGTH + 1).to_bytes(4, 'big')
+
+
+def utf8_json(message: dict):
+    """Кодирует сообщение в JSON без экранирования кириллицы."""
+    return json.dumps(message, ensure_ascii=False).encode(ENCODING)
+
+
+def read_all(buffer: MessageBuffer):
+    """Возвращает все целые сообщения из буфера."""
+    messages = []
+    message = buffer.next_message()
+    while message is not None:
+        messages.append(message)
+        message = buffer.next_message()
+    return messages
+
+
+class TestMessageBuffer(unittest.TestCase):
+    """Класс - тесты разбора потока сообщений."""
+
+    def assert_split(self, data: bytes, expected: list):
+        """Данные, разрезанные в любом месте, разбираются одинаково."""
+        for cut in range(len(data) + 1):
+            buffer = MessageBuffer()
+            buffer.feed(data[:cut])
+            messages = read_all(buffer)
+            buffer.feed(data[cut:])
+            messages += read_all(buffer)
+            self.assertEqual(messages, expected, cut)
+
+    def test_legacy_split(self):
+        for encode in (encode_message, utf8_json):
+            data = b''.join(encode(message) for message in MESSAGES)
+            self.assert_split(data, MESSAGES)
+
+    def test_legacy_partial_character(self):
+        # Сообщение перед разрезанным символом выдаётся сразу.
+        first, second = (utf8_json(message) for message in MESSAGES[:2])
+        cut = second.index('Привет'.encode(ENCODING)) + 1
+        buffer = MessageBuffer()
+        buffer.feed(first + second[:cut])
+        self.assertEqual(buffer.next_message(), MESSAGES[0])
+        self.assertIsNone(buffer.next_message())
+        buffer.feed(second[cut:])
+        self.assertEqual(buffer.next_message(), MESSAGES[1])
+
+    def test_legacy_burst_is_linear(self):
+        data = utf8_json(MESSAGES[1]) * 20000
+        buffer = MessageBuffer()
+        buffer.feed(data)
+        started = time.perf_counter()
+        self.assertEqual(len(read_all(buffer)), 20000)
+        self.assertLess(time.perf_counter() - started, 5)
+
+    def test_legacy_invalid(self):
+        buffer = MessageBuffer()
+        buffer.feed(b'{"action": ' + b'x' * MAX_PACKAGE_LENGTH)
+        with self.assertRaises(ProtocolError):
+            buffer.next_message()
+        buffer = MessageBuffer()
+        buffer.feed(b'{"text": "\xff"}')
+        with self.assertRaises(ProtocolError):
+            buffer.next_message()
+
+    def test_frames_split(self):
+        data = b''.join(pack_frame(encode_message(message))
+                        for message in MESSAGES)
+        self.assert_split(data, MESSAGES)
+
+    def test_legacy_then_frames(self):
+        data = encode_message(MESSAGES[0]) + b''.join(
+            pack_frame(encode_message(message)) for message in MESSAGES[1:])
+        self.assert_split(data, MESSAGES)
+
+    def test_binary_and_compressed_frames(self):
+        sender = MessageBuffer()
+        sender.framed = True
+        sender.codec = CODEC_BINARY
+        sender.compressor = Compressor(threshold=0)
+        data = b''.join(sender.pack(message) for message in MESSAGES)
+        self.assert_split(data, MESSAGES)
+
+    def test_bad_frame_header(self):
+        buffer = MessageBuffer()
+        buffer.feed(pack_frame(b'{}', FRAME_MARKER | 0x40))
+        with self.assertRaises(ProtocolError):
+            buffer.next_message()
+        buffer = MessageBuffer()
+        buffer.feed(TOO_LONG_HEADER)
+        with self.assertRaises(ProtocolError):
+            buffer.next_message()
+
+
+class TestCompressor(unittest.TestCase):
+    """Класс - тесты сжатия кадров."""
+
+    def test_threshold(self):
+        compressor = Compressor(threshold=100)
+        payload = b'a' * 99
+        self.assertEqual(compressor.compress(payload), (payload, 0))
+        self.assertEqual(compressor.frames, 0)
+        data, flags = compressor.compress(b'a' * 1000)
+        self.assertEqual(flags, FRAME_COMPRESSED)
+        self.assertEqual(decompress(data), b'a' * 1000)
+        self.assertEqual(compressor.raw_bytes, 1000)
+        self.assertEqual(compressor.compressed_bytes, len(data))
+        self.assertGreater(compressor.ratio, 10)
+
+    def test_incompressible(self):
+        compressor = Compressor(threshold=0)
+        payload = os.urandom(1000)
+        self.assertEqual(compressor.compress(payload), (payload, 0))
+        self.assertEqual((compressor.frames, compressor.skipped), (0, 1))
+        self.assertEqual(compressor.ratio, 1.0)
+
+    def test_decompress_limits(self):
+        with self.assertRaises(ProtocolError):
+            decompress(b'not zlib')
+        with self.assertRaises(ProtocolError):
+            decompress(zlib.compress(b'\0' * (MAX_FRAME_LENGTH + 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
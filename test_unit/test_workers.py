@@ -0,0 +1,85 @@
+"""Тесты фоновых исполнителей сервера"""
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from server.database import ServerStorage
+from server.workers import StorageWriter, make_challenge
+
+
+class TestStorageWriter(unittest.TestCase):
+    """Класс - тесты потока базы данных с групповым коммитом."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = ServerStorage(
+            os.path.join(directory.name, 'server.db3'))
+        self.addCleanup(self.database.reader_engine.dispose)
+        self.addCleanup(self.database.database_engine.dispose)
+        self.addCleanup(self.database.session.close)
+        self.database.add_user('alice', 'hash')
+        self.writer = StorageWriter(self.database)
+        self.addCleanup(self.writer.shutdown)
+
+    def submit_group(self, *tasks):
+        """Ставит задачи в очередь так, чтобы они попали в одну группу."""
+        gate = threading.Event()
+        self.writer.submit(gate.wait)
+        futures = [self.writer.submit(func, *args) for func, *args in tasks]
+        gate.set()
+        for future in futures:
+            future.exception(5)
+        return futures
+
+    def test_group_commit(self):
+        futures = self.submit_group(
+            *[(self.database.add_user, f'user_{i}', 'hash')
+              for i in range(10)])
+        self.assertTrue(all(future.exception() is None
+                            for future in futures))
+        self.assertEqual(len(self.database.users_list()), 11)
+        self.assertLessEqual(self.writer.commits, 3)
+
+    def test_failed_task_fails_alone(self):
+        message = {'action': 'message', 'from': 'bob', 'to': 'alice'}
+        first, failed, last = self.submit_group(
+            (self.database.add_offline_message, 'alice', message),
+            (self.database.add_user, 'alice', 'hash'),
+            (self.database.add_user, 'bob', 'hash'))
+        self.assertTrue(first.result())
+        self.assertIsNotNone(failed.exception())
+        self.assertIsNone(last.exception())
+        self.assertTrue(self.database.check_user('bob'))
+        # Откат группы не дублирует сообщение, сохранённое в памяти.
+        self.assertEqual(len(self.database.offline_pending), 1)
+        self.assertEqual(self.database.offline_counts['alice'], 1)
+
+    def test_error_without_rollback(self):
+        failed, done = self.submit_group(
+            (lambda: 1 / 0,), (self.database.add_user, 'bob', 'hash'))
+        self.assertIsInstance(failed.exception(), ZeroDivisionError)
+        self.assertIsNone(done.exception())
+
+    def test_shutdown(self):
+        self.writer.shutdown()
+        with self.assertRaises(RuntimeError):
+            self.writer.submit(print)
+
+
+class TestMakeChallenge(unittest.TestCase):
+    """Класс - тест запроса 511."""
+
+    def test_digest(self):
+        challenge, digest = make_challenge(b'hash')
+        self.assertEqual(len(challenge), 128)
+        self.assertEqual(len(digest), 16)
+        self.assertNotEqual(make_challenge(b'hash')[0], challenge)
+
+
+if __name__ == '__main__':
+    unittest.main()